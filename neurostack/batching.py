@@ -0,0 +1,82 @@
+"""
+Batching of requests to the Neurostack server. Requests with the same key (eg.
+the same user and endpoint) made within a short window of each other are sent
+as one batch, and each caller gets its own result back, so that the round
+trip and the classifier call are shared by the whole batch.
+"""
+import asyncio
+
+# seconds to wait for more requests before sending a batch, and the most
+# requests in a batch
+BATCH_WINDOW = 0.005
+MAX_BATCH_SIZE = 64
+
+
+class RequestBatcher:
+
+    def __init__(self, send_batch, window=BATCH_WINDOW,
+                 max_size=MAX_BATCH_SIZE):
+        """
+        Initializes a batcher with no pending requests
+
+        :param send_batch: coroutine function called with a key and a list of
+                           items, that returns a list with a result for each
+                           item
+        :param window: seconds after the first request of a batch that the
+                       batch is sent
+        :param max_size: most requests in a batch; a full batch is sent
+                         straight away
+        """
+        self.send_batch = send_batch
+        self.window = window
+        self.max_size = max_size
+
+        # batches waiting to be sent, as (items, futures), with key as key
+        self._batches = {}
+
+    async def submit(self, key, item):
+        """
+        Adds a request to the batch for key, and waits for its result
+
+        :param key: requests with the same key are batched together
+        :param item: the request
+        :return: the result for item
+        :raises Exception: whatever send_batch raised for the batch
+        """
+        loop = asyncio.get_event_loop()
+
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = ([], [])
+            self._batches[key] = batch
+            loop.call_later(self.window, self._flush, key, batch)
+
+        future = loop.create_future()
+        batch[0].append(item)
+        batch[1].append(future)
+        if len(batch[0]) >= self.max_size:
+            self._flush(key, batch)
+
+        return await future
+
+    def _flush(self, key, batch):
+        """Sends a batch, unless it was sent already"""
+        if self._batches.get(key) is not batch:
+            return
+        del self._batches[key]
+
+        asyncio.get_event_loop().create_task(self._send(key, *batch))
+
+    async def _send(self, key, items, futures):
+        """Sends a batch and hands out the results"""
+        try:
+            results = await self.send_batch(key, items)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
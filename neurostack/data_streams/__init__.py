@@ -1 +1,3 @@
-from data_stream import DataStream
+from data_streams.data_stream import DataStream
+from data_streams.ring_buffer import RingBuffer
+from data_streams.archive import SessionArchive, SessionRecorder
@@ -0,0 +1,354 @@
+"""
+Append-only, on-disk session archives. A SessionRecorder writes samples to a
+file from a background thread, and a SessionArchive memory-maps the file so
+that it can be queried like a DataStream without loading it into RAM.
+
+An archive file starts with a fixed-size header: a magic string, the length of
+a JSON description (channel names, sample rate, ...) and the description
+itself. It is followed by one record per sample: a float64 timestamp and a
+float32 value for each channel. Markers are kept next to the archive in
+`<path>.markers`, one JSON object per line.
+"""
+import json
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+from data_streams.time_index import extract_epochs, window_bounds
+
+MAGIC = b'NSTKARC1'
+HEADER_SIZE = 4096
+VERSION = 1
+
+# most blocks of samples (and markers) waiting to be written. If the writer
+# falls this far behind (eg. the disk stalls), recording stops rather than
+# using more and more memory
+MAX_QUEUED_BLOCKS = 1000
+
+
+def record_dtype(num_channels):
+    """Returns the numpy dtype of one sample in an archive"""
+    return np.dtype([('timestamp', '<f8'), ('data', '<f4', (num_channels,))])
+
+
+class SessionRecorder:
+
+    def __init__(self, path, channels, sample_rate=None):
+        """
+        Creates an archive at path and starts the background writer
+
+        :param path: file to write to. It is overwritten if it exists
+        :param channels: names of the channels that will be recorded
+        :param sample_rate: nominal sample rate of the recorded stream
+        """
+        self.path = path
+        self.channels = list(channels)
+        self.sample_rate = sample_rate
+
+        self._dtype = record_dtype(len(self.channels))
+        self._queue = queue.Queue(maxsize=MAX_QUEUED_BLOCKS)
+
+        # error that stopped the writer, if any; once set (or aborted), the
+        # writer stops and the rest of the queue is dropped
+        self.error = None
+        self._aborted = False
+
+        self._file = open(path, 'wb')
+        self._file.write(self._make_header())
+        self._file.flush()
+        self._markers_file = open(path + '.markers', 'w')
+
+        self._thread = threading.Thread(target=self._write_indefinitely,
+                                        name='archive')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _make_header(self):
+        """Returns the header for this archive as bytes"""
+        description = json.dumps({
+            'version': VERSION,
+            'channels': self.channels,
+            'sample_rate': self.sample_rate,
+            'created': time.time()
+        }).encode('utf-8')
+
+        header = MAGIC + struct.pack('<I', len(description)) + description
+        if len(header) > HEADER_SIZE:
+            raise ValueError("Too many channels to describe in archive header")
+
+        return header.ljust(HEADER_SIZE, b'\0')
+
+    def write(self, timestamps, samples):
+        """
+        Queues a block of samples to be written. Returns immediately.
+
+        :param timestamps: timestamps of the n samples
+        :param samples: (n x channels) block of samples
+        :return: None
+        :raises IOError: if the writer has failed or fallen too far behind.
+                         Nothing more is written after this; see abort
+        """
+        records = np.empty(len(timestamps), dtype=self._dtype)
+        records['timestamp'] = timestamps
+        records['data'] = samples
+        self._put(records)
+
+    def add_marker(self, timestamp, label):
+        """
+        Records a marker (eg. a stimulus or a training label) at timestamp
+
+        :param timestamp: timestamp of marker
+        :param label: JSON-serializable label
+        :return: None
+        :raises IOError: if the writer has failed or fallen too far behind
+        """
+        self._put({'timestamp': timestamp, 'label': label})
+
+    def _put(self, item):
+        """Queues an item for the writer, without waiting"""
+        if self.error is not None:
+            raise IOError(f"Cannot write to archive {self.path}: "
+                          f"{self.error}")
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            raise IOError(f"Archive {self.path} has fallen more than "
+                          f"{MAX_QUEUED_BLOCKS} blocks behind")
+
+    def abort(self):
+        """
+        Stops the writer without waiting for it, dropping anything that is
+        still queued. The archive is closed once the writer stops.
+
+        :return: None
+        """
+        self._aborted = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def close(self):
+        """Writes everything that is queued, then closes the archive"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._file.close()
+        self._markers_file.close()
+
+    def _write_indefinitely(self):
+        """
+        Write queued samples and markers until the recorder is closed
+
+        :return: None
+        """
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None or self._aborted:
+                    break
+
+                if isinstance(item, dict):
+                    self._markers_file.write(json.dumps(item) + '\n')
+                else:
+                    self._file.write(item.tobytes())
+
+                # flush when we have caught up, so that readers see the data
+                if self._queue.empty():
+                    self._file.flush()
+                    self._markers_file.flush()
+        except Exception as e:
+            print(f"Cannot write to archive {self.path}: {e}")
+            self.error = e
+        finally:
+            if self.error is not None or self._aborted:
+                self._file.close()
+                self._markers_file.close()
+
+
+class SessionArchive:
+
+    def __init__(self, path):
+        """
+        Opens an archive written by a SessionRecorder. Samples are memory-
+        mapped, so only the parts that are queried are read from disk.
+
+        :param path: archive file to open
+        """
+        self.path = path
+
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a Neurostack archive")
+
+        length, = struct.unpack('<I', header[len(MAGIC):len(MAGIC) + 4])
+        start = len(MAGIC) + 4
+        description = json.loads(header[start:start + length].decode('utf-8'))
+
+        self.channels = description['channels']
+        self.sample_rate = description['sample_rate']
+        self.created = description.get('created')
+
+        self._dtype = record_dtype(len(self.channels))
+        self._records = None
+        self.refresh()
+
+    def refresh(self):
+        """Re-maps the archive to pick up samples written since it was opened"""
+        num_samples = (os.path.getsize(self.path) - HEADER_SIZE) \
+            // self._dtype.itemsize
+
+        if num_samples == 0:
+            self._records = np.empty(0, dtype=self._dtype)
+        else:
+            self._records = np.memmap(self.path, dtype=self._dtype, mode='r',
+                                      offset=HEADER_SIZE,
+                                      shape=(num_samples,))
+
+    def __len__(self):
+        """Number of samples in the archive"""
+        return len(self._records)
+
+    @property
+    def timestamps(self):
+        """Timestamps of all samples"""
+        return self._records['timestamp']
+
+    @property
+    def data(self):
+        """(channels x samples) view of all samples"""
+        return self._records['data'].T
+
+    def get_markers(self):
+        """
+        Returns the markers recorded with the archive
+
+        :return: list of {'timestamp': ..., 'label': ...} dicts
+        """
+        if not os.path.exists(self.path + '.markers'):
+            return []
+
+        with open(self.path + '.markers') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    #
+    # Methods for processing data
+    #
+
+    def get_data(self, channels, start_time=None, num_samples=None,
+                 end_time=None, duration=None):
+        """
+        Takes a copy of a slice of data from channels in a time window. Works
+        like DataStream.get_data.
+
+        :param channels: channel or list of channels to query
+        :param start_time: start time for data. If None, starts from the
+                           oldest data
+        :param num_samples: number of data samples to return per channel.
+                            If None, return all data in the window
+        :param end_time: end time (exclusive) for data. If None, returns all
+                         data after start_time
+        :param duration: length of window in seconds after start_time, as an
+                         alternative to end_time
+        :return: a list of data if there is only 1 channel given, else a dict
+                 with channel names as keys and data as values.
+        """
+        channel_list = channels if isinstance(channels, list) else [channels]
+        data, _ = self.get_array(channel_list, start_time=start_time,
+                                 num_samples=num_samples, end_time=end_time,
+                                 duration=duration)
+        return_data = dict(zip(channel_list, data.tolist()))
+
+        if not isinstance(channels, list):
+            return return_data[channels]
+
+        return return_data
+
+    def get_array(self, channels=None, start_time=None, num_samples=None,
+                  end_time=None, duration=None, copy=False):
+        """
+        Takes a slice of data from channels in a time window as a 2-D array.
+        Works like DataStream.get_array; views are read-only views of the file.
+
+        :param channels: list of channels to query, defaults to all
+        :param start_time: start time for data. If None, starts from the
+                           oldest data
+        :param num_samples: number of data samples to return per channel.
+                            If None, return all data in the window
+        :param end_time: end time (exclusive) for data. If None, returns all
+                         data after start_time
+        :param duration: length of window in seconds after start_time, as an
+                         alternative to end_time
+        :param copy: if True, return copies in memory instead of views
+        :return: (data, timestamps), where data is a (channels x samples)
+                 float32 array and timestamps has the matching timestamps
+        """
+        timestamps = self.timestamps
+        start, end = window_bounds(timestamps,
+                                   start_time=start_time,
+                                   end_time=end_time,
+                                   duration=duration,
+                                   num_samples=num_samples)
+
+        data = self.data[self._rows(channels), start:end]
+        timestamps = timestamps[start:end]
+
+        if copy:
+            data = np.array(data)
+            timestamps = np.array(timestamps)
+
+        return data, timestamps
+
+    def get_epochs(self, event_times, pre=0., post=None, num_samples=None,
+                   channels=None):
+        """
+        Cuts an epoch around each of a number of events. Works like
+        DataStream.get_epochs.
+
+        :param event_times: timestamps of the events
+        :param pre: seconds of data to include before each event
+        :param post: seconds of data to include after each event
+        :param num_samples: number of samples per epoch
+        :param channels: channels to include, defaults to all
+        :return: (events x channels x samples) float32 array
+        """
+        if num_samples is None:
+            if post is None or not self.sample_rate:
+                raise ValueError("Either post (with a known sample rate) or "
+                                 "num_samples must be given")
+            num_samples = int(round((pre + post) * self.sample_rate))
+
+        start_times = np.asarray(event_times, dtype=np.float64) - pre
+        rows = self._rows(channels)
+        if isinstance(rows, slice):
+            return extract_epochs(self.data[rows], self.timestamps,
+                                  start_times, num_samples)
+
+        # indexing the file by a list of rows would copy the whole recording
+        # into memory, so take the rows out of the epochs instead
+        epochs = extract_epochs(self.data, self.timestamps, start_times,
+                                num_samples)
+        return epochs[:, rows]
+
+    def _rows(self, channels):
+        """Returns an index for the rows of channels (a slice if possible)"""
+        if channels is None:
+            return slice(None)
+
+        for channel in channels:
+            if channel not in self.channels:
+                raise Exception(f"A channel with name {channel} does not exist")
+
+        rows = [self.channels.index(channel) for channel in channels]
+        if rows and rows == list(range(rows[0], rows[0] + len(rows))):
+            return slice(rows[0], rows[0] + len(rows))
+        return rows
+
+    def close(self):
+        """Unmaps the archive"""
+        self._records = np.empty(0, dtype=self._dtype)
@@ -0,0 +1,163 @@
+"""
+Keeps track of the offset between stream (device/LSL) time and wall (unix)
+time, so that timestamps sent by apps can be matched up with samples even if
+the two clocks drift apart over a long session.
+"""
+import collections
+import time
+
+import numpy as np
+
+
+class ClockSync:
+
+    def __init__(self, interval=1., window=120):
+        """
+        Initializes clock synchronisation
+
+        Every chunk that arrives gives us an upper bound on the offset (wall
+        time when it arrived minus stream time of its last sample), since it
+        could only have been delayed on the way. The smallest offset seen in
+        each interval is kept, and a line is fit through the last `window` of
+        them, dropping outliers, to model offset (and drift) over time.
+
+        :param interval: seconds between points used for the fit
+        :param window: number of points to fit
+        """
+        self.interval = interval
+
+        self._points = collections.deque(maxlen=window)
+        self._bucket = None         # best (stream time, offset) this interval
+        self._bucket_start = None
+
+        # fitted offset(s) = intercept + slope * (s - reference)
+        self._reference = None
+        self._intercept = None
+        self._slope = 0.
+
+        # if True, the offset is fixed and measurements are ignored
+        self.frozen = False
+
+    def update(self, stream_time, wall_time=None):
+        """
+        Adds a measurement. Call with the stream time of the last sample of
+        each chunk, as soon as it arrives.
+
+        :param stream_time: stream timestamp of the latest sample
+        :param wall_time: unix time the sample arrived, defaults to now
+        :return: None
+        """
+        if self.frozen:
+            return
+        if wall_time is None:
+            wall_time = time.time()
+        offset = wall_time - stream_time
+
+        if self._bucket is None or offset < self._bucket[1]:
+            self._bucket = (stream_time, offset)
+        if self._bucket_start is None:
+            self._bucket_start = wall_time
+            self._reference = stream_time
+
+        # until the first fit, use the best offset seen so far
+        if not self._points:
+            self._intercept = self._bucket[1]
+
+        if wall_time - self._bucket_start >= self.interval:
+            self._points.append(self._bucket)
+            self._bucket = None
+            self._bucket_start = wall_time
+            self._fit()
+
+    def freeze(self, stream_time, wall_time=None):
+        """
+        Fixes the offset at a single measurement, with no drift, and ignores
+        updates from then on. For streams whose time does not run at the
+        speed of the wall clock, eg. a session replayed faster than real time.
+
+        :param stream_time: a stream time
+        :param wall_time: unix time at stream_time, defaults to now
+        :return: None
+        """
+        if wall_time is None:
+            wall_time = time.time()
+
+        self._points.clear()
+        self._bucket = (stream_time, wall_time - stream_time)
+        self._bucket_start = wall_time
+        self._reference = stream_time
+        self._intercept = wall_time - stream_time
+        self._slope = 0.
+        self.frozen = True
+
+    def _fit(self):
+        """Fits offset against stream time, ignoring outliers"""
+        points = np.array(self._points)
+        x = points[:, 0] - self._reference
+        y = points[:, 1]
+
+        # not enough points for a slope yet, so use the best offset
+        if len(points) < 3:
+            self._slope, self._intercept = 0., y.min()
+            return
+
+        slope, intercept = np.polyfit(x, y, 1)
+
+        # refit without points far from the line (eg. delayed chunks)
+        residuals = y - (intercept + slope * x)
+        deviation = np.median(np.abs(residuals - np.median(residuals)))
+        inliers = np.abs(residuals) <= max(3 * deviation, 1e-3)
+        if 2 <= inliers.sum() < len(points):
+            slope, intercept = np.polyfit(x[inliers], y[inliers], 1)
+
+        self._slope, self._intercept = slope, intercept
+
+    def is_synced(self):
+        """Returns True once there has been at least one measurement"""
+        return self._intercept is not None
+
+    def offset(self, stream_time=None):
+        """
+        Returns wall time minus stream time
+
+        :param stream_time: stream time to get the offset at, defaults to the
+                            latest measurement
+        :return: offset in seconds, or 0 if there are no measurements yet
+        """
+        if not self.is_synced():
+            return 0.
+        if stream_time is None:
+            return self._intercept + self._slope * \
+                (self._latest_stream_time() - self._reference)
+        return self._intercept + self._slope * (stream_time - self._reference)
+
+    def _latest_stream_time(self):
+        """Returns the stream time of the latest point"""
+        if self._bucket is not None:
+            return self._bucket[0]
+        return self._points[-1][0]
+
+    def to_wall(self, stream_times):
+        """
+        Converts stream times to unix time
+
+        :param stream_times: a stream time, or array of them
+        :return: unix time(s)
+        """
+        stream_times = np.asarray(stream_times, dtype=np.float64)
+        return stream_times + self.offset(stream_times)
+
+    def to_stream(self, wall_times):
+        """
+        Converts unix times to stream time
+
+        :param wall_times: a unix time, or array of them
+        :return: stream time(s)
+        """
+        wall_times = np.asarray(wall_times, dtype=np.float64)
+        if not self.is_synced():
+            return wall_times
+
+        # solve wall = s + intercept + slope * (s - reference) for s
+        return (wall_times - self._intercept + self._slope * self._reference) \
+            / (1 + self._slope)
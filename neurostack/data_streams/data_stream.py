@@ -2,45 +2,121 @@
 LSL-like object to stream data to multiple channels. Some code and helper
 methods taken from https://github.com/kaczmarj/rteeg
 """
-import numpy as np  # unused?
+import asyncio
+import math
+import numpy as np
 import pylsl
 import threading
-import copy  # unused?
 
+from data_streams.archive import SessionRecorder
+from data_streams.clock import ClockSync
+from data_streams.decimator import Decimator
+from data_streams.filters import FilterChain
+from data_streams.ring_buffer import RingBuffer
+from data_streams.time_index import extract_epochs, window_bounds
 
-def look_for_eeg_stream():
-    """returns an inlet of the first eeg stream outlet found."""
+# used to size the data buffers when the sample rate is not known
+DEFAULT_SAMPLE_RATE = 256.
+
+# seconds of data kept per channel; older samples are overwritten
+DEFAULT_RETENTION = 300.
+
+# most samples taken from the inlet per pull in chunked mode, and how long to
+# wait for them (seconds)
+CHUNK_SAMPLES = 1024
+CHUNK_TIMEOUT = 0.05
+
+# seconds between updates of the LSL time correction
+TIME_CORRECTION_INTERVAL = 5.
+
+
+def _resolve_waiter(future):
+    """Wakes up a coroutine waiting for new data, unless it gave up already"""
+    if not future.done():
+        future.set_result(None)
+
+
+def look_for_eeg_stream(max_chunklen=1):
+    """
+    returns an inlet of the first eeg stream outlet found.
+
+    :param max_chunklen: preferred number of samples per chunk sent by the
+                         outlet. 0 uses the sender's chunk size.
+    """
     print("looking for an EEG stream...")
     streams = pylsl.resolve_byprop('type', 'EEG', timeout=30)
     if len(streams) == 0:
         raise (RuntimeError, "Can't find EEG stream")
     print("Start acquiring data")
-    eeg_inlet = pylsl.StreamInlet(streams[0], max_chunklen=1)
+    eeg_inlet = pylsl.StreamInlet(streams[0], max_chunklen=max_chunklen)
 
     return eeg_inlet
 
 
 class DataStream:
 
-    def __init__(self):
-        """Initializes data stream"""
-        self.channels = {}
+    def __init__(self, retention=DEFAULT_RETENTION, sample_rate=None):
+        """
+        Initializes data stream
+
+        :param retention: seconds of data to keep per channel. Memory for this
+                          is allocated when the first channel is added.
+        :param sample_rate: nominal sample rate, used to size the buffer. If
+                            None, it is read from the LSL stream on connect.
+        """
+        self.channels = {}  # channel names with their row in self._buffer
+        self.retention = retention
+        self.sample_rate = sample_rate
+
+        self._buffer = None
+        self._lock = threading.RLock()
+
+        # for waking up consumers when new samples arrive
+        self._new_data = threading.Condition(self._lock)
+        self._async_waiters = []
+
+        # for recording to disk
+        self._recorder = None
+
+        # min/max/mean aggregates for plotting, if enabled
+        self._decimator = None
+
+        # online filters, if enabled, with the rows that filtered copies of
+        # channels are kept in
+        self._filter = None
+        self._filtered_rows = {}
 
         self._eeg_thread = None
         self._eeg_thread_active = False
         self._eeg_inlet = None
         self._eeg_channel_names = None
+        self._chunked = False
+        self._time_correction = 0.
+        self._time_correction_updated = None
+
+        # offset between stream and unix time, updated as data arrives
+        self.clock = ClockSync()
 
     #
     # Connection methods
     #
 
-    def lsl_connect(self):
-        """Connects to LSL stream"""
+    def lsl_connect(self, chunked=False):
+        """
+        Connects to LSL stream
+
+        :param chunked: if True, pull data from the stream in chunks rather
+                        than one sample at a time. Use this for streams with
+                        many channels or high sample rates.
+        """
         # get stream
-        self._eeg_inlet = look_for_eeg_stream()
+        self._chunked = chunked
+        self._eeg_inlet = look_for_eeg_stream(max_chunklen=0 if chunked else 1)
         info = self._eeg_inlet.info()
 
+        if self.sample_rate is None and info.nominal_srate() > 0:
+            self.sample_rate = info.nominal_srate()
+
         # get channel names
         ch_names = []
         this_child = info.desc().child('channels').child('channel')
@@ -54,8 +130,11 @@ class DataStream:
         self._eeg_thread_active = True
 
         # record data to channels
-        self._eeg_thread = threading.Thread(target=self._record_lsl_data_indefinitely,
-                                            name='lsl')
+        if self._chunked:
+            target = self._record_lsl_chunks_indefinitely
+        else:
+            target = self._record_lsl_data_indefinitely
+        self._eeg_thread = threading.Thread(target=target, name='lsl')
         self._eeg_thread.daemon = True
         self._eeg_thread.start()
 
@@ -68,23 +147,67 @@ class DataStream:
         """
         Record LSL data indefinitely
 
-        :param channel_names: channel names to stream samples to
         :return: does not return
         """
-        # create channels
-        for channel_name in self._eeg_channel_names:
-            if channel_name not in self.list_channels():
-                self.add_channel(channel_name)
+        self._create_eeg_channels()
 
         # continuously pull data
         while self._eeg_thread_active:
             samples, timestamp = self._eeg_inlet.pull_sample()
-            time_correction = self._eeg_inlet.time_correction()
+            time_correction = self._get_time_correction()
 
             # add pulled samples to channels
-            for i in range(len(samples)):
-                self.add_data(self._eeg_channel_names[i],
-                              [timestamp + time_correction] + [samples[i]])
+            self.add_samples([timestamp + time_correction], [samples])
+
+    def _record_lsl_chunks_indefinitely(self):
+        """
+        Record LSL data indefinitely, a chunk at a time. Time correction is
+        applied once per chunk (and only asked for every few seconds), and each
+        chunk is added to the channels in a single write.
+
+        :return: does not return
+        """
+        self._create_eeg_channels()
+
+        # pull float32 streams straight into a preallocated buffer, so that no
+        # Python objects are created per sample
+        dest = None
+        if self._eeg_inlet.info().channel_format() == pylsl.cf_float32:
+            dest = np.empty((CHUNK_SAMPLES, len(self._eeg_channel_names)),
+                            dtype=np.float32)
+
+        # continuously pull data
+        while self._eeg_thread_active:
+            samples, timestamps = self._eeg_inlet.pull_chunk(
+                timeout=CHUNK_TIMEOUT, max_samples=CHUNK_SAMPLES, dest_obj=dest)
+            if len(timestamps) == 0:
+                continue
+            time_correction = self._get_time_correction()
+
+            if dest is not None:
+                samples = dest[:len(timestamps)]
+
+            # add pulled chunk to channels
+            self.add_samples(np.asarray(timestamps) + time_correction, samples)
+
+    def _get_time_correction(self):
+        """
+        Returns the LSL time correction for the inlet, asking LSL for a new
+        one every TIME_CORRECTION_INTERVAL seconds
+        """
+        now = pylsl.local_clock()
+        if self._time_correction_updated is None or \
+                now - self._time_correction_updated > TIME_CORRECTION_INTERVAL:
+            self._time_correction = self._eeg_inlet.time_correction()
+            self._time_correction_updated = now
+
+        return self._time_correction
+
+    def _create_eeg_channels(self):
+        """Creates a channel for every EEG channel that does not have one"""
+        for channel_name in self._eeg_channel_names:
+            if channel_name not in self.list_channels():
+                self.add_channel(channel_name)
 
     def add_channel(self, name):
         """
@@ -96,7 +219,12 @@ class DataStream:
         if self.channels.get(name) is not None:
             print("Channel with name {0} already exists".format(name))
         else:
-            self.channels[name] = []
+            with self._lock:
+                if self._buffer is None:
+                    sample_rate = self.sample_rate or DEFAULT_SAMPLE_RATE
+                    capacity = math.ceil(self.retention * sample_rate)
+                    self._buffer = RingBuffer(capacity)
+                self.channels[name] = self._buffer.add_channel()
 
     def remove_channel(self, name):
         """
@@ -108,81 +236,241 @@ class DataStream:
         if self.channels.get(name) is None:
             print("Channel with name {0} does not exist".format(name))
         else:
-            self.channels.pop(name)
+            with self._lock:
+                if self._decimator is not None and \
+                        name in self._decimator.channels:
+                    self._decimator = None
+                if name in self._filtered_rows:
+                    self.remove_filters()
+                self._remove_row(self.channels.pop(name))
+
+    def _remove_row(self, row):
+        """Removes a row from the buffer, moving the rows after it up by one"""
+        with self._lock:
+            self._buffer.remove_channel(row)
+            for rows in (self.channels, self._filtered_rows):
+                for channel, channel_row in rows.items():
+                    if channel_row > row:
+                        rows[channel] = channel_row - 1
 
     def close(self):
         """Close all connections"""
-        self.channels = {}
+        self.stop_recording()
+
+        with self._lock:
+            self.channels = {}
+            self._buffer = None
+            self._decimator = None
+            self._filter = None
+            self._filtered_rows = {}
 
     #
     # Methods for processing data
     #
 
-    def get_data(self, channels, start_time=None, num_samples=None):
+    def get_data(self, channels, start_time=None, num_samples=None,
+                 end_time=None, duration=None):
         """
-        Takes a (copy of a) slice of data from channels at start_time for a
-        number of samples.
+        Takes a (copy of a) slice of data from channels in a time window. The
+        window is found once, with a binary search on the shared timestamps,
+        and then used for every channel.
 
         :param channels: channel or list of channels to query
-        :param start_time: start time for data. If None, returns all data
+        :param start_time: start time for data. If None, starts from the
+                           oldest data
         :param num_samples: number of data samples to return per channel.
-                            If None, return all data after start_time
+                            If None, return all data in the window
+        :param end_time: end time (exclusive) for data. If None, returns all
+                         data after start_time
+        :param duration: length of window in seconds after start_time, as an
+                         alternative to end_time
         :return: a list of data if there is only 1 channel given, else a dict
                  with channel names as keys and data as values.
         """
-        # get data for 1 channel--just return a list
-        # TODO: do with binary search
-        if not isinstance(channels, list):
-            channel = channels
+        channel_list = channels if isinstance(channels, list) else [channels]
 
-            # check to see that channel exists
+        # check to see that channels exist
+        for channel in channel_list:
             if self.channels.get(channel) is None:
                 raise Exception(f"A channel with name {channel} does not exist")
 
-            # return all the data for channel if start time is not specified
-            if start_time is None:
-                return [sample[1] for sample in self.channels[channel]]
+        with self._lock:
+            start, end = window_bounds(self._buffer.timestamps,
+                                       start_time=start_time,
+                                       end_time=end_time,
+                                       duration=duration,
+                                       num_samples=num_samples)
+            data = self._buffer.data
 
-            # find start index
-            start = 0
-            while start_time > self.channels[channel][start][0]:
-                start += 1
-                if start == len(self.channels[channel]):
-                    return []
+            return_data = {}
+            for channel in channel_list:
+                return_data[channel] = \
+                    data[self.channels[channel], start:end].tolist()
 
-            # return all the data starting from start time if number of samples
-            # is not specified
-            if num_samples is None:
-                return [sample[1] for sample in self.channels[channel][start:]]
-
-            # find end index
-            end = min(len(self.channels[channel]), start + num_samples)
-
-            # return time slice from start time for number of samples if both
-            # are specified
-            return [sample[1] for sample in self.channels[channel][start:end]]
+        # get data for 1 channel--just return a list
+        if not isinstance(channels, list):
+            return return_data[channels]
 
         # get data for multiple channels--return a dict
-        return_data = {}
-
-        for channel in channels:
-            return_data[channel] = self.get_data(channel, start_time,
-                                                 num_samples)
-
         return return_data
 
-    def get_eeg_data(self, start_time=None, num_samples=None):
+    def get_eeg_data(self, start_time=None, num_samples=None, end_time=None,
+                     duration=None):
         """
         Get data from EEG channels.
 
-        :param start_time: start time for data. If None, returns all data
+        :param start_time: start time for data. If None, starts from the
+                           oldest data
         :param num_samples: number of data samples to return per channel.
-                            If None, return all data after start_time
+                            If None, return all data in the window
+        :param end_time: end time (exclusive) for data. If None, returns all
+                         data after start_time
+        :param duration: length of window in seconds after start_time, as an
+                         alternative to end_time
         :return: a dict with channel names as keys and data as values
         """
         return self.get_data(channels=self._eeg_channel_names,
                              start_time=start_time,
-                             num_samples=num_samples)
+                             num_samples=num_samples,
+                             end_time=end_time,
+                             duration=duration)
+
+    def get_array(self, channels, start_time=None, num_samples=None,
+                  end_time=None, duration=None, copy=False, filtered=False):
+        """
+        Takes a slice of data from channels in a time window as a 2-D array.
+        Unlike get_data, no Python objects are created per sample: if the
+        channels are stored next to each other (eg. all EEG channels, in
+        order), the data is a view of the stream's buffer.
+
+        Views are only valid until the buffer wraps around and overwrites the
+        samples in them, so pass copy=True to keep the data for longer.
+
+        :param channels: list of channels to query
+        :param start_time: start time for data. If None, starts from the
+                           oldest data
+        :param num_samples: number of data samples to return per channel.
+                            If None, return all data in the window
+        :param end_time: end time (exclusive) for data. If None, returns all
+                         data after start_time
+        :param duration: length of window in seconds after start_time, as an
+                         alternative to end_time
+        :param copy: if True, always return copies instead of views
+        :param filtered: if True, return the output of the online filters
+                         (see set_filters) instead of the raw data
+        :return: (data, timestamps), where data is a (channels x samples)
+                 float32 array and timestamps has the matching timestamps
+        """
+        with self._lock:
+            self._check_channels(channels, filtered)
+            start, end = window_bounds(self._buffer.timestamps,
+                                       start_time=start_time,
+                                       end_time=end_time,
+                                       duration=duration,
+                                       num_samples=num_samples)
+            return self._slice(channels, start, end, copy, filtered)
+
+    def _check_channels(self, channels, filtered=False):
+        """Raises an exception if a channel (or its filtered copy) is missing"""
+        rows = self._filtered_rows if filtered else self.channels
+        for channel in channels:
+            if rows.get(channel) is None:
+                if filtered and self.channels.get(channel) is not None:
+                    raise Exception(f"Channel {channel} is not filtered")
+                raise Exception(f"A channel with name {channel} does not exist")
+
+    def _slice(self, channels, start, end, copy=False, filtered=False):
+        """
+        Takes samples start:end of channels from the buffer
+
+        :param channels: list of channels to take data from
+        :param start: index of first sample
+        :param end: index one past the last sample
+        :param copy: if True, always return copies instead of views
+        :param filtered: if True, take the filtered copies of channels
+        :return: (data, timestamps)
+        """
+        with self._lock:
+            rows = self._filtered_rows if filtered else self.channels
+            rows = [rows[channel] for channel in channels]
+            if rows and rows == list(range(rows[0], rows[0] + len(rows))):
+                data = self._buffer.data[rows[0]:rows[0] + len(rows),
+                                         start:end]
+            else:
+                # channels are not contiguous, so this is already a copy
+                data = self._buffer.data[rows, start:end]
+            timestamps = self._buffer.timestamps[start:end]
+
+            if copy:
+                data = data.copy()
+                timestamps = timestamps.copy()
+
+        return data, timestamps
+
+    def get_eeg_array(self, start_time=None, num_samples=None, end_time=None,
+                      duration=None, channels=None, copy=False,
+                      filtered=False):
+        """
+        Get data from EEG channels as a 2-D array. See get_array.
+
+        :param start_time: start time for data. If None, starts from the
+                           oldest data
+        :param num_samples: number of data samples to return per channel.
+                            If None, return all data in the window
+        :param end_time: end time (exclusive) for data. If None, returns all
+                         data after start_time
+        :param duration: length of window in seconds after start_time, as an
+                         alternative to end_time
+        :param channels: subset of EEG channels to return, defaults to all
+        :param copy: if True, always return copies instead of views
+        :param filtered: if True, return filtered data (see set_filters)
+        :return: (data, timestamps), where data is a (channels x samples)
+                 float32 array and timestamps has the matching timestamps
+        """
+        if channels is None:
+            channels = self._eeg_channel_names
+
+        return self.get_array(channels=channels,
+                              start_time=start_time,
+                              num_samples=num_samples,
+                              end_time=end_time,
+                              duration=duration,
+                              copy=copy,
+                              filtered=filtered)
+
+    def get_epochs(self, event_times, pre=0., post=None, num_samples=None,
+                   channels=None, filtered=False):
+        """
+        Cuts an epoch around each of a number of events, eg. all the stimuli
+        of a P300 block, in one call. The bounds of every epoch are found in a
+        single vectorized search.
+
+        :param event_times: timestamps of the events
+        :param pre: seconds of data to include before each event. Use a
+                    negative value to start the epoch after the event
+        :param post: seconds of data to include after each event. Used with
+                     the sample rate to work out num_samples if it is not given
+        :param num_samples: number of samples per epoch
+        :param channels: channels to include, defaults to the EEG channels
+        :param filtered: if True, cut epochs from filtered data (see
+                         set_filters)
+        :return: (events x channels x samples) float32 array. Samples that
+                 have not been recorded yet are NaN, and so are epochs that
+                 start before the oldest sample in the buffer.
+        """
+        if channels is None:
+            channels = self._eeg_channel_names
+        if num_samples is None:
+            if post is None:
+                raise ValueError("Either post or num_samples must be given")
+            sample_rate = self.sample_rate or DEFAULT_SAMPLE_RATE
+            num_samples = int(round((pre + post) * sample_rate))
+
+        start_times = np.asarray(event_times, dtype=np.float64) - pre
+
+        with self._lock:
+            data, timestamps = self.get_array(channels, filtered=filtered)
+            return extract_epochs(data, timestamps, start_times, num_samples)
 
     def get_latest_data(self, channels):
         """
@@ -194,14 +482,20 @@ class DataStream:
         with channel names as keys and data as values.
         """
         if not isinstance(channels, list):
-            return self.channels[channels][-1]
+            with self._lock:
+                index = self._latest_index(channels)
+                if index is None:
+                    raise IndexError(f"Channel {channels} has no data")
+                row = self.channels[channels]
+                return [float(self._buffer.timestamps[index]),
+                        float(self._buffer.data[row, index])]
 
         return_data = {}
 
         for channel in channels:
             if self.channels.get(channel) is not None:
                 # If the channel has no data (is empty)
-                if not self.channels[channel]:
+                if not self.has_data(channel):
                     return_data[channel] = []
                 else:
                     return_data[channel] = self.get_latest_data(channel)
@@ -213,32 +507,83 @@ class DataStream:
 
     def add_data(self, channel, data):
         """
-        TODO: decide on / find out about the specific requirements of the data
-        Add data to channel
+        Add a single [timestamp, value] data entry to channel. Entries for
+        different channels with the same timestamp are stored as one sample;
+        use add_samples to add a whole sample (or block of samples) at once.
 
-        :param channel:
-        :param data:
-        :return:
+        :param channel: name of channel to add data to
+        :param data: [timestamp, value]
+        :return: None
         """
         if self.channels.get(channel) is not None:
-            self.channels[channel].append(data)
+            with self._lock:
+                self._buffer.set_value(self.channels[channel], data[0], data[1])
+                self._notify_new_data()
         else:
             print(f"A channel with name {channel} does not exist")
 
+    def add_samples(self, timestamps, samples, channels=None):
+        """
+        Add a block of samples to channels in one write
+
+        :param timestamps: timestamps of the n samples
+        :param samples: (n x channels) block of samples
+        :param channels: channel names for the columns of samples, defaults to
+                         the EEG channels
+        :return: None
+        """
+        if channels is None:
+            channels = self._eeg_channel_names
+
+        with self._lock:
+            rows = [self.channels[channel] for channel in channels]
+            block = samples
+
+            # filter the block, and store it next to the raw samples
+            if self._filter is not None and \
+                    list(channels) == list(self._filtered_rows):
+                block = np.asarray(samples, dtype=np.float32).reshape(
+                    len(timestamps), len(channels))
+                block = np.concatenate([block, self._filter.process(block)],
+                                       axis=1)
+                rows += list(self._filtered_rows.values())
+
+            if rows == list(range(self._buffer.num_channels)):
+                rows = None
+            self._buffer.append(timestamps, block, rows=rows)
+            self._notify_new_data()
+
+            if len(timestamps) > 0:
+                self.clock.update(timestamps[-1])
+
+            if self._decimator is not None and \
+                    list(channels) == self._decimator.channels:
+                self._decimator.add(timestamps, samples)
+
+            if self._recorder is not None and \
+                    list(channels) == self._recorder.channels:
+                try:
+                    self._recorder.write(timestamps, samples)
+                except IOError as e:
+                    print(f"Stopped recording: {e}")
+                    self._recorder.abort()
+                    self._recorder = None
+
     def remove_data(self, channel, data):
         """
-        TODO: decide on / find out about the specific requirements of the data
-        Remove a specific piece of data from a channel
+        Remove a specific [timestamp, value] data entry from a channel. The
+        sample keeps its timestamp, but has no value (NaN) for the channel.
 
-        :param channel:
-        :param data:
-        :return:
+        :param channel: name of channel to remove data from
+        :param data: [timestamp, value]
+        :return: None
         """
         if self.channels.get(channel) is not None:
-            try:
-                self.channels[channel].remove(data)
-            except ValueError:
-                raise (ValueError, f"{data} data does not exist in the channel named {channel}")
+            with self._lock:
+                if not self._buffer.clear_value(self.channels[channel],
+                                                data[0], data[1]):
+                    raise ValueError(f"{data} data does not exist in the "
+                                     f"channel named {channel}")
         else:
             print(f"A channel with name {channel} does not exist")
 
@@ -249,7 +594,348 @@ class DataStream:
         :param channel: channel
         :return: True if the channel has data, False otherwise
         """
-        return not len(self.channels.get(channel, [])) == 0
+        with self._lock:
+            return channel in self.channels and \
+                self._latest_index(channel) is not None
+
+    def _latest_index(self, channel):
+        """
+        Finds the latest sample with a value for channel. Samples added for
+        other channels with add_data have no value (NaN) for it.
+
+        :param channel: channel
+        :return: index of the sample in the buffer, or None if there is none
+        """
+        with self._lock:
+            values = self._buffer.data[self.channels[channel]]
+            if len(values) > 0 and not np.isnan(values[-1]):
+                return len(values) - 1
+
+            recorded = np.flatnonzero(~np.isnan(values))
+            if len(recorded) == 0:
+                return None
+            return int(recorded[-1])
+
+    #
+    # Methods for recording to disk
+    #
+
+    def start_recording(self, path, channels=None):
+        """
+        Starts recording every block of samples added to channels into an
+        archive at path (see data_streams.archive). Writing happens on a
+        background thread.
+
+        :param path: file to record to. It is overwritten if it exists
+        :param channels: channels to record, defaults to the EEG channels
+        :return: None
+        """
+        if channels is None:
+            channels = self._eeg_channel_names
+
+        with self._lock:
+            self.stop_recording()
+            self._recorder = SessionRecorder(path, channels=channels,
+                                             sample_rate=self.sample_rate)
+
+    def stop_recording(self):
+        """Stops recording and closes the archive, if recording"""
+        with self._lock:
+            recorder, self._recorder = self._recorder, None
+
+        if recorder is not None:
+            recorder.close()
+
+    def add_marker(self, timestamp, label):
+        """
+        Records a marker (eg. a stimulus) with the archive, if recording
+
+        :param timestamp: timestamp of marker
+        :param label: JSON-serializable label
+        :return: None
+        """
+        with self._lock:
+            if self._recorder is not None:
+                try:
+                    self._recorder.add_marker(timestamp, label)
+                except IOError as e:
+                    print(f"Stopped recording: {e}")
+                    self._recorder.abort()
+                    self._recorder = None
+
+    #
+    # Methods for filtering
+    #
+
+    def set_filters(self, notch=None, highpass=None, bandpass=None,
+                    channels=None):
+        """
+        Starts filtering channels as blocks of samples are added (see
+        data_streams.filters), replacing any filters already set. The filtered
+        data is kept alongside the raw data, and can be read by passing
+        filtered=True to the methods that get data. Only blocks added for
+        exactly these channels (eg. from LSL) are filtered; samples added
+        before this is called have no filtered values (NaN).
+
+        :param notch: frequency to remove in Hz, eg. 60 for line noise
+        :param highpass: cutoff frequency in Hz for a high-pass filter
+        :param bandpass: (low, high) cutoff frequencies in Hz for a band-pass
+                         filter
+        :param channels: channels to filter, defaults to the EEG channels
+        :return: None
+        """
+        if channels is None:
+            self._create_eeg_channels()
+            channels = self._eeg_channel_names
+
+        chain = FilterChain(len(channels),
+                            self.sample_rate or DEFAULT_SAMPLE_RATE)
+        if notch is not None:
+            chain.add_notch(notch)
+        if highpass is not None:
+            chain.add_highpass(highpass)
+        if bandpass is not None:
+            chain.add_bandpass(*bandpass)
+
+        with self._lock:
+            self._check_channels(channels)
+            self.remove_filters()
+
+            for channel in channels:
+                self._filtered_rows[channel] = self._buffer.add_channel()
+            self._filter = chain
+
+    def remove_filters(self):
+        """Stops filtering and frees the filtered data"""
+        with self._lock:
+            self._filter = None
+            for row in sorted(self._filtered_rows.values(), reverse=True):
+                self._remove_row(row)
+            self._filtered_rows = {}
+
+    def get_filters(self):
+        """
+        Returns the stages of the online filters, eg. [('notch', 60)], or None
+        if filtering is off
+        """
+        return None if self._filter is None else list(self._filter.stages)
+
+    #
+    # Methods for plotting
+    #
+
+    def enable_decimation(self, channels=None, ratio=4):
+        """
+        Starts keeping min/max/mean aggregates of channels at several zoom
+        levels (see data_streams.decimator), filled in from the data already
+        in the stream and updated as blocks of samples are added. Only blocks
+        added for exactly these channels (eg. from LSL) are aggregated.
+
+        :param channels: channels to aggregate, defaults to the EEG channels
+        :param ratio: ratio between the bin sizes of neighbouring levels
+        :return: None
+        :raises ValueError: if there are no channels to aggregate yet
+        """
+        if channels is None:
+            channels = self._eeg_channel_names
+
+        with self._lock:
+            if self._buffer is None or len(channels) == 0:
+                raise ValueError("Cannot enable decimation without channels")
+            for channel in channels:
+                if self.channels.get(channel) is None:
+                    raise Exception(f"A channel with name {channel} does not "
+                                    f"exist")
+
+            decimator = Decimator(channels, self._buffer.capacity, ratio=ratio)
+            data, timestamps = self.get_array(channels)
+            decimator.add(timestamps, data.T)
+            self._decimator = decimator
+
+    def disable_decimation(self):
+        """Stops keeping aggregates for plotting"""
+        with self._lock:
+            self._decimator = None
+
+    def decimation_enabled(self):
+        """Returns True if aggregates for plotting are being kept"""
+        return self._decimator is not None
+
+    def get_decimated(self, channels=None, width=1000, start_time=None,
+                      end_time=None, duration=None):
+        """
+        Gets a time window at about the resolution it will be plotted at: at
+        most width bins (unless the window is too long for the coarsest
+        level), each with the min, max and mean of the samples in it. Windows
+        with no more than width samples are returned as raw samples. Needs
+        enable_decimation to have been called.
+
+        :param channels: list of channels to get, defaults to the aggregated
+                         channels
+        :param width: most bins wanted, eg. the width of the plot in pixels
+        :param start_time: start time of window. If None, it is duration
+                           before end_time, or the oldest data
+        :param end_time: end time (exclusive) of window. If None, goes up to
+                         the latest data
+        :param duration: length of window in seconds
+        :return: dict with 'timestamps' (time of the first sample of each
+                 bin), 'min', 'max' and 'mean' ((channels x bins) float32
+                 arrays) and 'bin_size' (samples per bin)
+        """
+        with self._lock:
+            if self._decimator is None:
+                raise ValueError("Decimation is not enabled")
+            if channels is None:
+                channels = self._decimator.channels
+
+            timestamps = self._buffer.timestamps
+            if duration is not None:
+                if start_time is None and end_time is None:
+                    end_time = timestamps[-1] if len(timestamps) else 0.
+                    end_time = np.nextafter(end_time, np.inf)
+                if start_time is None:
+                    start_time = end_time - duration
+                else:
+                    end_time = start_time + duration
+
+            start, end = window_bounds(timestamps, start_time=start_time,
+                                       end_time=end_time)
+            level = self._decimator.choose_level(end - start, width)
+
+            if level is None:
+                data, timestamps = self._slice(channels, start, end, copy=True)
+                return {'timestamps': timestamps, 'min': data, 'max': data,
+                        'mean': data, 'bin_size': 1}
+
+            timestamps, mins, maxs, means = self._decimator.get(
+                level, channels, start_time=start_time, end_time=end_time)
+            return {'timestamps': timestamps, 'min': mins, 'max': maxs,
+                    'mean': means,
+                    'bin_size': self._decimator.factors[level]}
+
+    #
+    # Methods for subscribing to new data
+    #
+
+    def get_cursor(self):
+        """
+        Returns the number of samples added to the stream so far. Pass it to
+        the methods below to wait for, and get, samples added after it.
+        """
+        with self._lock:
+            return 0 if self._buffer is None else self._buffer.count
+
+    def get_data_since(self, cursor, channels=None, copy=False,
+                       filtered=False):
+        """
+        Gets all the samples added after cursor. If some of them have already
+        been overwritten, returns the ones that are left.
+
+        :param cursor: cursor returned by an earlier call, or by get_cursor
+        :param channels: channels to get data from, defaults to EEG channels,
+                         or to all channels if the EEG channels are not known
+        :param copy: if True, always return copies instead of views
+        :param filtered: if True, get filtered data (see set_filters)
+        :return: (data, timestamps, cursor), where data is a (channels x
+                 samples) float32 array, and cursor should be passed to the
+                 next call
+        """
+        with self._lock:
+            if channels is None:
+                channels = self._eeg_channel_names
+                if channels is None:
+                    channels = self.list_channels()
+
+            if self._buffer is None:
+                data = np.empty((len(channels), 0), dtype=np.float32)
+                return data, np.empty(0), cursor
+
+            new_cursor = self._buffer.count
+            end = len(self._buffer)
+            start = max(0, end - (new_cursor - cursor))
+
+            self._check_channels(channels, filtered)
+            data, timestamps = self._slice(channels, start, end, copy,
+                                           filtered)
+            return data, timestamps, new_cursor
+
+    def wait_for_data(self, cursor, timeout=None):
+        """
+        Blocks the calling thread until samples are added after cursor
+
+        :param cursor: cursor to wait on
+        :param timeout: maximum number of seconds to wait, or None to wait
+                        indefinitely
+        :return: the current cursor
+        """
+        with self._new_data:
+            self._new_data.wait_for(lambda: self.get_cursor() > cursor,
+                                    timeout=timeout)
+            return self.get_cursor()
+
+    async def wait_for_data_async(self, cursor, timeout=None):
+        """
+        Waits, without blocking the event loop, until samples are added after
+        cursor
+
+        :param cursor: cursor to wait on
+        :param timeout: maximum number of seconds to wait, or None to wait
+                        indefinitely
+        :return: the current cursor
+        """
+        loop = asyncio.get_event_loop()
+
+        with self._lock:
+            if self.get_cursor() > cursor:
+                return self.get_cursor()
+            waiter = (loop, loop.create_future())
+            self._async_waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if waiter in self._async_waiters:
+                    self._async_waiters.remove(waiter)
+
+        return self.get_cursor()
+
+    async def wait_until_async(self, stream_time, timeout=None):
+        """
+        Waits, without blocking the event loop, until there is data up to
+        stream_time (eg. so that a window of data is complete)
+
+        :param stream_time: stream timestamp to wait for
+        :param timeout: maximum number of seconds to wait, or None to wait
+                        indefinitely
+        :return: True if there is data up to stream_time, False on timeout
+        """
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        cursor = self.get_cursor()
+        while self.get_latest_timestamp() < stream_time:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            cursor = await self.wait_for_data_async(cursor, remaining)
+
+        return True
+
+    def get_latest_timestamp(self):
+        """Returns the timestamp of the latest sample, or -inf if none"""
+        with self._lock:
+            if self._buffer is None or len(self._buffer) == 0:
+                return -np.inf
+            return float(self._buffer.timestamps[-1])
+
+    def _notify_new_data(self):
+        """Wakes up everything waiting for new data. Call with lock held."""
+        self._new_data.notify_all()
+
+        for loop, future in self._async_waiters:
+            loop.call_soon_threadsafe(_resolve_waiter, future)
+        self._async_waiters = []
 
     #
     # Stream information
@@ -262,3 +948,14 @@ class DataStream:
     def get_eeg_channels(self):
         """Returns a list of the EEG channel names"""
         return self._eeg_channel_names
+
+    def set_eeg_channels(self, channel_names):
+        """
+        Sets the EEG channel names for data that is added directly (instead of
+        from an LSL stream), and creates channels for them
+
+        :param channel_names: list of EEG channel names
+        :return: None
+        """
+        self._eeg_channel_names = list(channel_names)
+        self._create_eeg_channels()
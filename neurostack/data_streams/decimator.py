@@ -0,0 +1,159 @@
+"""
+Min/max/mean aggregates of a stream at several zoom levels, for plotting. Each
+level splits the stream into bins of a fixed number of samples (ratio times
+more than the level below it) and keeps the minimum, maximum and mean of every
+bin. Levels are updated incrementally as samples arrive, so a plot of any
+window can be answered from the level whose bins best match its width,
+without touching the raw samples.
+"""
+import numpy as np
+
+from data_streams.ring_buffer import RingBuffer
+from data_streams.time_index import window_bounds
+
+
+class Decimator:
+
+    def __init__(self, channels, capacity, ratio=4, min_bins=64):
+        """
+        Initializes empty aggregates
+
+        :param channels: names of the channels that will be added
+        :param capacity: number of raw samples to cover, like the capacity of
+                         the stream's ring buffer
+        :param ratio: samples per bin at the first level, and bins per bin at
+                      each level after it
+        :param min_bins: levels with fewer bins than this are not kept
+        """
+        if ratio < 2:
+            raise ValueError("Decimation ratio must be at least 2")
+
+        self.channels = list(channels)
+        self.ratio = ratio
+
+        # samples per bin, with a ring buffer for each level holding the min,
+        # max and mean rows of each channel, and the timestamp of each bin's
+        # first sample
+        self.factors = []
+        self._levels = []
+        factor = ratio
+        while capacity // factor >= min_bins:
+            self.factors.append(factor)
+            self._levels.append(RingBuffer(capacity // factor,
+                                           num_channels=3 * len(self.channels)))
+            factor *= ratio
+
+        # bins (or raw samples) that have not made up a whole bin of the next
+        # level yet, as (timestamps, mins, maxs, means)
+        self._pending = [None] * len(self._levels)
+
+    @property
+    def nbytes(self):
+        """Memory used by the aggregates, in bytes"""
+        return sum(level.nbytes for level in self._levels)
+
+    def add(self, timestamps, samples):
+        """
+        Adds a block of samples, updating every level
+
+        :param timestamps: timestamps of the n samples
+        :param samples: (n x channels) block of samples
+        :return: None
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        data = np.asarray(samples, dtype=np.float32).reshape(
+            len(timestamps), len(self.channels)).T
+        bins = (timestamps, data, data, data)
+
+        for i, level in enumerate(self._levels):
+            bins = self._reduce(i, bins)
+            if bins is None:
+                break
+
+            level.append(bins[0], np.concatenate(bins[1:]).T)
+
+    def _reduce(self, i, bins):
+        """
+        Combines every ratio bins from the level below level i (with any left
+        over from before) into bins of level i
+
+        :param i: index of level
+        :param bins: new (timestamps, mins, maxs, means) from the level below
+        :return: (timestamps, mins, maxs, means) of the new bins of level i,
+                 or None if there are not enough for a whole bin
+        """
+        if self._pending[i] is not None:
+            bins = tuple(np.concatenate([pending, new], axis=-1)
+                         for pending, new in zip(self._pending[i], bins))
+
+        n = len(bins[0]) // self.ratio * self.ratio
+        self._pending[i] = tuple(x[..., n:].copy() for x in bins)
+        if n == 0:
+            return None
+
+        timestamps, mins, maxs, means = \
+            (x[..., :n].reshape(x.shape[:-1] + (-1, self.ratio)) for x in bins)
+
+        # empty (NaN) values are ignored, and a bin with no values is empty
+        valid = ~np.isnan(means)
+        with np.errstate(invalid='ignore'):
+            mean = np.where(valid, means, 0).sum(axis=-1) / valid.sum(axis=-1)
+
+        return (timestamps[:, 0],
+                np.fmin.reduce(mins, axis=-1),
+                np.fmax.reduce(maxs, axis=-1),
+                mean.astype(np.float32))
+
+    def choose_level(self, num_samples, width):
+        """
+        Picks the finest level that has at most width bins for num_samples raw
+        samples (or the coarsest level, if none is coarse enough)
+
+        :param num_samples: number of raw samples in the window
+        :param width: most bins wanted, eg. the width of a plot in pixels
+        :return: index of the level, or None if the raw samples fit in width
+        """
+        if num_samples <= width or not self._levels:
+            return None
+
+        for i, factor in enumerate(self.factors):
+            if num_samples / factor <= width:
+                return i
+
+        return len(self._levels) - 1
+
+    def get(self, level, channels=None, start_time=None, end_time=None):
+        """
+        Gets the bins of a level in a time window
+
+        :param level: index of level, see choose_level
+        :param channels: list of channels to get, defaults to all
+        :param start_time: start time of window. If None, starts from the
+                           oldest bin
+        :param end_time: end time (exclusive) of window. If None, goes up to
+                         the latest bin
+        :return: (timestamps, mins, maxs, means), where timestamps are the
+                 times of the first sample in each bin and the others are
+                 (channels x bins) float32 arrays. These are copies.
+        """
+        buffer = self._levels[level]
+        start, end = window_bounds(buffer.timestamps, start_time=start_time,
+                                   end_time=end_time)
+
+        if channels is None:
+            rows = np.arange(len(self.channels))
+        else:
+            for channel in channels:
+                if channel not in self.channels:
+                    raise Exception(f"A channel with name {channel} is not "
+                                    f"decimated")
+            rows = np.array([self.channels.index(channel)
+                             for channel in channels], dtype=int)
+
+        data = buffer.data[:, start:end]
+        num_channels = len(self.channels)
+
+        return (np.array(buffer.timestamps[start:end]),
+                data[rows],
+                data[rows + num_channels],
+                data[rows + 2 * num_channels])
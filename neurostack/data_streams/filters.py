@@ -0,0 +1,108 @@
+"""
+Causal filters that run on a stream as it arrives. A FilterChain is a cascade
+of second-order sections (notch, high-pass and band-pass stages) that filters
+each block of samples for all channels in one call, and carries its state over
+to the next block, so that filtering block by block gives the same result as
+filtering the whole recording at once.
+"""
+import numpy as np
+from scipy import signal
+
+
+class FilterChain:
+
+    def __init__(self, num_channels, sample_rate):
+        """
+        Initializes an empty chain, which passes samples through unchanged
+
+        :param num_channels: number of channels to filter
+        :param sample_rate: sample rate of the stream in Hz
+        """
+        self.num_channels = num_channels
+        self.sample_rate = float(sample_rate)
+
+        # descriptions of the stages, eg. ('notch', 60.)
+        self.stages = []
+
+        self._sos = np.empty((0, 6))
+        self._zi = None
+
+    def add_notch(self, freq, quality=30.):
+        """
+        Adds a notch filter, eg. for line noise
+
+        :param freq: frequency to remove in Hz
+        :param quality: quality factor; higher is narrower
+        :return: the chain, so that calls can be chained
+        """
+        b, a = signal.iirnotch(freq, quality, fs=self.sample_rate)
+        return self._add_stage(('notch', freq), signal.tf2sos(b, a))
+
+    def add_highpass(self, cutoff, order=4):
+        """
+        Adds a Butterworth high-pass filter, eg. to remove drift
+
+        :param cutoff: cutoff frequency in Hz
+        :param order: order of filter
+        :return: the chain
+        """
+        sos = signal.butter(order, cutoff, btype='highpass',
+                            fs=self.sample_rate, output='sos')
+        return self._add_stage(('highpass', cutoff), sos)
+
+    def add_bandpass(self, low, high, order=4):
+        """
+        Adds a Butterworth band-pass filter
+
+        :param low: low cutoff frequency in Hz
+        :param high: high cutoff frequency in Hz
+        :param order: order of filter
+        :return: the chain
+        """
+        sos = signal.butter(order, [low, high], btype='bandpass',
+                            fs=self.sample_rate, output='sos')
+        return self._add_stage(('bandpass', low, high), sos)
+
+    def _add_stage(self, description, sos):
+        """Appends sections to the chain and resets its state"""
+        self.stages.append(description)
+        self._sos = np.concatenate([self._sos, sos])
+        self.reset()
+        return self
+
+    def reset(self):
+        """Forgets the filter state; the next block starts the filter again"""
+        self._zi = None
+
+    def process(self, samples):
+        """
+        Filters the next block of samples. The first block after a reset
+        starts the filter in steady state for its first sample, to avoid a
+        large step response.
+
+        Empty (NaN) values are filtered as zeros, so that they do not spread
+        through the filter state, and are NaN in the result.
+
+        :param samples: (n x channels) block of samples
+        :return: (n x channels) float32 block of filtered samples
+        """
+        samples = np.asarray(samples, dtype=np.float64).reshape(
+            -1, self.num_channels)
+        if len(samples) == 0 or len(self._sos) == 0:
+            return samples.astype(np.float32)
+
+        missing = np.isnan(samples)
+        if missing.any():
+            samples = np.where(missing, 0., samples)
+
+        if self._zi is None:
+            # (sections x 2 x channels), scaled to the first sample
+            self._zi = signal.sosfilt_zi(self._sos)[:, :, np.newaxis] * \
+                samples[0]
+
+        filtered, self._zi = signal.sosfilt(self._sos, samples, axis=0,
+                                            zi=self._zi)
+        filtered = filtered.astype(np.float32)
+        filtered[missing] = np.nan
+
+        return filtered
@@ -0,0 +1,173 @@
+"""
+Fixed-size storage for multi-channel time series. Samples live in one float32
+(channels x capacity) block with a single shared float64 timestamp column, so
+memory use is bounded and known up front, no matter how long we record for.
+"""
+import numpy as np
+
+
+class RingBuffer:
+
+    def __init__(self, capacity, num_channels=0):
+        """
+        Initializes an empty ring buffer
+
+        Every sample is written twice (at i and i + capacity), so the latest
+        `capacity` samples are always one contiguous slice of memory and can be
+        handed out as views instead of being copied around.
+
+        :param capacity: number of samples to retain per channel
+        :param num_channels: number of channels to allocate up front
+        """
+        self.capacity = int(capacity)
+        if self.capacity <= 0:
+            raise ValueError("Ring buffer capacity must be positive")
+
+        self._data = np.full((num_channels, 2 * self.capacity), np.nan,
+                             dtype=np.float32)
+        self._timestamps = np.full(2 * self.capacity, np.nan, dtype=np.float64)
+
+        # total number of samples ever written
+        self.count = 0
+
+    def __len__(self):
+        """Number of samples currently held"""
+        return min(self.count, self.capacity)
+
+    @property
+    def num_channels(self):
+        """Number of channels (rows) in the buffer"""
+        return self._data.shape[0]
+
+    @property
+    def nbytes(self):
+        """Memory used by the buffer, in bytes"""
+        return self._data.nbytes + self._timestamps.nbytes
+
+    #
+    # Channels
+    #
+
+    def add_channel(self):
+        """
+        Adds an empty channel to the buffer. Samples that are already stored
+        have no value (NaN) for it.
+
+        :return: row index of the new channel
+        """
+        row = np.full((1, 2 * self.capacity), np.nan, dtype=np.float32)
+        self._data = np.concatenate([self._data, row])
+        return self.num_channels - 1
+
+    def remove_channel(self, row):
+        """
+        Removes a channel from the buffer. Rows after it move up by one.
+
+        :param row: row index of channel to remove
+        :return: None
+        """
+        self._data = np.delete(self._data, row, axis=0)
+
+    #
+    # Writing
+    #
+
+    def append(self, timestamps, samples, rows=None):
+        """
+        Appends a block of samples. If the block is larger than the buffer,
+        only its most recent samples are kept.
+
+        :param timestamps: 1-D sequence of n timestamps
+        :param samples: (n x channels) block of samples, one row per timestamp
+        :param rows: buffer rows that the columns of samples belong to. If
+                     None, samples must have a column for every row. Rows that
+                     are not given get no value (NaN) for these timestamps.
+        :return: None
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        samples = np.asarray(samples, dtype=np.float32)
+        if samples.ndim == 1:
+            samples = samples[np.newaxis, :]
+
+        n = len(timestamps)
+        if n == 0:
+            return
+        if n > self.capacity:
+            timestamps = timestamps[-self.capacity:]
+            samples = samples[-self.capacity:]
+            self.count += n - self.capacity
+            n = self.capacity
+
+        # write positions, in both halves of the buffer
+        idx = (self.count + np.arange(n)) % self.capacity
+        idx = np.concatenate([idx, idx + self.capacity])
+
+        self._timestamps[idx] = np.concatenate([timestamps, timestamps])
+        if rows is None:
+            self._data[:, idx] = np.concatenate([samples.T, samples.T], axis=1)
+        else:
+            self._data[:, idx] = np.nan
+            self._data[np.ix_(rows, idx)] = \
+                np.concatenate([samples.T, samples.T], axis=1)
+
+        self.count += n
+
+    def set_value(self, row, timestamp, value):
+        """
+        Sets the value of a single channel at timestamp. If timestamp is the
+        latest timestamp in the buffer, the value is filled in for that sample,
+        otherwise a new sample is appended with no value for other channels.
+
+        :param row: row index of channel
+        :param timestamp: timestamp of value
+        :param value: value to set
+        :return: None
+        """
+        if self.count > 0 and self._timestamps[self._end - 1] == timestamp:
+            pos = (self.count - 1) % self.capacity
+            self._data[row, [pos, pos + self.capacity]] = value
+        else:
+            self.append([timestamp], [[value]], rows=[row])
+
+    def clear_value(self, row, timestamp, value):
+        """
+        Clears (sets to NaN) a single channel value at timestamp
+
+        :param row: row index of channel
+        :param timestamp: timestamp of value
+        :param value: value to clear
+        :return: True if a matching value was found and cleared, else False
+        """
+        timestamps = self.timestamps
+        values = self.data[row]
+        matches = np.flatnonzero((timestamps == timestamp) &
+                                 (values == np.float32(value)))
+        if len(matches) == 0:
+            return False
+
+        pos = (self.count - len(self) + matches[0]) % self.capacity
+        self._data[row, [pos, pos + self.capacity]] = np.nan
+        return True
+
+    #
+    # Reading
+    #
+
+    @property
+    def _end(self):
+        """Index one past the latest sample in the mirrored buffer"""
+        if self.count == 0:
+            return self.capacity
+        return (self.count - 1) % self.capacity + 1 + self.capacity
+
+    @property
+    def timestamps(self):
+        """View of the timestamps of all held samples, oldest first"""
+        end = self._end
+        return self._timestamps[end - len(self):end]
+
+    @property
+    def data(self):
+        """(channels x samples) view of all held samples, oldest first"""
+        end = self._end
+        return self._data[:, end - len(self):end]
@@ -0,0 +1,101 @@
+"""
+Overlapping windows over a live stream, for continuous classification. The
+window is kept in its own ring buffer and only the samples added since the
+last window are copied into it, rather than reading the whole window from the
+stream each time. Each window is handed out as a full copy, which the trained
+pipelines (which filter and transform raw windows) classify from scratch.
+"""
+import asyncio
+
+import numpy as np
+
+from data_streams.ring_buffer import RingBuffer
+
+
+class SlidingWindow:
+
+    def __init__(self, data_stream, num_samples, hop_samples, channels=None,
+                 filtered=False):
+        """
+        Initializes an empty window. Only samples added to the stream after
+        this are used.
+
+        :param data_stream: DataStream to take samples from
+        :param num_samples: number of samples per window
+        :param hop_samples: number of new samples between windows
+        :param channels: channels to include, defaults to the EEG channels
+        :param filtered: if True, use filtered data (see DataStream.set_filters)
+        """
+        if channels is None:
+            channels = data_stream.get_eeg_channels()
+
+        self.data_stream = data_stream
+        self.num_samples = num_samples
+        self.hop_samples = max(1, hop_samples)
+        self.channels = list(channels)
+        self.filtered = filtered
+
+        # number of windows skipped because the consumer fell behind
+        self.skipped = 0
+
+        self._buffer = RingBuffer(num_samples, num_channels=len(self.channels))
+        self._cursor = data_stream.get_cursor()
+        self._new_samples = 0
+        self._windows = 0
+
+    def _update(self):
+        """Moves any samples added to the stream into the window"""
+        data, timestamps, self._cursor = self.data_stream.get_data_since(
+            self._cursor, self.channels, filtered=self.filtered)
+        if len(timestamps) == 0:
+            return
+
+        self._buffer.append(timestamps, data.T)
+        self._new_samples += len(timestamps)
+
+    def ready(self):
+        """
+        Returns True if a full window has hop_samples samples that were not in
+        the last window
+        """
+        self._update()
+        return len(self._buffer) == self.num_samples and \
+            self._new_samples >= self.hop_samples
+
+    async def next_window(self, timeout=None):
+        """
+        Waits for the next window. If more than one hop has passed since the
+        last window (because the caller was busy), the windows in between are
+        skipped and the latest one is returned, so that decisions are never
+        more than a hop behind the data.
+
+        :param timeout: seconds to wait, or None to wait indefinitely
+        :return: (data, timestamps), where data is a (channels x num_samples)
+                 float32 copy of the window, or None if there was no window
+                 in time
+        """
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        while not self.ready():
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return None
+            await self.data_stream.wait_for_data_async(self._cursor,
+                                                       timeout=remaining)
+
+        # windows that came up since the last one was handed out were skipped
+        if self._windows > 0:
+            self.skipped += self._new_samples // self.hop_samples - 1
+        self._new_samples = 0
+        self._windows += 1
+
+        return self._buffer.data.copy(), self._buffer.timestamps.copy()
+
+    def power(self):
+        """
+        Returns the power (variance) of each channel over the current window
+        (empty values count as zero)
+        """
+        return np.var(np.nan_to_num(self._buffer.data.astype(np.float64)),
+                      axis=1)
@@ -0,0 +1,73 @@
+"""
+Helpers for finding time windows in a sorted column of timestamps. Lookups are
+binary searches, so they cost the same for a few seconds of data as they do for
+hours of it.
+"""
+import numpy as np
+
+
+def window_bounds(timestamps, start_time=None, end_time=None, duration=None,
+                  num_samples=None):
+    """
+    Finds the index bounds of a time window
+
+    :param timestamps: sorted 1-D array of timestamps
+    :param start_time: start time of window (inclusive). If None, the window
+                       starts at the first sample
+    :param end_time: end time of window (exclusive). If None, the window ends
+                     at the last sample
+    :param duration: length of window in seconds, counted from start_time.
+                     Cannot be given together with end_time
+    :param num_samples: maximum number of samples in window
+    :return: (start, end) indices such that timestamps[start:end] is the window
+    """
+    if duration is not None:
+        if end_time is not None:
+            raise ValueError("Only one of end_time and duration can be given")
+        if start_time is None:
+            raise ValueError("duration needs a start_time")
+        end_time = start_time + duration
+
+    start = 0
+    end = len(timestamps)
+
+    if start_time is not None:
+        start = int(np.searchsorted(timestamps, start_time, side='left'))
+    if end_time is not None:
+        end = max(start, int(np.searchsorted(timestamps, end_time,
+                                             side='left')))
+    if num_samples is not None:
+        end = min(end, start + num_samples)
+
+    return start, end
+
+
+def extract_epochs(data, timestamps, start_times, num_samples):
+    """
+    Cuts a fixed-length epoch out of data for each of start_times, finding all
+    epoch starts in one vectorized binary search
+
+    :param data: (channels x samples) array
+    :param timestamps: sorted timestamps of the samples in data
+    :param start_times: 1-D array of epoch start times
+    :param num_samples: number of samples per epoch
+    :return: (epochs x channels x num_samples) array. Samples that fall past
+             the end of data are NaN, and so are epochs that start before the
+             first sample of data (eg. ones that have left the buffer).
+    """
+    start_times = np.asarray(start_times, dtype=np.float64)
+    epochs = np.full((len(start_times), data.shape[0], num_samples), np.nan,
+                     dtype=data.dtype)
+    if data.shape[1] == 0:
+        return epochs
+
+    starts = np.searchsorted(timestamps, start_times, side='left')
+    idx = starts[:, np.newaxis] + np.arange(num_samples)
+    valid = (idx < data.shape[1]) & \
+        (start_times >= timestamps[0])[:, np.newaxis]
+
+    # data[:, idx] is (channels x epochs x num_samples)
+    epochs[:] = data[:, np.minimum(idx, data.shape[1] - 1)].transpose(1, 0, 2)
+    epochs[np.broadcast_to(~valid[:, np.newaxis, :], epochs.shape)] = np.nan
+
+    return epochs
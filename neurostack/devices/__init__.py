@@ -1,3 +1,5 @@
 from devices.device import Device
 from devices.muse import Muse
+from devices.replay import Replay
+from devices.synthetic import Synthetic, SyntheticEEG
 # from devices.openbci import OpenBCI
@@ -61,3 +61,22 @@ class Device(ABC):
         :return:
         """
         pass
+
+    def get_time_diff(self):
+        """
+        Get the offset between unix time and the device's stream time, as
+        currently estimated by its data stream.
+
+        :return: unix time minus stream time, in seconds
+        """
+        return self.data_stream.clock.offset()
+
+    def to_stream_time(self, unix_time):
+        """
+        Convert unix time(s) to the device's stream time, correcting for drift
+        between the two clocks.
+
+        :param unix_time: a unix time, or array of them
+        :return: stream time(s)
+        """
+        return self.data_stream.clock.to_stream(unix_time)
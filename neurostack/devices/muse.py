@@ -1,8 +1,8 @@
 from data_streams.data_stream import DataStream
 from devices import Device
+from devices.synthetic import SyntheticEEG
 
 import pylsl
-import random
 import threading
 import time
 
@@ -12,9 +12,6 @@ class Muse(Device):
     def __init__(self, device_id=None):
         super().__init__(device_id)
 
-        # difference between unix and muse time
-        self.time_diff = 0
-
         # for generating fake data
         self._fake_muse = None
         self._fake_muse_active = False
@@ -25,16 +22,11 @@ class Muse(Device):
 
     def _create_fake_eeg_stream(self):
         """
-        Method for generating dummy EEG data for the muse. Sends randomly-
-        generated data through an LSL outlet.
+        Method for generating dummy EEG data for the muse. Sends synthetic
+        data through an LSL outlet, in chunks.
 
         :return: None
         """
-        def generate_muse_data():
-            """Generate 4 random floats, representing channels AF7, AF8, TP9,
-            and TP10 on the muse headset"""
-            return [random.random() for _ in range(4)]
-
         # create fake muse
         info = pylsl.StreamInfo(name='Muse', type='EEG', channel_count=4,
                                 nominal_srate=256, channel_format='float32',
@@ -53,32 +45,32 @@ class Muse(Device):
         outlet = pylsl.StreamOutlet(info)
 
         # continuously push data to outlet when active
-        while self._fake_muse_active:
-            outlet.push_sample(generate_muse_data())
-            time.sleep(0.00390625)  # 256Hz
+        generator = SyntheticEEG(num_channels=4, sample_rate=256)
+        generator.stream_to_outlet(outlet, lambda: self._fake_muse_active)
 
     #
     # Public device methods
     #
 
-    def connect(self, fake_data=False):
+    def connect(self, fake_data=False, chunked=False):
         """
         Creates data streams if there are none and connects to EEG stream
         (since that is the one that is immediately needed for use). If fake_data
         is True, then start a separate thread that generates fake data instead
-        of connecting to a muse.
+        of connecting to a muse. If chunked is True, data is pulled from the
+        stream in chunks instead of one sample at a time.
         """
         # create thread that runs something which continuously streams data
         if fake_data:
             eeg_data_thread = threading.Thread(
                 target=self._create_fake_eeg_stream, name='fake muse')
             eeg_data_thread.daemon = True
-            eeg_data_thread.start()
 
             self._fake_muse_active = True
             self._fake_muse = eeg_data_thread
+            eeg_data_thread.start()
 
-        self.data_stream.lsl_connect()
+        self.data_stream.lsl_connect(chunked=chunked)
 
     def start(self):
         """Start streaming EEG data"""
@@ -92,8 +84,6 @@ class Muse(Device):
         # wait until there is data in the channels
         while not self.data_stream.has_data(channel_name):
             time.sleep(0.01)
-        self.time_diff = time.time() - \
-                         self.data_stream.get_latest_data(channel_name)[0]
 
     def stop(self):
         """Stop streaming EEG data"""
@@ -101,13 +91,10 @@ class Muse(Device):
 
     def shutdown(self):
         """Disconnect EEG stream (and stop streaming data)"""
-        self.data_stream.lsl_Stop()
+        self.data_stream.lsl_stop()
+        self.data_stream.close()
         self.data_stream = DataStream()
 
     def get_info(self):
         """Print info about device"""
         print("Device ID: " + str(self.device_id))
-
-    def get_time_diff(self):
-        """Return time offset"""
-        return self.time_diff
@@ -0,0 +1,193 @@
+from data_streams.archive import SessionArchive
+from data_streams.data_stream import DataStream
+from devices.device import Device
+
+import json
+import numpy as np
+import pylsl
+import threading
+import time
+
+
+class Replay(Device):
+
+    def __init__(self, archive, speed=1., chunk_size=32, device_id=None):
+        """
+        Device that plays back a recorded session, for reproducing problems
+        and for testing with real signals.
+
+        :param archive: SessionArchive, or path of an archive, to play back
+        :param speed: playback speed relative to real time, eg. 10 to play
+                      back 10x faster. If None, plays back as fast as possible
+        :param chunk_size: number of samples sent at a time
+        :param device_id: id of the device
+        """
+        super().__init__(device_id)
+
+        if not isinstance(archive, SessionArchive):
+            archive = SessionArchive(archive)
+        self.archive = archive
+        self.speed = speed
+        self.chunk_size = chunk_size
+
+        # markers that have been played back, with stream timestamps
+        self.markers = []
+
+        # set when the whole session has been played back
+        self.finished = threading.Event()
+
+        self._use_lsl = False
+        self._outlet = None
+        self._marker_outlet = None
+        self._replay_thread = None
+        self._replay_active = False
+
+    #
+    # Private device methods for handling data streams
+    #
+
+    def _create_outlets(self):
+        """
+        Creates LSL outlets for the recorded EEG and markers
+
+        :return: None
+        """
+        info = pylsl.StreamInfo(name='Replay', type='EEG',
+                                channel_count=len(self.archive.channels),
+                                nominal_srate=self.archive.sample_rate or 0,
+                                channel_format='float32',
+                                source_id=f'replay {self.archive.path}')
+        info.desc().append_child_value('manufacturer', 'Neurostack')
+        channels = info.desc().append_child('channels')
+        for c in self.archive.channels:
+            channels.append_child("channel") \
+                .append_child_value("label", c) \
+                .append_child_value("type", "EEG")
+        self._outlet = pylsl.StreamOutlet(info, chunk_size=self.chunk_size)
+
+        marker_info = pylsl.StreamInfo(name='Replay markers', type='Markers',
+                                       channel_count=1, nominal_srate=0,
+                                       channel_format='string',
+                                       source_id=f'replay markers {self.archive.path}')
+        self._marker_outlet = pylsl.StreamOutlet(marker_info)
+
+    def _replay(self):
+        """
+        Plays back the archive, a chunk at a time, on a drift-free schedule.
+        Timestamps keep their recorded spacing, but are moved to start now.
+
+        :return: None
+        """
+        timestamps = self.archive.timestamps
+        data = self.archive.data
+        if len(timestamps) == 0:
+            self.finished.set()
+            return
+
+        markers = sorted(self.archive.get_markers(),
+                         key=lambda marker: marker['timestamp'])
+        marker_times = np.array([marker['timestamp'] for marker in markers])
+        next_marker = 0
+
+        start_clock = pylsl.local_clock()
+        offset = start_clock - timestamps[0]
+
+        # stream time only keeps up with the wall clock at normal speed, so
+        # otherwise fix the clock offset at the start instead of fitting it
+        clock = self.data_stream.clock
+        if self.speed != 1:
+            clock.freeze(start_clock)
+        else:
+            clock.frozen = False
+
+        for start in range(0, len(timestamps), self.chunk_size):
+            if not self._replay_active:
+                return
+            end = min(start + self.chunk_size, len(timestamps))
+
+            # wait until the last sample of the chunk is due
+            if self.speed:
+                due = start_clock + (timestamps[end - 1] - timestamps[0]) / \
+                      self.speed
+                delay = due - pylsl.local_clock()
+                if delay > 0:
+                    time.sleep(delay)
+
+            chunk_timestamps = timestamps[start:end] + offset
+            samples = np.ascontiguousarray(data[:, start:end].T,
+                                           dtype=np.float32)
+            if self._use_lsl:
+                self._outlet.push_chunk(samples, chunk_timestamps[-1])
+            else:
+                self.data_stream.add_samples(chunk_timestamps, samples)
+
+            # send the markers up to the end of this chunk
+            last = int(np.searchsorted(marker_times, timestamps[end - 1],
+                                       side='right'))
+            for marker in markers[next_marker:last]:
+                timestamp = float(marker['timestamp'] + offset)
+                self.markers.append({'timestamp': timestamp,
+                                     'label': marker['label']})
+                if self._use_lsl:
+                    self._marker_outlet.push_sample(
+                        [json.dumps(marker['label'])], timestamp)
+                else:
+                    self.data_stream.add_marker(timestamp, marker['label'])
+            next_marker = last
+
+        self._replay_active = False
+        self.finished.set()
+
+    #
+    # Public device methods
+    #
+
+    def connect(self, use_lsl=False, chunked=True):
+        """
+        Sets up playback. If use_lsl is True, the session is played back
+        through LSL outlets and the data stream connects to them like it does
+        to a headset. Otherwise samples are added straight to the data stream.
+
+        :param use_lsl: play back through LSL
+        :param chunked: if playing back through LSL, pull data in chunks
+        :return: None
+        """
+        self._use_lsl = use_lsl
+
+        if use_lsl:
+            self._create_outlets()
+            self.data_stream.lsl_connect(chunked=chunked)
+        else:
+            self.data_stream.sample_rate = self.archive.sample_rate
+            self.data_stream.set_eeg_channels(self.archive.channels)
+
+    def start(self):
+        """Start playing back the session"""
+        if self._use_lsl:
+            self.data_stream.lsl_start()
+
+        self.finished.clear()
+        self._replay_active = True
+        self._replay_thread = threading.Thread(target=self._replay,
+                                               name='replay')
+        self._replay_thread.daemon = True
+        self._replay_thread.start()
+
+    def stop(self):
+        """Stop playing back the session"""
+        self._replay_active = False
+        if self._use_lsl:
+            self.data_stream.lsl_stop()
+
+    def shutdown(self):
+        """Stop playing back the session and close the data stream"""
+        self.stop()
+        self.data_stream.close()
+        self.data_stream = DataStream()
+
+    def get_info(self):
+        """Print info about device"""
+        print("Device ID: " + str(self.device_id))
+        print("Replaying: " + self.archive.path)
+        print(f"Channels: {self.archive.channels}, sample rate: "
+              f"{self.archive.sample_rate}, speed: {self.speed}")
@@ -0,0 +1,285 @@
+from data_streams.data_stream import DataStream
+from devices.device import Device
+
+import bisect
+import collections
+
+import numpy as np
+import pylsl
+import threading
+import time
+
+# kinds of events that can be injected into synthetic EEG
+EVENT_KINDS = ('p300', 'left', 'right')
+
+# seconds that the effect of an event lasts: 0.6 for P300s, 3 for left/right
+# desynchronisation
+EVENT_LENGTHS = {'p300': 0.6, 'left': 3., 'right': 3.}
+
+
+class SyntheticEEG:
+
+    def __init__(self, num_channels=4, sample_rate=256., line_freq=60.,
+                 event_interval=None, event_kinds=EVENT_KINDS, seed=None,
+                 background_seconds=10.):
+        """
+        Generates realistic-looking EEG in chunks with NumPy: a 1/f
+        background, alpha bursts, mu/beta rhythms, line noise, and P300s and
+        mu/beta desynchronisation at known event times.
+
+        :param num_channels: number of channels to generate
+        :param sample_rate: sample rate in Hz
+        :param line_freq: frequency of line noise in Hz (50 or 60)
+        :param event_interval: if given, inject a random event every this many
+                               seconds
+        :param event_kinds: kinds of events to pick from for random events
+        :param seed: seed for the random number generator
+        :param background_seconds: length of the 1/f background, which is
+                                   generated once and played in a loop
+        """
+        self.num_channels = num_channels
+        self.sample_rate = float(sample_rate)
+        self.line_freq = line_freq
+        self.event_interval = event_interval
+        self.event_kinds = event_kinds
+
+        # amplitudes, in microvolts
+        self.background_amplitude = 10.
+        self.alpha_amplitude = 8.
+        self.mu_amplitude = 4.
+        self.beta_amplitude = 2.
+        self.line_amplitude = 3.
+        self.p300_amplitude = 6.
+
+        # injected events, as {'time': seconds since start, 'kind': kind},
+        # in order of time. Events are dropped once their effect is over
+        self.events = collections.deque()
+
+        # LSL time of the first sample, if streaming to an outlet
+        self.start_time = None
+
+        self._random = np.random.RandomState(seed)
+        self._phases = self._random.uniform(0, 2 * np.pi, (3, num_channels))
+        self._background = self._make_background(background_seconds)
+        self._sample = 0
+        self._next_event = event_interval
+
+    def _make_background(self, seconds):
+        """
+        Makes a 1/f (pink) noise background that loops without a seam
+
+        :param seconds: length of background
+        :return: (samples x channels) float32 array
+        """
+        n = int(seconds * self.sample_rate)
+        spectrum = np.fft.rfft(self._random.randn(n, self.num_channels), axis=0)
+        freqs = np.fft.rfftfreq(n, 1 / self.sample_rate)
+        spectrum[1:] /= np.sqrt(freqs[1:])[:, np.newaxis]
+        spectrum[0] = 0
+
+        background = np.fft.irfft(spectrum, n=n, axis=0)
+        background /= background.std(axis=0)
+        return (background * self.background_amplitude).astype(np.float32)
+
+    def add_event(self, event_time, kind):
+        """
+        Injects an event. 'p300' adds a P300 to all channels, 'left' and
+        'right' desynchronise mu/beta rhythms on the opposite half of the
+        channels (as in imagined movement).
+
+        :param event_time: time of event, in seconds since the first sample
+        :param kind: one of EVENT_KINDS
+        :return: None
+        """
+        if kind not in EVENT_KINDS:
+            raise ValueError(f"Unknown event kind {kind}")
+
+        event = {'time': event_time, 'kind': kind}
+        if not self.events or event_time >= self.events[-1]['time']:
+            self.events.append(event)
+        else:
+            times = [e['time'] for e in self.events]
+            self.events.insert(bisect.bisect_right(times, event_time), event)
+
+    def generate(self, num_samples):
+        """
+        Generates the next num_samples samples
+
+        :param num_samples: number of samples to generate
+        :return: (samples x channels) float32 array
+        """
+        t = (self._sample + np.arange(num_samples)) / self.sample_rate
+        t_col = t[:, np.newaxis]
+
+        # schedule random events
+        if self.event_interval:
+            while self._next_event < t[-1] + self.event_interval:
+                self.add_event(self._next_event,
+                               self._random.choice(self.event_kinds))
+                self._next_event += self.event_interval
+
+        # drop events whose effect is over
+        while self.events and self.events[0]['time'] < \
+                t[0] - max(EVENT_LENGTHS.values()):
+            self.events.popleft()
+
+        # background
+        idx = (self._sample + np.arange(num_samples)) % len(self._background)
+        chunk = self._background[idx].astype(np.float64)
+
+        # alpha, coming and going in bursts
+        envelope = np.clip(np.sin(2 * np.pi * 0.13 * t_col + self._phases[0]) *
+                           np.sin(2 * np.pi * 0.07 * t_col), 0, 1)
+        chunk += self.alpha_amplitude * envelope * \
+            np.sin(2 * np.pi * 10 * t_col + self._phases[1])
+
+        # mu and beta, desynchronised after left/right events
+        erd = self._desynchronisation(t)
+        chunk += erd * (
+            self.mu_amplitude * np.sin(2 * np.pi * 12 * t_col + self._phases[2]) +
+            self.beta_amplitude * np.sin(2 * np.pi * 20 * t_col + self._phases[2]))
+
+        # line noise
+        chunk += self.line_amplitude * np.sin(2 * np.pi * self.line_freq * t_col)
+
+        # P300s, peaking 300ms after each event
+        for event in self._events_near(t, ('p300',), EVENT_LENGTHS['p300']):
+            chunk += self.p300_amplitude * \
+                np.exp(-(t_col - event['time'] - 0.3) ** 2 / (2 * 0.05 ** 2))
+
+        self._sample += num_samples
+        return chunk.astype(np.float32)
+
+    def _desynchronisation(self, t):
+        """
+        Returns how much of the mu/beta rhythm is left at times t, for each
+        channel, after left/right events (0.5s to 2.5s after the event)
+
+        :param t: times, in seconds since the first sample
+        :return: (samples x channels) array of factors between 0.2 and 1
+        """
+        factors = np.ones((len(t), self.num_channels))
+        half = self.num_channels // 2
+
+        for event in self._events_near(t, ('left', 'right'),
+                                       EVENT_LENGTHS['left']):
+            window = np.exp(-(t - event['time'] - 1.5) ** 2 / (2 * 0.5 ** 2))
+            # imagined movement desynchronises the opposite hemisphere
+            if event['kind'] == 'left':
+                channels = slice(half, None)
+            else:
+                channels = slice(0, max(half, 1))
+            factors[:, channels] *= 1 - 0.8 * window[:, np.newaxis]
+
+        return factors
+
+    def _events_near(self, t, kinds, length):
+        """Returns events of kinds whose effect (length seconds) overlaps t"""
+        return [event for event in self.events
+                if event['kind'] in kinds and
+                t[0] - length <= event['time'] <= t[-1]]
+
+    def stream_to_outlet(self, outlet, is_active, chunk_duration=1 / 32):
+        """
+        Pushes generated chunks to an LSL outlet while is_active() is True.
+        Chunks are due at times computed from the start time, so the stream
+        does not drift however long it runs.
+
+        :param outlet: pylsl.StreamOutlet to push to
+        :param is_active: function that returns False to stop streaming
+        :param chunk_duration: seconds of data per chunk
+        :return: None
+        """
+        chunk_samples = max(1, int(round(self.sample_rate * chunk_duration)))
+        self.start_time = pylsl.local_clock()
+        sent = 0
+
+        while is_active():
+            # wait until the last sample of the chunk is due
+            last_sample_time = self.start_time + \
+                (sent + chunk_samples - 1) / self.sample_rate
+            delay = last_sample_time - pylsl.local_clock()
+            if delay > 0:
+                time.sleep(delay)
+
+            outlet.push_chunk(self.generate(chunk_samples), last_sample_time)
+            sent += chunk_samples
+
+
+class Synthetic(Device):
+
+    def __init__(self, num_channels=4, sample_rate=256., device_id=None,
+                 **kwargs):
+        """
+        Device that streams synthetic EEG through LSL, for testing at any
+        channel count and sample rate
+
+        :param num_channels: number of channels to generate
+        :param sample_rate: sample rate in Hz
+        :param device_id: id of the device
+        :param kwargs: other arguments for SyntheticEEG
+        """
+        super().__init__(device_id)
+        self.generator = SyntheticEEG(num_channels=num_channels,
+                                      sample_rate=sample_rate, **kwargs)
+
+        self._generator_thread = None
+        self._generator_active = False
+
+    def _create_synthetic_stream(self):
+        """
+        Streams synthetic EEG through an LSL outlet
+
+        :return: None
+        """
+        info = pylsl.StreamInfo(name='Synthetic', type='EEG',
+                                channel_count=self.generator.num_channels,
+                                nominal_srate=self.generator.sample_rate,
+                                channel_format='float32',
+                                source_id='synthetic eeg')
+        channels = info.desc().append_child('channels')
+        for i in range(self.generator.num_channels):
+            channels.append_child("channel") \
+                .append_child_value("label", f"ch{i}") \
+                .append_child_value("unit", "microvolts") \
+                .append_child_value("type", "EEG")
+
+        outlet = pylsl.StreamOutlet(info)
+        self.generator.stream_to_outlet(outlet,
+                                        lambda: self._generator_active)
+
+    def connect(self, chunked=True):
+        """
+        Starts generating data and connects to the synthetic stream
+
+        :param chunked: pull data from the stream in chunks
+        :return: None
+        """
+        self._generator_active = True
+        self._generator_thread = threading.Thread(
+            target=self._create_synthetic_stream, name='synthetic eeg')
+        self._generator_thread.daemon = True
+        self._generator_thread.start()
+
+        self.data_stream.lsl_connect(chunked=chunked)
+
+    def start(self):
+        """Start streaming EEG data"""
+        self.data_stream.lsl_start()
+
+    def stop(self):
+        """Stop streaming EEG data"""
+        self.data_stream.lsl_stop()
+
+    def shutdown(self):
+        """Stop generating data and close the data stream"""
+        self._generator_active = False
+        self.data_stream.lsl_stop()
+        self.data_stream.close()
+        self.data_stream = DataStream()
+
+    def get_info(self):
+        """Print info about device"""
+        print("Device ID: " + str(self.device_id))
+        print(f"Synthetic EEG: {self.generator.num_channels} channels at "
+              f"{self.generator.sample_rate}Hz")
@@ -0,0 +1,126 @@
+"""
+Trained classifiers fetched from the Neurostack server, so that predictions
+can be made on the client without a round trip to the server. Classifiers are
+pickled scikit-learn pipelines, so making predictions locally needs the
+server's ML dependencies (see server_requirements.txt) to be installed on the
+client as well; if they are not, predictions are left to the server.
+"""
+import asyncio
+import concurrent.futures
+import pickle
+import time
+
+import numpy as np
+
+# seconds a fetched classifier is used for before checking the server for a
+# newer version
+MODEL_MAX_AGE = 60.
+
+
+class LocalModels:
+
+    def __init__(self, max_age=MODEL_MAX_AGE):
+        """
+        Initializes an empty set of classifiers
+
+        :param max_age: seconds a classifier is used for after it was fetched
+                        (or last found to be up to date) before it is stale
+        """
+        self.max_age = max_age
+
+        # classifiers with (uuid, kind) as key, as dicts with the 'model'
+        # (None if it could not be loaded), its 'version' and when it was
+        # last 'checked' against the server
+        self.models = {}
+
+        # predictions run one at a time, off the event loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def get(self, uuid, kind):
+        """
+        Returns the classifier for a user, if there is a usable one
+
+        :param uuid: client UUID
+        :param kind: kind of classifier, 'p300' or 'left_right'
+        :return: classifier, or None if there is none or it is stale
+        """
+        entry = self.models.get((uuid, kind))
+        if entry is None or self.is_stale(uuid, kind):
+            return None
+        return entry['model']
+
+    def get_version(self, uuid, kind):
+        """Returns the version of the classifier for a user, or None"""
+        entry = self.models.get((uuid, kind))
+        return None if entry is None else entry['version']
+
+    def is_stale(self, uuid, kind):
+        """
+        Returns True if there is no classifier for a user, or if it has not
+        been checked against the server for max_age seconds
+        """
+        entry = self.models.get((uuid, kind))
+        return entry is None or time.time() - entry['checked'] > self.max_age
+
+    def update(self, uuid, kind, version, model=None):
+        """
+        Stores a classifier fetched from the server
+
+        :param uuid: client UUID
+        :param kind: kind of classifier
+        :param version: version of the classifier
+        :param model: pickled classifier, or None if the version we have is
+                      still the latest
+        :return: None
+        """
+        entry = self.models.get((uuid, kind))
+        if model is None and entry is not None and \
+                entry['version'] == version:
+            entry['checked'] = time.time()
+            return
+
+        try:
+            model = pickle.loads(model)
+        except Exception as e:
+            print(f"Cannot load classifier for local predictions: {e}")
+            model = None
+
+        self.models[(uuid, kind)] = {
+            'model': model,
+            'version': version,
+            'checked': time.time()
+        }
+
+    def invalidate(self, uuid, kind):
+        """Marks a user's classifier as stale, eg. after more training"""
+        entry = self.models.get((uuid, kind))
+        if entry is not None:
+            entry['checked'] = float('-inf')
+
+    async def predict(self, uuid, kind, data):
+        """
+        Makes a prediction with a user's classifier, in a worker thread
+
+        :param uuid: client UUID
+        :param kind: kind of classifier, 'p300' or 'left_right'
+        :param data: (channels x samples) window of EEG data
+        :return: prediction results in the same format as the server's
+                 predict endpoint for kind, or None if there is no usable
+                 classifier
+        """
+        model = self.get(uuid, kind)
+        if model is None:
+            return None
+
+        data = np.expand_dims(np.asarray(data), axis=0)
+        loop = asyncio.get_event_loop()
+        prediction = await loop.run_in_executor(
+            self._executor, lambda: model.predict(data)[0])
+
+        # TODO: currently we do not have a confidence method
+        if kind == 'p300':
+            return {'uuid': uuid, 'p300': int(prediction), 'score': 1}
+
+        if isinstance(prediction, np.generic):
+            prediction = prediction.item()
+        return {'uuid': uuid, 'left': prediction}
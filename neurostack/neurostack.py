@@ -1,24 +1,65 @@
+from batching import RequestBatcher
+from data_streams.data_stream import DEFAULT_SAMPLE_RATE
+from data_streams.sliding_window import SlidingWindow
 from devices.muse import Muse
-from socketIO_client import SocketIO
-from utils import generate_uuid
+from devices.replay import Replay
+from local_models import LocalModels, MODEL_MAX_AGE
+from streaming import Broadcaster, MAX_QUEUED_FRAMES
+from utils import encode_array, generate_uuid, nan_to_none
 from sanic import Sanic
 
 import argparse
 import asyncio
+import functools
 import json
+import numpy as np
 import socketio
-import time
+
+# seconds to wait for a reply from the neurostack server
+REQUEST_TIMEOUT = 10.
+
+# seconds between attempts to connect to the neurostack server
+SERVER_RECONNECT_DELAY = 2.
+
+# frames per second for streaming raw data to apps
+RAW_FRAME_RATE = 25
+
+# most windows of a continuous prediction waiting on the server at once; more
+# are skipped until replies arrive
+MAX_PENDING_WINDOWS = 4
+
+# epochs for training and predictions start EPOCH_OFFSET seconds after the
+# event and are EPOCH_LENGTH seconds long (128 samples at 256Hz)
+EPOCH_OFFSET = .1
+EPOCH_LENGTH = .5
 
 
 #Todo: switch Sanic to flask
 class Neurostack:
 
-    def __init__(self, devices=None):  # devices is one of the folders, arguments
+    def __init__(self, devices=None, request_timeout=REQUEST_TIMEOUT,
+                 raw_frame_rate=RAW_FRAME_RATE, local_models=False,
+                 model_max_age=MODEL_MAX_AGE, payload_format='json',
+                 compress_payloads=False, batch_window=0.):  # devices is one of the folders, arguments
         """
         Initialize a connection with an EEG device, and sets up an
         asynchronous connection with subscribers passed in.
 
         :param device: [Devices]
+        :param request_timeout: seconds to wait for neurostack server replies
+        :param raw_frame_rate: frames per second for streaming raw data
+        :param local_models: if True, fetch trained classifiers from the
+                             server and make predictions with them locally
+        :param model_max_age: seconds before a local classifier is checked
+                              against the server again
+        :param payload_format: how EEG data is sent to the server: 'json' (as
+                               lists), or 'float32' or 'float16' (as binary
+                               arrays, see utils.encode_array)
+        :param compress_payloads: if True, compress binary arrays sent to the
+                                  server
+        :param batch_window: seconds to collect prediction requests for the
+                             same user and endpoint for, to send them to the
+                             server as one batch. 0 sends each on its own
         """
         self.devices = devices
 
@@ -28,11 +69,37 @@ class Neurostack:
         self.sio_app.attach(self.sio_app_server)
 
         # socketIO client connects to neurostack server
-        self.sio_neurostack = None
-
-        self.train_results = {}
-        self.predict_results = {}
-        self.stream_raw_data = {}
+        self.sio_neurostack = socketio.AsyncClient(reconnection=True)
+        self.server_url = None
+        self.request_timeout = request_timeout
+        self._server_connected = None
+        self.payload_format = payload_format
+        self.compress_payloads = compress_payloads
+
+        # futures for requests waiting on the server, with request ID as key
+        self.pending_requests = {}
+
+        # prediction requests waiting to be sent to the server in a batch
+        self.batcher = None
+        if batch_window > 0:
+            self.batcher = RequestBatcher(self._send_predict_batch,
+                                          window=batch_window)
+
+        # classifiers for local predictions, and the ones being fetched
+        self.local_models = LocalModels(model_max_age) if local_models else None
+        self._fetching_models = set()
+
+        # one broadcaster of raw data (and one of filtered data) per device,
+        # shared by all users
+        self.raw_frame_rate = raw_frame_rate
+        self.broadcasters = {}
+
+        # session ID of each user streaming raw data, with UUID as key
+        self.streaming_sessions = {}
+
+        # (session ID, task) of users getting continuous predictions, with UUID
+        # as key
+        self.continuous_predictions = {}
 
     #
     # Methods for handling devices
@@ -89,49 +156,197 @@ class Neurostack:
         Connects to neurostack server at ip:port. If no arguments for ip and
         port are given, then connects to the default hardcoded address for a
         server on the cloud.
+
+        The connection is made once Neurostack is running, and is made again
+        automatically if it drops.
         """
-        self.sio_neurostack = SocketIO(ip, port)
-        self.sio_neurostack.connect()
+        self.server_url = f'http://{ip}:{port}'
+        self.sio_app_server.register_listener(self._start_server_connection,
+                                              'after_server_start')
 
-    def neurostack_disconnect(self):
+    async def neurostack_disconnect(self):
         """Disconnects from neurostack server"""
-        self.sio_neurostack.disconnect()
+        self.server_url = None
+        await self.sio_neurostack.disconnect()
+
+    async def _start_server_connection(self, app, loop):
+        """Listener that connects to the neurostack server in the background"""
+        self._server_connected = asyncio.Event()
+        self.sio_neurostack.on('connect', self._server_connected.set)
+        self.sio_neurostack.on('disconnect', self._server_connected.clear)
+        self.sio_neurostack.on('train_results', self.on_train_results)
+
+        loop.create_task(self._connect_to_server())
+
+    async def _connect_to_server(self):
+        """Keeps trying to connect to the neurostack server until it works"""
+        while self.server_url is not None and not self.sio_neurostack.connected:
+            try:
+                await self.sio_neurostack.connect(self.server_url)
+            except socketio.exceptions.ConnectionError as e:
+                print(f"Cannot connect to Neurostack server: {e}")
+                await asyncio.sleep(SERVER_RECONNECT_DELAY)
+
+    async def _request(self, server_endpoint, args, timeout=None):
+        """
+        Sends a request to the neurostack server and waits for the reply to it.
+        Any number of requests can be waiting at once.
 
-    def send_train_data(self, server_endpoint, uuid, eeg_data, label):
+        :param server_endpoint: server API's endpoint
+        :param args: arguments for the endpoint
+        :param timeout: seconds to wait for the reply (including time spent
+                        waiting for a connection), defaults to
+                        self.request_timeout
+        :return: the server's reply
+        :raises asyncio.TimeoutError: if there is no reply in time
+        :raises ConnectionError: if Neurostack is not set up to connect to a
+                                 server (see neurostack_connect)
+        """
+        if self._server_connected is None:
+            raise ConnectionError("Not connected to a Neurostack server")
+
+        if timeout is None:
+            timeout = self.request_timeout
+
+        loop = asyncio.get_event_loop()
+        request_id = generate_uuid()
+        future = loop.create_future()
+        self.pending_requests[request_id] = future
+
+        async def send_and_wait():
+            await self._server_connected.wait()
+            await self.sio_neurostack.emit(
+                server_endpoint, args,
+                callback=functools.partial(self.on_results, request_id))
+            return await future
+
+        try:
+            return await asyncio.wait_for(send_and_wait(), timeout)
+        finally:
+            self.pending_requests.pop(request_id, None)
+
+    async def send_train_data(self, server_endpoint, uuid, eeg_data, label,
+                              timeout=None, timestamp=None):
         """
         Sends training data to neurostack server
 
         :param server_endpoint: server API's endpoint
         :param uuid: client's UUID
-        :param eeg_data: one sample of EEG data to be used for training
+        :param eeg_data: one sample of EEG data to be used for training, as a
+                         (channels x samples) array
         :param label: this data's label
-        :returns: None
+        :param timeout: seconds to wait for the reply
+        :param timestamp: timestamp of the data, passed back with the results
+        :returns: the server's reply
         """
         args = {
             'uuid': uuid,
-            'data': eeg_data,
-            'label': label
+            'data': self._encode_data(eeg_data),
+            'label': label,
+            'timestamp': timestamp
         }
-        self.sio_neurostack.emit(server_endpoint, args, self.on_train_results)
-        self.sio_neurostack.wait_for_callbacks(seconds=1)
+        return await self._request(server_endpoint, args, timeout)
 
-    def send_predict_data(self, server_endpoint, uuid, eeg_data):
+    async def send_predict_data(self, server_endpoint, uuid, eeg_data,
+                                timeout=None):
         """
         Sneds prediction data to neurostack server
 
         :param server_endpoint: server API's endpoint
         :param uuid: client's UUID
-        :param eeg_data: one sample of EEG data that we want to predict for
-        :returns: None
+        :param eeg_data: one sample of EEG data that we want to predict for,
+                         as a (channels x samples) array
+        :param timeout: seconds to wait for the reply
+        :returns: the server's reply
         """
         args = {
             'uuid': uuid,
-            'data': eeg_data
+            'data': self._encode_data(eeg_data)
         }
-        self.sio_neurostack.emit(server_endpoint, args, self.on_predict_results)
-        self.sio_neurostack.wait_for_callbacks(seconds=1)
+        return await self._request(server_endpoint, args, timeout)
+
+    def _encode_data(self, eeg_data):
+        """Encodes EEG data to send to the server, as set by payload_format"""
+        if self.payload_format == 'json':
+            return np.asarray(eeg_data).tolist()
+        return encode_array(eeg_data, dtype=self.payload_format,
+                            compress=self.compress_payloads)
+
+    async def predict(self, server_endpoint, uuid, eeg_data, timeout=None):
+        """
+        Makes a prediction with the user's classifier, locally if it has been
+        fetched and is up to date, otherwise on the neurostack server (and
+        fetches the classifier in the background for next time)
+
+        :param server_endpoint: server API's endpoint, eg. 'p300_predict'
+        :param uuid: client's UUID
+        :param eeg_data: (channels x samples) array of EEG data to predict for
+        :param timeout: seconds to wait for the server's reply
+        :returns: prediction results
+        """
+        if self.local_models is not None:
+            kind = server_endpoint[:-len('_predict')]
+            if self.local_models.get(uuid, kind) is not None:
+                return await self.local_models.predict(uuid, kind, eeg_data)
+            if self.local_models.is_stale(uuid, kind):
+                self._fetch_model(uuid, kind)
+
+        # only windows of the same shape can be stacked into one batch
+        if self.batcher is not None:
+            key = (server_endpoint, uuid, np.shape(eeg_data))
+            return await asyncio.wait_for(self.batcher.submit(key, eeg_data),
+                                          timeout or self.request_timeout)
+        return await self.send_predict_data(server_endpoint, uuid, eeg_data,
+                                            timeout)
+
+    async def _send_predict_batch(self, key, eeg_data):
+        """
+        Sends a batch of prediction requests for one user and endpoint to the
+        neurostack server
 
-    def send_train_data_test(self, uuid, eeg_data, label):
+        :param key: (server_endpoint, uuid, shape of data) of the requests
+        :param eeg_data: list of (channels x samples) arrays of EEG data
+        :returns: list with the server's prediction results for each array
+        """
+        server_endpoint, uuid, _ = key
+        args = {
+            'uuid': uuid,
+            'data': self._encode_data(np.stack(eeg_data))
+        }
+        results = await self._request(f'{server_endpoint}_batch', args)
+
+        # errors are passed on to every request in the batch
+        if not isinstance(results, dict):
+            return [results] * len(eeg_data)
+        return results['results']
+
+    def _fetch_model(self, uuid, kind):
+        """Fetches a user's classifier from the server in the background"""
+        if (uuid, kind) in self._fetching_models:
+            return
+        self._fetching_models.add((uuid, kind))
+
+        async def fetch():
+            try:
+                args = {
+                    'uuid': uuid,
+                    'type': kind,
+                    'version': self.local_models.get_version(uuid, kind)
+                }
+                results = await self._request('get_classifier', args)
+                if 'error' not in results:
+                    self.local_models.update(uuid, kind, results['version'],
+                                             results.get('model'))
+            except asyncio.TimeoutError:
+                print(f"Timed out fetching {kind} classifier")
+            except ConnectionError as e:
+                print(f"Cannot fetch {kind} classifier: {e}")
+            finally:
+                self._fetching_models.discard((uuid, kind))
+
+        asyncio.get_event_loop().create_task(fetch())
+
+    async def send_train_data_test(self, uuid, eeg_data, label):
         """
         Tests endpoint for sending training data to neurostack server
 
@@ -145,10 +360,9 @@ class Neurostack:
             'data': eeg_data,
             'label': label
         }
-        self.sio_neurostack.emit("test_train", args, self.print_results)
-        self.sio_neurostack.wait_for_callbacks(seconds=1)
+        self.print_results(await self._request("test_train", args))
 
-    def send_predict_data_test(self, uuid, eeg_data):
+    async def send_predict_data_test(self, uuid, eeg_data):
         """
         Tests endpoint for sending prediction data to neurostack server
 
@@ -160,8 +374,7 @@ class Neurostack:
             'uuid': uuid,
             'data': eeg_data
         }
-        self.sio_neurostack.emit("test_predict", args, self.print_results)
-        self.sio_neurostack.wait_for_callbacks(seconds=1)
+        self.print_results(await self._request("test_predict", args))
 
     #
     # Methods for handling client-side communication
@@ -173,6 +386,7 @@ class Neurostack:
         # streaming raw data
         self.sio_app.on("start_streaming_raw_data", self.start_streaming_raw_data_handler)
         self.sio_app.on("stop_streaming_raw_data", self.stop_streaming_raw_data_handler)
+        self.sio_app.on("get_decimated_data", self.get_decimated_data_handler)
 
         # training Neurostack model
         self.sio_app.on("p300_train", self.p300_train_handler)
@@ -181,8 +395,13 @@ class Neurostack:
         self.sio_app.on("left_right_train", self.left_right_train_handler)
         self.sio_app.on("left_right_predict", self.left_right_predict_handler)
 
+        # continuous predictions
+        self.sio_app.on("start_continuous_prediction", self.start_continuous_prediction_handler)
+        self.sio_app.on("stop_continuous_prediction", self.stop_continuous_prediction_handler)
+
         # misc
         self.sio_app.on("generate_uuid", self.generate_uuid_handler)
+        self.sio_app.on("disconnect", self.disconnect_handler)
 
 
     def run(self, host='localhost', port=8002):
@@ -200,32 +419,57 @@ class Neurostack:
         """
         Handler for streaming raw data
 
-        :param sid: session ID (not important)
+        :param sid: session ID
         :param args: arguments passed to this function. This should include:
             uuid: universally unique ID of user who wants to stop streaming
+            format (optional): 'binary' to receive 'raw_data_frame' events
+                with binary frames of samples (see streaming.py) instead of
+                a 'raw_data' event per sample
+            max_frames (optional): most frames to queue for the user if they
+                cannot keep up, up to streaming.MAX_QUEUED_FRAMES_LIMIT
+            policy (optional): what to do when max_frames are queued, one of
+                'drop_oldest' (default), 'latest' or 'disconnect'
+            filtered (optional): True to stream filtered data, if Neurostack
+                was started with filters
         """
         args = json.loads(args)
         uuid = args['uuid']
-        self.stream_raw_data[uuid] = True
-
-        # keep track of data from previous while loop iteration, so that the
-        # same data is not sent twice.
-        prev_data = None
-        while self.stream_raw_data[uuid]:
+        fmt = args.get('format', 'json')
+        filtered = args.get('filtered', False)
 
-            # TODO: devices[0] is the Muse that we set at the bottom, but we
-            # want to support multiple or different devices
-            data_stream = self.devices[0].data_stream
-            eeg_channel_names = data_stream.get_eeg_channels()
-            raw_data = data_stream.get_latest_data(eeg_channel_names)
-
-            # TODO: raw data can be either a list or a dict right now, should we
-            # just stick with dict?
-
-            # in case while loop is running faster than device streaming rate
-            if raw_data != prev_data:
-                prev_data = raw_data
-                await self.sio_app.emit('raw_data', raw_data)
+        # TODO: devices[0] is the Muse that we set at the bottom, but we
+        # want to support multiple or different devices
+        device = self.devices[0]
+        if filtered and device.data_stream.get_filters() is None:
+            await self.sio_app.emit('raw_data', "filtering is not enabled",
+                                    room=sid)
+            return
+
+        if fmt == 'binary':
+            async def send(frame):
+                await self.sio_app.emit('raw_data_frame', frame, room=sid)
+        else:
+            async def send(samples):
+                for raw_data in samples:
+                    await self.sio_app.emit('raw_data', raw_data, room=sid)
+
+        async def disconnect():
+            self.streaming_sessions.pop(uuid, None)
+            await self.sio_app.emit('raw_data', "streaming has stopped",
+                                    room=sid)
+
+        try:
+            self._get_broadcaster(device, filtered).subscribe(
+                uuid, send, fmt=fmt,
+                max_frames=args.get('max_frames', MAX_QUEUED_FRAMES),
+                policy=args.get('policy', 'drop_oldest'),
+                on_disconnect=disconnect)
+        except ValueError as e:
+            print(e)
+            await self.sio_app.emit('raw_data', str(e), room=sid)
+            return
+
+        self.streaming_sessions[uuid] = sid
 
     async def stop_streaming_raw_data_handler(self, sid, args):
         """
@@ -236,10 +480,86 @@ class Neurostack:
             uuid: universally unique ID of user who wants to stop streaming
         """
         args = json.loads(args)
-        uuid = args['uuid']
-        self.stream_raw_data[uuid] = False
+        self._stop_streaming(args['uuid'])
+
+        await self.sio_app.emit('raw_data', "streaming has stopped", room=sid)
+
+    async def disconnect_handler(self, sid):
+        """
+        Handler for when an app disconnects. Stops streaming to, and making
+        continuous predictions for, any users that were using the app.
+
+        :param sid: session ID
+        """
+        for uuid, session in list(self.streaming_sessions.items()):
+            if session == sid:
+                self._stop_streaming(uuid)
+
+        for uuid, (session, _) in list(self.continuous_predictions.items()):
+            if session == sid:
+                self._stop_continuous_prediction(uuid)
+
+    def _stop_streaming(self, uuid):
+        """Stops streaming raw data to a user, from every broadcaster"""
+        self.streaming_sessions.pop(uuid, None)
+        for broadcaster in self.broadcasters.values():
+            broadcaster.unsubscribe(uuid)
+
+    async def get_decimated_data_handler(self, sid, args):
+        """
+        Handler for getting a window of raw data reduced to the resolution it
+        will be plotted at, as the min, max and mean of each bin
+
+        :param sid: session ID
+        :param args: arguments passed to this function. This should include:
+            uuid: universally unique ID of user who wants the data
+            duration (optional): seconds of data to get, up to the latest
+                sample. The default is 30.
+            width (optional): most bins to get, eg. the width of the plot in
+                pixels. The default is 1000.
+        """
+        args = json.loads(args)
 
-        await self.sio_app.emit('raw_data', "streaming has stopped")
+        # TODO: change API to specify device
+        data_stream = self.devices[0].data_stream
+        if not data_stream.decimation_enabled():
+            # filling in the aggregates from the data already in the stream
+            # can take a while, so do it off the event loop
+            loop = asyncio.get_event_loop()
+            try:
+                await loop.run_in_executor(None, data_stream.enable_decimation)
+            except ValueError as e:
+                await self.sio_app.emit('decimated_data', {
+                    'uuid': args['uuid'],
+                    'error': str(e)
+                }, room=sid)
+                return
+
+        decimated = data_stream.get_decimated(
+            width=args.get('width', 1000), duration=args.get('duration', 30))
+        channels = data_stream.get_eeg_channels()
+
+        # empty bins are NaN, which is sent as null
+        results = {
+            'uuid': args['uuid'],
+            'timestamps': decimated['timestamps'].tolist(),
+            'bin_size': decimated['bin_size'],
+            'data': {channel: {key: nan_to_none(decimated[key][i])
+                               for key in ('min', 'max', 'mean')}
+                     for i, channel in enumerate(channels)}
+        }
+        await self.sio_app.emit('decimated_data', results, room=sid)
+
+    def _get_broadcaster(self, device, filtered=False):
+        """
+        Returns the broadcaster of raw (or filtered) data for device, creating
+        it if needed
+        """
+        key = (device, filtered)
+        if key not in self.broadcasters:
+            self.broadcasters[key] = Broadcaster(
+                device, frame_rate=self.raw_frame_rate, filtered=filtered)
+        return self.broadcasters[key]
 
     async def p300_train_handler(self, sid, args):
         """P300 training handler"""
@@ -288,8 +608,6 @@ class Neurostack:
         """
         Handler for passing training data to Neurostack
 
-        TODO: something for sample rate
-
         :param server_endpoint: Neurostack server API endpoint
         :param uuid: client UUID
         :param timestamp: timestamp of data we are interested in, in unix time
@@ -297,34 +615,46 @@ class Neurostack:
         :param window: window of data we are interested in, in seconds
         :return: None
         """
-        # create list for uuid if not done already
-        self.train_results[uuid] = self.train_results.get(uuid, [])
-
         # TODO: change API to specify device
         device = self.devices[0]
 
         # Wait until the device has enough data (ie. the time slice is complete)
-        # then take 100ms - 750ms window for training
-        while time.time() < timestamp + window:
-            time.sleep(.01)
-
-        # TODO: num_samples = window * sample rate
-        timestamp -= self.devices[0].get_time_diff()
-        data_dict = device.data_stream.get_eeg_data(start_time=timestamp + .1,
-                                                    num_samples=128)
-        data = list(data_dict.values())
-
-        self.send_train_data(
-            server_endpoint=server_endpoint,
-            uuid=uuid,
-            eeg_data=data,
-            label=label
-        )
-
-        # wait for results
-        while len(self.train_results[uuid]) == 0:
-            time.sleep(.01)
-        result = self.train_results[uuid].pop(0)
+        # then take the epoch after the event for training
+        stream_time = float(device.to_stream_time(timestamp))
+        if not await device.data_stream.wait_until_async(stream_time + window,
+                                                         timeout=window + 1):
+            await self.sio_app.emit("train", {
+                'uuid': uuid,
+                'error': 'Timed out waiting for EEG data'
+            })
+            return
+
+        data = self._get_epoch(device.data_stream, stream_time)
+        if data is None:
+            await self.sio_app.emit("train", {
+                'uuid': uuid,
+                'error': 'EEG data is no longer buffered'
+            })
+            return
+
+        try:
+            result = await self.send_train_data(
+                server_endpoint=server_endpoint,
+                uuid=uuid,
+                eeg_data=data,
+                label=label,
+                timestamp=timestamp
+            )
+        except asyncio.TimeoutError:
+            result = {'uuid': uuid, 'error': 'Neurostack server timed out'}
+        except ConnectionError as e:
+            result = {'uuid': uuid, 'error': str(e)}
+
+        # the classifier was retrained, so local copies are out of date
+        if self.local_models is not None and isinstance(result, dict) and \
+                result.get('acc') is not None:
+            self.local_models.invalidate(uuid,
+                                         server_endpoint[:-len('_train')])
         await self.sio_app.emit("train", result)
 
     async def predict_handler(self, server_endpoint, uuid, timestamp,
@@ -332,43 +662,211 @@ class Neurostack:
         """
         Handler for passing prediction data to Neurostack
 
-        TODO: something for sample rate
-
         :param server_endpoint: Neurostack server API endpoint
         :param uuid: client UUID
         :param timestamp: timestamp of data we are interested in, in unix time
         :param window: window of data we are interested in, in seconds
         :return: None
         """
-        # create list for uuid if not done already
-        self.predict_results[uuid] = self.predict_results.get(uuid, [])
-
         # TODO: change API to specify device
         device = self.devices[0]
 
         # Wait until the device has enough data (ie. the time slice is complete)
-        # then take 100ms - 750ms window for training. The window should
-        # contain 0.65s * 256Hz = 166 samples.
-        while time.time() < timestamp + window:
-            time.sleep(.01)
-
-        timestamp -= self.devices[0].get_time_diff()
-        data_dict = device.data_stream.get_eeg_data(start_time=timestamp + .1,
-                                                    num_samples=128)
-        data = list(data_dict.values())
-
-        self.send_predict_data(
-            server_endpoint=server_endpoint,
-            uuid=uuid,
-            eeg_data=data
-        )
-
-        # wait for results
-        while len(self.predict_results[uuid]) == 0:
-            time.sleep(.01)
-        result = self.predict_results[uuid].pop(0)
+        # then take the epoch after the event for the prediction
+        timestamp = float(device.to_stream_time(timestamp))
+        if not await device.data_stream.wait_until_async(timestamp + window,
+                                                         timeout=window + 1):
+            await self.sio_app.emit("predict", {
+                'uuid': uuid,
+                'error': 'Timed out waiting for EEG data'
+            })
+            return
+
+        data = self._get_epoch(device.data_stream, timestamp)
+        if data is None:
+            await self.sio_app.emit("predict", {
+                'uuid': uuid,
+                'error': 'EEG data is no longer buffered'
+            })
+            return
+
+        try:
+            result = await self.predict(
+                server_endpoint=server_endpoint,
+                uuid=uuid,
+                eeg_data=data
+            )
+        except asyncio.TimeoutError:
+            result = {'uuid': uuid, 'error': 'Neurostack server timed out'}
+        except ConnectionError as e:
+            result = {'uuid': uuid, 'error': str(e)}
         await self.sio_app.emit("predict", result)
 
+    @staticmethod
+    def _get_epoch(data_stream, stream_time):
+        """
+        Gets the EEG epoch for an event, EPOCH_LENGTH seconds of data starting
+        EPOCH_OFFSET seconds after it
+
+        :param data_stream: DataStream to get data from
+        :param stream_time: time of the event, in stream time
+        :return: (channels x samples) array, or None if the start of the epoch
+                 has already been dropped from the buffer
+        """
+        sample_rate = data_stream.sample_rate or DEFAULT_SAMPLE_RATE
+        num_samples = int(round(EPOCH_LENGTH * sample_rate))
+        start_time = stream_time + EPOCH_OFFSET
+
+        data, timestamps = data_stream.get_eeg_array(start_time=start_time,
+                                                     num_samples=num_samples,
+                                                     copy=True)
+
+        # if the start is older than the buffer, the oldest data is returned
+        # instead, so the first sample is late
+        if len(timestamps) < num_samples or \
+                timestamps[0] - start_time > 1. / sample_rate:
+            return None
+        return data
+
+    async def start_continuous_prediction_handler(self, sid, args):
+        """
+        Handler for making predictions continuously, on overlapping windows of
+        the latest data, until stopped. A 'continuous_predict' event is
+        emitted for each window.
+
+        Windows are sent to the server without waiting for the reply to the
+        previous one, and windows that come up while the server is behind are
+        skipped, so that predictions keep up with the data.
+
+        :param sid: session ID
+        :param args: arguments passed to this function. This should include:
+            uuid: universally unique ID of user who wants predictions
+            type: kind of prediction, 'p300' or 'left_right'
+            window (optional): length of windows in seconds. It should match
+                the data the classifier was trained on, which is EPOCH_LENGTH
+                by default.
+            hop (optional): seconds between windows. The default is 0.1.
+            filtered (optional): True to use filtered data
+        """
+        args = json.loads(args)
+        uuid = args['uuid']
+        server_endpoint = f"{args['type']}_predict"
+
+        # TODO: change API to specify device
+        device = self.devices[0]
+        data_stream = device.data_stream
+        sample_rate = data_stream.sample_rate or DEFAULT_SAMPLE_RATE
+
+        window = args.get('window')
+        if window is None:
+            window = EPOCH_LENGTH
+        num_samples = int(round(window * sample_rate))
+        hop_samples = int(round(args.get('hop', 0.1) * sample_rate))
+
+        sliding_window = SlidingWindow(data_stream, num_samples, hop_samples,
+                                       filtered=args.get('filtered', False))
+
+        # replace any continuous prediction the user already has
+        self._stop_continuous_prediction(uuid)
+        task = asyncio.get_event_loop().create_task(
+            self._run_continuous_prediction(sid, server_endpoint, uuid,
+                                            sliding_window))
+        self.continuous_predictions[uuid] = (sid, task)
+
+    async def _run_continuous_prediction(self, sid, server_endpoint, uuid,
+                                         sliding_window):
+        """
+        Gets a prediction for each window of a continuous prediction, until
+        cancelled (see _stop_continuous_prediction)
+
+        :param sid: session ID
+        :param server_endpoint: Neurostack server API endpoint
+        :param uuid: client UUID
+        :param sliding_window: SlidingWindow to get windows from
+        :return: None
+        """
+        # requests waiting on the server, and the time of the latest window
+        # whose prediction has been emitted
+        pending = set()
+        latest = {'timestamp': float('-inf')}
+        clock = sliding_window.data_stream.clock
+
+        try:
+            while True:
+                window = await sliding_window.next_window(timeout=1)
+                if window is None:
+                    continue
+                if len(pending) >= MAX_PENDING_WINDOWS:
+                    sliding_window.skipped += 1
+                    continue
+
+                data, timestamps = window
+                task = asyncio.get_event_loop().create_task(
+                    self._continuous_predict(
+                        sid, server_endpoint, uuid, data,
+                        timestamp=float(clock.to_wall(timestamps[-1])),
+                        power=sliding_window.power().tolist(),
+                        latest=latest))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _continuous_predict(self, sid, server_endpoint, uuid, data,
+                                  timestamp, power, latest):
+        """
+        Gets a prediction for one window of a continuous prediction and emits
+        it, unless a prediction for a later window was emitted first
+
+        :param sid: session ID
+        :param server_endpoint: Neurostack server API endpoint
+        :param uuid: client UUID
+        :param data: (channels x samples) window of data
+        :param timestamp: unix time of the last sample in the window
+        :param power: power of each channel over the window
+        :param latest: dict with the 'timestamp' of the latest window emitted
+        :return: None
+        """
+        try:
+            result = await self.predict(
+                server_endpoint=server_endpoint,
+                uuid=uuid,
+                eeg_data=data
+            )
+        except asyncio.TimeoutError:
+            result = {'uuid': uuid, 'error': 'Neurostack server timed out'}
+        except ConnectionError as e:
+            result = {'uuid': uuid, 'error': str(e)}
+
+        if timestamp <= latest['timestamp']:
+            return
+        latest['timestamp'] = timestamp
+
+        await self.sio_app.emit('continuous_predict', {
+            'uuid': uuid,
+            'timestamp': timestamp,
+            'result': result,
+            'power': power
+        }, room=sid)
+
+    async def stop_continuous_prediction_handler(self, sid, args):
+        """
+        Handler to stop continuous predictions
+
+        :param sid: session ID
+        :param args: arguments passed to this function. This should include:
+            uuid: universally unique ID of user who wants to stop predictions
+        """
+        args = json.loads(args)
+        self._stop_continuous_prediction(args['uuid'])
+
+    def _stop_continuous_prediction(self, uuid):
+        """Stops making continuous predictions for a user, if they are"""
+        prediction = self.continuous_predictions.pop(uuid, None)
+        if prediction is not None:
+            prediction[1].cancel()
+
     async def generate_uuid_handler(self, sid, args):
         """Handler for sending a request to the server to generate a UUID"""
         uuid = generate_uuid()
@@ -378,17 +876,20 @@ class Neurostack:
     # Callback functions
     #
 
-    def on_train_results(self, *args):
-        """Callback function for saving training results"""
-        results = args[0]
-        uuid = results['uuid']
-        self.train_results[uuid].append(results)
+    def on_results(self, request_id, *args):
+        """Callback function for server replies to requests"""
+        future = self.pending_requests.get(request_id)
+        if future is not None and not future.done():
+            future.set_result(args[0])
 
-    def on_predict_results(self, *args):
-        """Callback function for saving prediction results"""
-        results = args[0]
-        uuid = results['uuid']
-        self.predict_results[uuid].append(results)
+    async def on_train_results(self, results):
+        """
+        Callback function for the server finishing training a classifier;
+        passes the accuracy on to apps with a 'train' event
+        """
+        if self.local_models is not None and results.get('acc') is not None:
+            self.local_models.invalidate(results['uuid'], results['type'])
+        await self.sio_app.emit("train", results)
 
     def print_results(self, *args):
         """Prints out results"""
@@ -428,17 +929,78 @@ if __name__ == '__main__':
                         help='ip:port of Neurostack server to connect to')
     parser.add_argument('--use_fake_data', action='store_true',
                         help='Use flag to generate fake data')
+    parser.add_argument('--request_timeout', type=float,
+                        default=REQUEST_TIMEOUT,
+                        help='seconds to wait for Neurostack server replies')
+    parser.add_argument('--raw_frame_rate', type=float,
+                        default=RAW_FRAME_RATE,
+                        help='frames per second for streaming raw data')
+    parser.add_argument('--local_models', action='store_true',
+                        help='Use flag to fetch trained classifiers from the '
+                             'server and make predictions locally')
+    parser.add_argument('--model_max_age', type=float, default=MODEL_MAX_AGE,
+                        help='seconds before a local classifier is checked '
+                             'against the server again')
+    parser.add_argument('--payload_format', default='json',
+                        choices=['json', 'float32', 'float16'],
+                        help='how EEG data is sent to the server: as JSON '
+                             'lists, or as binary float32 or float16 arrays')
+    parser.add_argument('--compress_payloads', action='store_true',
+                        help='Use flag to compress binary EEG data sent to '
+                             'the server')
+    parser.add_argument('--batch_window', type=float, default=0.,
+                        help='seconds to collect prediction requests for, to '
+                             'send them to the server in one batch (eg. '
+                             '0.005). 0 sends each request on its own')
+    parser.add_argument('--chunked', action='store_true',
+                        help='Use flag to pull EEG data in chunks (for high '
+                             'channel counts or sample rates)')
+    parser.add_argument('--notch', type=float,
+                        help='frequency to filter out of the EEG data, eg. '
+                             '60 for line noise')
+    parser.add_argument('--highpass', type=float,
+                        help='cutoff frequency for high-pass filtering the '
+                             'EEG data')
+    parser.add_argument('--bandpass', type=float, nargs=2,
+                        metavar=('LOW', 'HIGH'),
+                        help='cutoff frequencies for band-pass filtering the '
+                             'EEG data')
+    parser.add_argument('--record', type=str,
+                        help='file to record the EEG session to')
+    parser.add_argument('--replay', type=str,
+                        help='recorded session to play back instead of '
+                             'connecting to a headset')
+    parser.add_argument('--replay_speed', type=float, default=1.,
+                        help='playback speed for --replay (0 for as fast as '
+                             'possible)')
 
     args = parser.parse_args()
 
     # TODO: add something to specify which devices get passed in
-    muse = Muse()
-    muse.connect(fake_data=args.use_fake_data)
-    muse.start()
+    if args.replay is not None:
+        device = Replay(args.replay, speed=args.replay_speed or None)
+        device.connect()
+    else:
+        device = Muse()
+        device.connect(fake_data=args.use_fake_data, chunked=args.chunked)
+    if args.notch or args.highpass or args.bandpass:
+        device.data_stream.set_filters(notch=args.notch,
+                                       highpass=args.highpass,
+                                       bandpass=args.bandpass)
+    if args.record is not None:
+        device.data_stream.start_recording(args.record)
+    device.start()
 
     # create and run neurostack!
-    devices = [muse]
-    neurostack = Neurostack(devices=devices)
+    devices = [device]
+    neurostack = Neurostack(devices=devices,
+                            request_timeout=args.request_timeout,
+                            raw_frame_rate=args.raw_frame_rate,
+                            local_models=args.local_models,
+                            model_max_age=args.model_max_age,
+                            payload_format=args.payload_format,
+                            compress_payloads=args.compress_payloads,
+                            batch_window=args.batch_window)
 
     # connect to neurostack server
     if args.server_address is not None:
@@ -1,4 +1,6 @@
 """ML script with functions for training, loading, and predicting with a LDA classifier."""
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.covariance import oas
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from sklearn.pipeline import make_pipeline
 
@@ -54,7 +56,8 @@ def ml_classifier(inputs, targets, classifier=None, pipeline=None):
         'vecct_reglda': make_pipeline(Vectorizer(), LDA(shrinkage='auto', solver='eigen')),
         'xdawn_reglda': make_pipeline(Xdawn(2, classes=[1]), Vectorizer(), LDA(shrinkage='auto', solver='eigen')),
         'erpcov_ts': make_pipeline(ERPCovariances(), TangentSpace(), LogisticRegression()),
-        'erpcov_mdm': make_pipeline(ERPCovariances(), MDM())
+        'erpcov_mdm': make_pipeline(ERPCovariances(), MDM()),
+        'incremental_lda': IncrementalLDA()
     }
     if not classifier and pipeline:
         classifier = pipeline_dict[pipeline.lower()]
@@ -62,6 +65,132 @@ def ml_classifier(inputs, targets, classifier=None, pipeline=None):
     return classifier
 
 
+class IncrementalLDA(BaseEstimator, ClassifierMixin):
+    """Two-class LDA with OAS shrinkage that can be updated with new epochs without training from scratch.
+    Each channel of an epoch is averaged over n_bins consecutive stretches of time (P300 waves are slow, so this keeps
+    their shape), and the averages of all channels make up the feature vector. The class means and counts, and the
+    inverse of the (shrunk) within-class scatter matrix, are kept; partial_fit updates them with one rank-one
+    (Sherman-Morrison) update per epoch, so an update takes time proportional to the number of new epochs, not to the
+    size of the training set. Since there are n_bins features per channel, rather than one per sample, the inverse
+    stays small (eg. 256 x 256 for 16 channels) and an update takes well under a millisecond.
+
+    The shrinkage is estimated by fit, and is kept as a fixed amount of regularization by partial_fit, so it slowly
+    weakens as epochs are added until the next fit. partial_fit predicts each epoch before training on it, which gives
+    a running (prequential) accuracy without holding out data.
+
+    partial_fit replaces the arrays of the classifier instead of changing them, so a shallow copy of a classifier can be
+    updated while the original is still in use (or is being saved).
+    """
+
+    def __init__(self, n_bins=16):
+        """
+        Args:
+            n_bins: number of stretches of time each channel of an epoch is averaged over, or None to use every
+                sample. Epochs with fewer samples than this use every sample.
+        """
+        self.n_bins = n_bins
+
+    def fit(self, X, y):
+        """Trains the classifier from scratch.
+        Args:
+            X: array of N epochs, each (channels x samples).
+            y: array of N labels, of exactly two classes.
+        Returns:
+            self
+        """
+        X = self._features(X)
+        y = np.asarray(y)
+        self.classes_ = np.unique(y)
+        if len(self.classes_) != 2:
+            raise ValueError(f"Need epochs of two classes to train, got {len(self.classes_)}")
+
+        k = (y == self.classes_[1]).astype(int)
+        self.counts_ = np.bincount(k, minlength=2)
+        self.means_ = np.array([X[k == i].mean(axis=0) for i in (0, 1)])
+
+        # OAS shrinks the covariance towards (trace / d) * I; keep the shrunk scatter matrix, whose inverse is updated
+        # by partial_fit
+        n, d = X.shape
+        centered = X - self.means_[k]
+        _, self.shrinkage_ = oas(centered, assume_centered=True)
+        scatter = centered.T @ centered
+        self.ridge_ = self.shrinkage_ * np.trace(scatter) / d
+        self.precision_ = np.linalg.inv((1 - self.shrinkage_) * scatter + self.ridge_ * np.eye(d))
+
+        self.n_samples_seen_ = n
+        self.n_tested_ = 0
+        self.n_correct_ = 0
+        self._update_weights()
+        return self
+
+    def partial_fit(self, X, y):
+        """Updates the classifier with new epochs, testing it on each epoch before training on it.
+        Args:
+            X: array of N new epochs, of the same shape as the epochs it was fit on.
+            y: array of N labels, of the classes it was fit on.
+        Returns:
+            self
+        """
+        X = self._features(X)
+        for x, label in zip(X, np.asarray(y)):
+            if label not in self.classes_:
+                raise ValueError(f"Unknown class {label}")
+            k = int(label == self.classes_[1])
+
+            self.n_tested_ += 1
+            self.n_correct_ += int((x @ self.coef_ + self.intercept_ > 0) == k)
+
+            # adding x to class k adds count / (count + 1) * u * u^T to the scatter matrix
+            u = x - self.means_[k]
+            c = (1 - self.shrinkage_) * self.counts_[k] / (self.counts_[k] + 1)
+            pu = self.precision_ @ u
+            self.precision_ = self.precision_ - np.outer(pu, pu * (c / (1 + c * (u @ pu))))
+
+            means = self.means_.copy()
+            means[k] += u / (self.counts_[k] + 1)
+            self.means_ = means
+            counts = self.counts_.copy()
+            counts[k] += 1
+            self.counts_ = counts
+
+            self.n_samples_seen_ += 1
+            self._update_weights()
+
+        return self
+
+    def _update_weights(self):
+        """Computes the linear decision function from the class statistics."""
+        # the shrunk covariance is the shrunk scatter matrix divided by the number of epochs
+        self.coef_ = self.n_samples_seen_ * (self.precision_ @ (self.means_[1] - self.means_[0]))
+        self.intercept_ = -self.coef_ @ (self.means_[0] + self.means_[1]) / 2 + \
+            np.log(self.counts_[1] / self.counts_[0])
+
+    def decision_function(self, X):
+        """Returns the score of each epoch; positive scores predict the second class."""
+        return self._features(X) @ self.coef_ + self.intercept_
+
+    def predict(self, X):
+        """Returns the predicted class of each epoch."""
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
+
+    def prequential_score(self):
+        """Returns the accuracy of predictions made by partial_fit before training on each epoch, since the last fit,
+        or None if there were none."""
+        if self.n_tested_ == 0:
+            return None
+        return self.n_correct_ / self.n_tested_
+
+    def _features(self, X):
+        """Averages each channel of each epoch in X over n_bins stretches of time, and flattens each epoch into a
+        feature vector."""
+        X = np.asarray(X, dtype=np.float64)
+        n_samples = X.shape[-1]
+        if X.ndim > 2 and self.n_bins is not None and n_samples > self.n_bins:
+            starts = np.linspace(0, n_samples, self.n_bins + 1).astype(int)
+            X = np.add.reduceat(X, starts[:-1], axis=-1) / np.diff(starts)
+        return X.reshape(len(X), -1)
+
+
 def predict(inputs, classifier):
     """Prediction for every input event.
     Args:
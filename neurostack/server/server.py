@@ -1,14 +1,28 @@
 import binascii
+import functools
 import hashlib
 import json
 import os
 import random
+import urllib.parse
 import socketio
 from sanic import Sanic
 
-from utils import generate_uuid
+from utils import decode_array, generate_uuid, is_valid_uuid
+from server.services.base_service import DATA_DIR
 from server.services.left_right import LeftRightService
 from server.services.p300 import P300Service
+from server.training import TrainingExecutor
+
+# directory older servers saved classifiers in, relative to the directory
+# they were run from
+LEGACY_DIR = 'clfs'
+
+# services with classifiers, with the kind of prediction they make as key
+SERVICES = {
+    'left_right': LeftRightService,
+    'p300': P300Service
+}
 
 
 def hash_password(password):
@@ -33,12 +47,29 @@ def verify_password(stored_password, provided_password):
 
 
 class NeurostackServer:
-    def __init__(self):
+    def __init__(self, data_dir=DATA_DIR, legacy_dir=LEGACY_DIR):
+        """
+        :param data_dir: directory to keep classifiers and training data in
+        :param legacy_dir: directory older servers saved classifiers in, which
+                           are imported when first needed
+        """
         self.sio = socketio.AsyncServer(async_mode='sanic')
         self.app = Sanic()
         self.sio.attach(self.app)
 
         self.services = {}
+        self.data_dir = os.path.abspath(data_dir)
+        self.legacy_dir = os.path.abspath(legacy_dir)
+
+        # classifiers are trained in worker processes
+        self.trainer = TrainingExecutor()
+
+    def _get_service(self, name):
+        """Gets a service, initializing it if it does not exist already"""
+        if self.services.get(name) is None:
+            self.services[name] = SERVICES[name](self.data_dir,
+                                                 self.legacy_dir)
+        return self.services[name]
 
     async def left_right_train(self, sid, args):
         """
@@ -51,24 +82,31 @@ class NeurostackServer:
                          'data': EEG data to use for training
                          'left': True or False
                      }
-        :returns: None if there is not enough data for training, or the current
-                  model accuracy in the format
+        :returns: results in the format below. If enough new data has come
+                  in, the classifier is trained in the background, and the
+                  accuracy is emitted as a 'train_results' event when done
+                  (see _train)
                   {
                       'uuid': client UUID
-                      'acc': current training accuracy
+                      'acc': None
+                      'training': True if the classifier is being trained
                   }
         """
         # initialize service if it does not exist already
-        if self.services.get('left_right') is None:
-            self.services['left_right'] = LeftRightService()
+        self._get_service('left_right')
 
         # load arguments, generate UUID if none is provided
         uuid = args['uuid'] if args['uuid'] != 'None' else generate_uuid()
-        data = args['data']
-        left = args['label']
+        if not is_valid_uuid(uuid):
+            return {'uuid': uuid, 'error': 'Invalid UUID'}
+        try:
+            data = decode_array(args['data'])
+            left = args['label']
+        except (KeyError, ValueError) as e:
+            return {'uuid': uuid, 'error': f'Invalid training data: {e}'}
 
-        results = self.services['left_right'].train(uuid=uuid, data=data, left=left)
-        return results
+        return await self._train(sid, 'left_right', uuid, data, left,
+                                 args.get('timestamp'))
 
     async def left_right_predict(self, sid, args):
         """
@@ -87,14 +125,20 @@ class NeurostackServer:
                   }
         """
         # initialize service if it does not exist already
-        if self.services.get('left_right') is None:
-            self.services['left_right'] = LeftRightService()
+        self._get_service('left_right')
 
         # load arguments, generate UUID if none is provided
         uuid = args['uuid'] if args['uuid'] != 'None' else generate_uuid()
-        data = args['data']
-
-        results = self.services['left_right'].predict(uuid=uuid, data=data)
+        if not is_valid_uuid(uuid):
+            return {'uuid': uuid, 'error': 'Invalid UUID'}
+        try:
+            data = decode_array(args['data'])
+        except (KeyError, ValueError) as e:
+            return {'uuid': uuid, 'error': f'Invalid EEG data: {e}'}
+
+        clf = await self.services['left_right'].load_classifier_async(uuid)
+        results = self.services['left_right'].predict(
+            uuid=uuid, data=data, clf=clf)
         return results
 
     async def p300_train(self, sid, args):
@@ -109,25 +153,133 @@ class NeurostackServer:
                          'data': EEG data to use for training
                          'p300': True or False
                      }
-        :returns: None if there is not enough data for training, or the current
-                  model accuracy in the format
+        :returns: results in the format below. If enough new data has come
+                  in, the classifier is trained in the background, and the
+                  accuracy is emitted as a 'train_results' event when done
+                  (see _train)
                   {
                       'uuid': client UUID
-                      'acc': current training accuracy
+                      'acc': accuracy if the classifier was updated with the
+                             data (see _train), else None
+                      'training': True if the classifier is being trained
                   }
         """
         # initialize service if it does not exist already
-        if self.services.get('p300') is None:
-            self.services['p300'] = P300Service()
+        self._get_service('p300')
 
         # load arguments, generate UUID if none is provided
         uuid = args['uuid'] if args['uuid'] != 'None' else generate_uuid()
-        data = args['data']
-        p300 = args['label']
+        if not is_valid_uuid(uuid):
+            return {'uuid': uuid, 'error': 'Invalid UUID'}
+        try:
+            data = decode_array(args['data'])
+            p300 = args['label']
+        except (KeyError, ValueError) as e:
+            return {'uuid': uuid, 'error': f'Invalid training data: {e}'}
+
+        return await self._train(sid, 'p300', uuid, data, p300,
+                                 args.get('timestamp'))
+
+    async def _train(self, sid, name, uuid, data, label, timestamp=None):
+        """
+        Saves training data, and starts training the classifier in a worker
+        process if enough new data has come in. If the classifier is already
+        being trained, it is trained again on the latest data once that is
+        done. Services that support it (see BaseService.partial_fit) instead
+        update the classifier with each sample, and only train it from scratch
+        every refit_interval samples. When training is done, the classifier
+        is saved and a 'train_results' event is emitted to the session, in the
+        format
+                  {
+                      'uuid': client UUID
+                      'type': kind of classifier
+                      'timestamp': timestamp of the data that started training
+                      'acc': current training accuracy, or None if training
+                             failed
+                  }
+
+        :param sid: Socket IO session ID
+        :param name: name of service
+        :param uuid: client UUID
+        :param data: EEG data to use for training
+        :param label: label of data
+        :param timestamp: timestamp of data, passed back with the results
+        :returns: results of saving the data, or {'uuid': client UUID,
+                  'error': reason} if it does not match the training data
+                  saved before
+        """
+        service = self.services[name]
+        try:
+            service.save_inputs(uuid, data, label)
+        except ValueError as e:
+            return {'uuid': uuid, 'error': str(e)}
+
+        # the user is active, so have their classifier ready for predictions
+        service.prefetch_classifier(uuid)
+
+        # decide what is due before updating, since more samples may come in
+        # while the classifier is updated
+        num_samples = service.training.num_samples(uuid)
+        retrain = service.retrain_due(uuid)
+        refit = retrain and service.refit_due(uuid)
+
+        # services that support it update the classifier with every sample,
+        # and only train it from scratch every so often
+        updated = await service.update_classifier_async(uuid)
+
+        results = {
+            'uuid': uuid,
+            'timestamp': timestamp,
+            'acc': None,
+            'training': False
+        }
+
+        if not retrain:
+            return results
+
+        if updated is not None and not refit:
+            results['acc'] = updated[1]
+            await self._on_trained(sid, name, uuid, timestamp, num_samples,
+                                   updated)
+        else:
+            X, y = service.get_training_set(uuid)
+            callback = functools.partial(self._on_trained, sid, name, uuid,
+                                         timestamp, len(y))
+            self.trainer.submit((name, uuid), service.fit, (X, y), callback)
+            results['training'] = True
 
-        results = self.services['p300'].train(uuid=uuid, data=data, p300=p300)
         return results
 
+    async def _on_trained(self, sid, name, uuid, timestamp, num_samples,
+                          result):
+        """Saves a newly trained classifier and sends its accuracy"""
+        results = {
+            'uuid': uuid,
+            'type': name,
+            'timestamp': timestamp,
+            'acc': None
+        }
+
+        if isinstance(result, Exception):
+            print(f"Cannot train {name} classifier: {result}")
+            results['error'] = str(result)
+        else:
+            service = self.services[name]
+            clf, results['acc'] = result
+
+            # catch up on samples that came in while training
+            if service.partial_fit is not None and \
+                    num_samples < service.training.num_samples(uuid):
+                updated = await service.update_classifier_async(uuid, clf)
+                if updated is not None:
+                    clf, results['acc'] = updated
+                    num_samples = service.training.num_samples(uuid)
+
+            service.save_classifier(uuid, clf, acc=results['acc'],
+                                    num_samples=num_samples)
+
+        await self.sio.emit('train_results', results, room=sid)
+
     async def p300_predict(self, sid, args):
         """
         Endpoint for making predictions with trained p300 classifier
@@ -146,14 +298,160 @@ class NeurostackServer:
                   }
         """
         # initialize service if it does not exist already
-        if self.services.get('p300') is None:
-            self.services['p300'] = P300Service()
+        self._get_service('p300')
+
+        # load arguments, generate UUID if none is provided
+        uuid = args['uuid'] if args['uuid'] != 'None' else generate_uuid()
+        if not is_valid_uuid(uuid):
+            return {'uuid': uuid, 'error': 'Invalid UUID'}
+        try:
+            data = decode_array(args['data'])
+        except (KeyError, ValueError) as e:
+            return {'uuid': uuid, 'error': f'Invalid EEG data: {e}'}
+
+        clf = await self.services['p300'].load_classifier_async(uuid)
+        results = self.services['p300'].predict(
+            uuid=uuid, data=data, clf=clf)
+        return results
+
+    async def left_right_predict_batch(self, sid, args):
+        """
+        Endpoint for making predictions for a batch of events with trained
+        left right classifier
+
+        :param sid: Socket IO session ID, automatically given by connection
+        :param args: arguments from client. This should be in the format
+                     {
+                         'uuid': client UUID
+                         'data': (events x channels x samples) EEG data to
+                                 make predictions on
+                         'timestamps': timestamps of events (optional)
+                     }
+        :returns: prediction results in the format
+                  {
+                      'uuid': client UUID
+                      'results': results of left_right_predict for each event
+                  }
+        """
+        # initialize service if it does not exist already
+        self._get_service('left_right')
+
+        # load arguments, generate UUID if none is provided
+        uuid = args['uuid'] if args['uuid'] != 'None' else generate_uuid()
+        if not is_valid_uuid(uuid):
+            return {'uuid': uuid, 'error': 'Invalid UUID'}
+        try:
+            data = decode_array(args['data'])
+        except (KeyError, ValueError) as e:
+            return {'uuid': uuid, 'error': f'Invalid EEG data: {e}'}
+
+        clf = await self.services['left_right'].load_classifier_async(uuid)
+        results = self.services['left_right'].predict_batch(
+            uuid=uuid, data=data, timestamps=args.get('timestamps'), clf=clf)
+        if isinstance(results, str):
+            return results
+        return {'uuid': uuid, 'results': results}
+
+    async def p300_predict_batch(self, sid, args):
+        """
+        Endpoint for making predictions for a batch of events with trained
+        p300 classifier
+
+        :param sid: Socket IO session ID, automatically given by connection
+        :param args: arguments from client. This should be in the format
+                     {
+                         'uuid': client UUID
+                         'data': (events x channels x samples) EEG data to
+                                 make predictions on
+                         'timestamps': timestamps of events (optional)
+                     }
+        :returns: prediction results in the format
+                  {
+                      'uuid': client UUID
+                      'results': results of p300_predict for each event
+                  }
+        """
+        # initialize service if it does not exist already
+        self._get_service('p300')
 
         # load arguments, generate UUID if none is provided
         uuid = args['uuid'] if args['uuid'] != 'None' else generate_uuid()
-        data = args['data']
+        if not is_valid_uuid(uuid):
+            return {'uuid': uuid, 'error': 'Invalid UUID'}
+        try:
+            data = decode_array(args['data'])
+        except (KeyError, ValueError) as e:
+            return {'uuid': uuid, 'error': f'Invalid EEG data: {e}'}
+
+        clf = await self.services['p300'].load_classifier_async(uuid)
+        results = self.services['p300'].predict_batch(
+            uuid=uuid, data=data, timestamps=args.get('timestamps'), clf=clf)
+        if isinstance(results, str):
+            return results
+        return {'uuid': uuid, 'results': results}
+
+    async def connect(self, sid, environ):
+        """
+        Handler for new connections. Clients that connect for a user can pass
+        their UUID in the query string (eg. ?uuid=...), so that the user's
+        classifiers start loading in the background straight away.
 
-        results = self.services['p300'].predict(uuid=uuid, data=data)
+        :param sid: Socket IO session ID, automatically given by connection
+        :param environ: WSGI environment of the connection request
+        :return: None
+        """
+        query = urllib.parse.parse_qs(environ.get('QUERY_STRING', ''))
+        for uuid in filter(is_valid_uuid, query.get('uuid', [])):
+            for name in SERVICES:
+                self._get_service(name).prefetch_classifier(uuid)
+
+    async def get_classifier(self, sid, args):
+        """
+        Endpoint for getting a trained classifier, so that clients can make
+        predictions with it themselves
+
+        :param sid: Socket IO session ID, automatically given by connection
+        :param args: arguments from client. This should be in the format
+                     {
+                         'uuid': client UUID
+                         'type': kind of classifier, 'p300' or 'left_right'
+                         'version': version of the classifier the client
+                                    already has, if any
+                     }
+        :returns: the classifier in the format
+                  {
+                      'uuid': client UUID
+                      'type': kind of classifier
+                      'version': version of the classifier
+                      'model': pickled classifier, left out if the client
+                               already has this version
+                  }
+                  or {'uuid': client UUID, 'error': reason} if there is no
+                  trained classifier
+        """
+        uuid = args['uuid']
+        name = args['type']
+        if not is_valid_uuid(uuid):
+            return {'uuid': uuid, 'error': 'Invalid UUID'}
+        if name not in SERVICES:
+            return {'uuid': uuid, 'error': f'Unknown classifier type {name}'}
+
+        service = self._get_service(name)
+
+        version = service.get_classifier_version(uuid)
+        if version is None:
+            return {'uuid': uuid, 'error': 'No trained classifier'}
+
+        results = {
+            'uuid': uuid,
+            'type': name,
+            'version': version
+        }
+        if args.get('version') != version:
+            model = await service.dump_classifier(uuid)
+            if model is None:
+                return {'uuid': uuid, 'error': 'No trained classifier'}
+            results['model'] = model
         return results
 
     #
@@ -205,12 +503,20 @@ class NeurostackServer:
 
     def initialize_handlers(self):
         """Initialize handlers for server"""
+        # start loading classifiers of users as they connect
+        self.sio.on("connect", self.connect)
+
         # train classifier and predict
         self.sio.on("p300_train", self.p300_train)
         self.sio.on("p300_predict", self.p300_predict)
+        self.sio.on("p300_predict_batch", self.p300_predict_batch)
 
         self.sio.on("left_right_train", self.left_right_train)
         self.sio.on("left_right_predict", self.left_right_predict)
+        self.sio.on("left_right_predict_batch", self.left_right_predict_batch)
+
+        # send trained classifiers to clients
+        self.sio.on("get_classifier", self.get_classifier)
 
         # for testing
         self.sio.on("test_train", self.test_train)
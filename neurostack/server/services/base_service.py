@@ -1,20 +1,56 @@
+import asyncio
 import os
+import pickle
 from abc import ABC, abstractmethod
 
-import numpy as np
+from server.services.model_cache import ModelCache, estimate_size
+from server.services.model_store import ModelStore
+from server.services.training_store import TrainingStore
 
-import server.ml as ml
+# default directory to keep classifiers and training data in
+DATA_DIR = os.path.join(os.path.expanduser('~'), '.neurostack')
 
 
 class BaseService(ABC):
 
-    def __init__(self):
+    # train again every this many samples
+    retrain_interval = 10
+
+    # services that can update a classifier with new samples without training
+    # it from scratch (see partial_fit) train it from scratch every this many
+    # samples instead
+    refit_interval = None
+
+    # name of the classifier pipeline, saved with each classifier
+    pipeline = None
+
+    # name of the first step of the pipelines trained by older servers, which
+    # saved every kind of classifier to the same file
+    legacy_step = None
+
+    def __init__(self, data_dir=DATA_DIR, legacy_dir=None):
         """
         Initialize fields that all services should have
+
+        :param data_dir: directory to keep classifiers and training data in,
+                         so that they are kept when the server restarts. Each
+                         service keeps its own in a subdirectory named after
+                         it
+        :param legacy_dir: directory older servers saved classifiers in, if
+                           any. Users' classifiers there of this service's
+                           kind are imported when first needed
         """
-        self.clf = {}       # classifiers with UUID as key
-        self.inputs = {}    # training data with UUID as key
-        self.targets = {}
+        name = type(self).__name__
+
+        # saved classifiers, and recently used classifiers with UUID as key
+        self.store = ModelStore(os.path.join(data_dir, 'clfs', name),
+                                legacy_root=legacy_dir,
+                                legacy_filter=self.is_legacy_classifier)
+        self.clf = ModelCache(self.store.load)
+
+        # training data with UUID as key
+        self.training = TrainingStore(
+            os.path.join(data_dir, 'training_data', name))
 
     @abstractmethod
     def train(self, *args):
@@ -38,23 +74,147 @@ class BaseService(ABC):
         """
         raise NotImplementedError
 
+    @staticmethod
+    @abstractmethod
+    def fit(X, y):
+        """
+        Trains and scores a classifier. Services set this to a module-level
+        function, so that it can be run in a worker process.
+
+        :param X: training data
+        :param y: labels of training data
+        :return: (classifier, accuracy)
+        """
+        raise NotImplementedError
+
+    # Services that can update a classifier with new samples set this to a
+    # module-level function partial_fit(clf, X, y) -> (classifier, accuracy),
+    # which updates clf with the samples at the end of X and y that it has
+    # not been trained on (or returns None if it cannot)
+    partial_fit = None
+
     #
     #   Helper methods
     #
 
-    def save_classifier(self, uuid, model):
+    def retrain_due(self, uuid):
+        """
+        Check if enough new training data has come in to train the client's
+        classifier again
+
+        :param uuid: client UUID
+        :return: True if the classifier should be trained
+        """
+        num_samples = self.training.num_samples(uuid)
+        return num_samples >= self.retrain_interval and \
+            num_samples % self.retrain_interval == 0
+
+    def refit_due(self, uuid):
+        """
+        Check if the client's classifier should be trained from scratch, rather
+        than updated with the new data (see partial_fit)
+
+        :param uuid: client UUID
+        :return: True if the classifier should be trained from scratch
+        """
+        if self.partial_fit is None or \
+                self.get_classifier_version(uuid) is None:
+            return True
+        return self.training.num_samples(uuid) % self.refit_interval == 0
+
+    def update_classifier(self, uuid, clf=None):
+        """
+        Update the client's classifier with the training data it has not been
+        trained on, if the service supports it (see partial_fit)
+
+        :param uuid: client UUID
+        :param clf: classifier to update. Defaults to the cached classifier,
+                    which is replaced by the updated one; if it is not cached,
+                    it is not updated, rather than waiting for it to load
+        :return: (updated classifier, accuracy), or None if the classifier
+                 was not updated
+        """
+        if self.partial_fit is None:
+            return None
+
+        cached = clf is None
+        if cached:
+            if uuid not in self.clf:
+                return None
+            clf = self.clf[uuid]
+
+        updated = self.partial_fit(clf, *self.get_training_set(uuid))
+        if updated is not None and cached:
+            # the updated classifier is the same size as the old one
+            self.clf.put(uuid, updated[0], self.clf.get_size(uuid))
+        return updated
+
+    async def update_classifier_async(self, uuid, clf=None):
+        """
+        Update the client's classifier like update_classifier, in a worker
+        thread, so that the event loop is free to serve other clients
+
+        :param uuid: client UUID
+        :param clf: classifier to update. Defaults to the cached classifier,
+                    which is replaced by the updated one unless it was
+                    replaced while updating
+        :return: (updated classifier, accuracy), or None if the classifier
+                 was not updated
+        """
+        if self.partial_fit is None:
+            return None
+
+        cached = clf is None
+        if cached:
+            if uuid not in self.clf:
+                return None
+            clf = self.clf[uuid]
+
+        X, y = self.get_training_set(uuid)
+        updated = await asyncio.get_event_loop().run_in_executor(
+            None, self.partial_fit, clf, X, y)
+
+        # if another update finished first, keep its classifier; the next
+        # update catches up on the samples this one had
+        if updated is not None and cached and uuid in self.clf and \
+                self.clf[uuid] is clf:
+            self.clf.put(uuid, updated[0], self.clf.get_size(uuid))
+        return updated
+
+    def is_legacy_classifier(self, model):
+        """
+        Check if a classifier saved by an older server is of this service's
+        kind (see legacy_step)
+
+        :param model: classifier
+        :return: True if it is
         """
-        Save classifier for client with given UUID into clf folder
+        steps = getattr(model, 'steps', None)
+        return bool(steps) and steps[0][0] == self.legacy_step
+
+    def get_training_set(self, uuid):
+        """
+        Get all the training data saved for client with given UUID
+
+        :param uuid: client UUID
+        :return: (inputs, targets) as arrays
+        """
+        return self.training.get(uuid)
+
+    def save_classifier(self, uuid, model, acc=None, num_samples=None):
+        """
+        Save a new version of the classifier for client with given UUID into
+        clf folder. The classifier is written in the background.
 
         :param uuid: client UUID
         :param model:
+        :param acc: accuracy of classifier, saved with it
+        :param num_samples: size of training set, saved with it
         :return: None
         """
-        if not os.path.exists('clfs'):
-            os.makedirs('clfs')
-
-        self.clf[uuid] = model
-        ml.save(f'clfs/{uuid}', self.clf[uuid])
+        self.store.save(uuid, model, pipeline=self.pipeline, acc=acc,
+                        num_samples=num_samples)
+        self.clf.put(uuid, model, estimate_size(model))
 
     def load_classifier(self, uuid):
         """
@@ -63,14 +223,55 @@ class BaseService(ABC):
         :param uuid: client UUID
         :return: True if classifier is successfully loaded, else False
         """
-        try:
-            if self.clf.get(uuid) is None:
-                self.clf[uuid] = ml.load(f'clfs/{uuid}')
-            return True
-
-        except FileNotFoundError:
+        if self.clf.load(uuid) is None:
             print(f'Cannot load classifier')
             return False
+        return True
+
+    async def load_classifier_async(self, uuid):
+        """
+        Load classifier for client with given UUID into self.clf, reading it
+        from disk in a worker thread if it is not cached
+
+        :param uuid: client UUID
+        :return: the classifier, or None if it cannot be loaded
+        """
+        return await self.clf.load_async(uuid)
+
+    def prefetch_classifier(self, uuid):
+        """
+        Start loading classifier for client with given UUID into self.clf in
+        the background, eg. when the client becomes active
+
+        :param uuid: client UUID
+        :return: None
+        """
+        self.clf.prefetch(uuid)
+
+    def get_classifier_version(self, uuid):
+        """
+        Get the version of the saved classifier for client with given UUID,
+        which changes every time the classifier is saved
+
+        :param uuid: client UUID
+        :return: version, or None if there is no saved classifier
+        """
+        return self.store.get_version(uuid)
+
+    async def dump_classifier(self, uuid):
+        """
+        Get the latest classifier for client with given UUID, pickled. The
+        classifier is loaded and pickled in a worker thread.
+
+        :param uuid: client UUID
+        :return: pickled classifier as bytes, or None if there is no
+                 classifier
+        """
+        clf = await self.clf.load_async(uuid)
+        if clf is None:
+            return None
+        return await asyncio.get_event_loop().run_in_executor(
+            None, pickle.dumps, clf)
 
     def save_inputs(self, uuid, data, labels):
         """
@@ -81,9 +282,4 @@ class BaseService(ABC):
         :param labels:
         :return: None
         """
-        # initialize if empty
-        self.inputs[uuid] = self.inputs.get(uuid, [])
-        self.targets[uuid] = self.targets.get(uuid, [])
-
-        self.inputs[uuid].append(np.array(data))
-        self.targets[uuid].append(np.array(labels))
+        self.training.append(uuid, data, labels)
@@ -57,19 +57,58 @@ class FeatureSelector(BaseEstimator, TransformerMixin):
         return X[:, self.features]
 
 
+def fit(X, y):
+    """
+    Trains and scores a left/right classifier. This is a module-level function
+    so that it can be run in a worker process (see server.training).
+
+    :param X: (samples x channels x time) training data
+    :param y: labels of training data
+    :returns: (classifier, accuracy on held-out data)
+    """
+    # normalize and split data
+    X = stats.zscore(X, axis=2)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3)
+
+    # build model
+    fbcsp = create_fbcsp(6, n_jobs=2)
+    svc = SVC(kernel="linear")
+    clf = Pipeline([
+        ("fbcsp", fbcsp),
+        ("fselector", FeatureSelector(features=[6, 7])),
+        ("classifier", svc)
+    ])
+
+    # train and score model
+    clf.fit(X_train, y_train)
+    score = clf.score(X_test, y_test)
+
+    return clf, score
+
+
 class LeftRightService(BaseService):
 
-    def train(self, uuid, data, left):
+    # train again every this many samples
+    retrain_interval = 5
+
+    pipeline = 'fbcsp_svc'
+    legacy_step = 'fbcsp'
+    fit = staticmethod(fit)
+
+    def train(self, uuid, data, left, timestamp=None):
         """
-        Method to make a prediction with a given classifier
+        Method to save training data, and train the classifier (in this
+        thread) if enough new data has come in
 
         :param uuid: client UUID
         :param data: EEG data to use for training
         :param left: True or False
+        :param timestamp: timestamp of data, passed back with the results
         :returns: The current model accuracy in the below format. If there is not
                   enough data, then the 'acc' field will be None (model not trained)
                   {
                       'uuid': client UUID
+                      'timestamp': timestamp of data
                       'acc': current training accuracy
                   }
         """
@@ -81,54 +120,59 @@ class LeftRightService(BaseService):
             'acc': None
         }
 
-        if len(self.targets[uuid]) % 5 == 0 and len(self.targets[uuid]) >= 5:
-            # load, normalize, and split data
-            X = np.array(self.inputs[uuid])
-            X = stats.zscore(X, axis=2)
-            y = np.array(self.targets[uuid])
-
-            X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3)
-
-            # build model
-            fbcsp = create_fbcsp(6, n_jobs=2)
-            svc = SVC(kernel="linear")
-            clf = Pipeline([
-                ("fbcsp", fbcsp),
-                ("fselector", FeatureSelector(features=[6, 7])),
-                ("classifier", svc)
-            ])
-
-            # train, score, and save model
-            clf.fit(X_train, y_train)
-            score = clf.score(X_test, y_test)
-            self.save_classifier(uuid, clf)
-
-            results['acc'] = score
+        if self.retrain_due(uuid):
+            X, y = self.get_training_set(uuid)
+            clf, results['acc'] = self.fit(X, y)
+            self.save_classifier(uuid, clf, acc=results['acc'],
+                                 num_samples=len(y))
 
         return results
 
-    def predict(self, uuid, data):
+    def predict(self, uuid, data, timestamp=None, clf=None):
         """
         Method to make a prediction with a given classifier
 
         :param uuid: client UUID
         :param data: EEG data to make prediction on
+        :param timestamp: timestamp of data, passed back with the results
+        :param clf: classifier to use, eg. as returned by
+                    load_classifier_async. Defaults to loading the client's
+                    classifier
         :return: Results of prediction
         """
-        # prepare data for prediction
-        data = np.array(data)
-        data = np.expand_dims(data, axis=0)
+        results = self.predict_batch(uuid, np.expand_dims(data, axis=0),
+                                     [timestamp], clf)
+        return results if isinstance(results, str) else results[0]
+
+    def predict_batch(self, uuid, data, timestamps=None, clf=None):
+        """
+        Method to make predictions for a batch of events with one call to the
+        classifier
 
-        # load classifier if not already loaded
-        if self.load_classifier(uuid):
-            left = self.clf[uuid].predict(data)[0]
-        else:
+        :param uuid: client UUID
+        :param data: (events x channels x samples) EEG data to make
+                     predictions on
+        :param timestamps: timestamps of events, passed back with the results
+        :param clf: classifier to use, eg. as returned by
+                    load_classifier_async. Defaults to loading the client's
+                    classifier
+        :return: list of results of prediction, one per event
+        """
+        # prepare data for prediction
+        data = np.asarray(data)
+        if timestamps is None:
+            timestamps = [None] * len(data)
+
+        # load classifier if none was given
+        if clf is None and self.load_classifier(uuid):
+            clf = self.clf[uuid]
+        if clf is None:
             return 'Cannot load classifier and make prediction'
+        lefts = clf.predict(data).tolist()
 
         # TODO: include 'score' (currently we do not have a confidence method)
-        results = {
+        return [{
             'uuid': uuid,
             'timestamp': timestamp,
             'left': left
-        }
-        return results
+        } for left, timestamp in zip(lefts, timestamps)]
@@ -0,0 +1,237 @@
+"""
+A bounded, least-recently-used cache of classifiers. The server can host many
+more users than are active at once, so only the classifiers of recently active
+users are kept in memory. Classifiers can be loaded into the cache in a
+background thread before they are needed, so that loading them from disk does
+not hold up the event loop.
+"""
+import asyncio
+import collections
+import sys
+import types
+
+import numpy as np
+
+# default budget of the cache: most classifiers, and most bytes
+MAX_CACHED_MODELS = 256
+MAX_CACHED_BYTES = 512 * 1024 * 1024
+
+
+class ModelCache:
+
+    def __init__(self, loader, max_entries=MAX_CACHED_MODELS,
+                 max_bytes=MAX_CACHED_BYTES):
+        """
+        Initializes an empty cache
+
+        :param loader: function that loads the model for a key, returning
+                       (model, size in bytes). It should raise
+                       FileNotFoundError if there is no model for the key. It
+                       is called from a worker thread for prefetches
+        :param max_entries: most models to keep
+        :param max_bytes: most bytes of models to keep. A model bigger than
+                          this is not cached at all
+        """
+        self.loader = loader
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # models, with the key as key, as (model, size), least recently used
+        # first
+        self._models = collections.OrderedDict()
+        self.nbytes = 0
+
+        # loads in progress, with the key as key
+        self._loading = {}
+
+        # statistics: lookups with get (or load) that found the model in the
+        # cache, or did not; models read from disk (in any thread); and
+        # models evicted to stay within budget
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """Number of models in the cache"""
+        return len(self._models)
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def __getitem__(self, key):
+        """Gets a model (without counting a hit), marking it recently used"""
+        self._models.move_to_end(key)
+        return self._models[key][0]
+
+    def __setitem__(self, key, model):
+        self.put(key, model)
+
+    def get(self, key):
+        """
+        Gets a model, if it is in the cache, marking it recently used
+
+        :param key: key of model
+        :return: model, or None if it is not in the cache
+        """
+        if key not in self._models:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return self[key]
+
+    def put(self, key, model, size=None):
+        """
+        Adds a model to the cache, or replaces it, evicting the least recently
+        used models to stay within budget
+
+        :param key: key of model
+        :param model: model to add
+        :param size: size of model in bytes, defaults to an estimate (see
+                     estimate_size)
+        :return: None
+        """
+        if size is None:
+            size = estimate_size(model)
+
+        self.pop(key)
+        if size > self.max_bytes:
+            return
+
+        self._models[key] = (model, size)
+        self.nbytes += size
+
+        while len(self._models) > self.max_entries or \
+                self.nbytes > self.max_bytes:
+            _, (_, evicted_size) = self._models.popitem(last=False)
+            self.nbytes -= evicted_size
+            self.evictions += 1
+
+    def get_size(self, key):
+        """Returns the size of a model in the cache in bytes, or None"""
+        if key not in self._models:
+            return None
+        return self._models[key][1]
+
+    def pop(self, key):
+        """Removes a model from the cache, returning it (or None)"""
+        if key not in self._models:
+            return None
+
+        model, size = self._models.pop(key)
+        self.nbytes -= size
+        return model
+
+    def load(self, key):
+        """
+        Gets a model, loading it in this thread if it is not in the cache
+
+        :param key: key of model
+        :return: model, or None if there is no model for key
+        """
+        model = self.get(key)
+        if model is None:
+            try:
+                model, size = self.loader(key)
+            except FileNotFoundError:
+                return None
+            self.loads += 1
+            self.put(key, model, size)
+
+        return model
+
+    async def load_async(self, key):
+        """
+        Gets a model, loading it in a worker thread if it is not in the cache.
+        Loads of the same key at the same time share one read. This is not
+        counted as a hit or miss, since it is used to make sure a model is in
+        the cache before it is looked up.
+
+        :param key: key of model
+        :return: model, or None if there is no model for key
+        """
+        if key in self._models:
+            return self[key]
+
+        if key not in self._loading:
+            self._loading[key] = asyncio.get_event_loop().create_task(
+                self._load_in_background(key))
+        return await asyncio.shield(self._loading[key])
+
+    def prefetch(self, key):
+        """
+        Starts loading a model in the background, if it is not in the cache
+        (eg. when a user becomes active, before they ask for a prediction)
+
+        :param key: key of model
+        :return: None
+        """
+        if key not in self._models and key not in self._loading:
+            self._loading[key] = asyncio.get_event_loop().create_task(
+                self._load_in_background(key))
+
+    async def _load_in_background(self, key):
+        """Loads a model in a worker thread and adds it to the cache"""
+        loop = asyncio.get_event_loop()
+        try:
+            model, size = await loop.run_in_executor(None, self.loader, key)
+        except FileNotFoundError:
+            return None
+        finally:
+            self._loading.pop(key, None)
+        self.loads += 1
+
+        # the model may have been replaced (eg. retrained) while loading
+        if key in self._models:
+            return self[key]
+
+        self.put(key, model, size)
+        return model
+
+    def stats(self):
+        """
+        Returns statistics of the cache
+
+        :return: dict with the number of 'entries', their size in 'bytes', and
+                 the number of 'hits', 'misses', 'loads' and 'evictions' so
+                 far
+        """
+        return {
+            'entries': len(self._models),
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'loads': self.loads,
+            'evictions': self.evictions
+        }
+
+
+def estimate_size(model):
+    """
+    Estimates the size of a model in bytes from the NumPy arrays in it, which
+    take up nearly all of a trained classifier, without pickling it
+
+    :param model: model, eg. a scikit-learn estimator or pipeline
+    :return: estimated size in bytes
+    """
+    seen = set()
+
+    def size_of(obj):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+
+        if isinstance(obj, np.ndarray):
+            return obj.nbytes
+        if isinstance(obj, (type, types.ModuleType, types.FunctionType)):
+            return 0
+        if isinstance(obj, dict):
+            return sum(size_of(value) for value in obj.values())
+        if isinstance(obj, (list, tuple, set)):
+            return sum(size_of(item) for item in obj)
+        if hasattr(obj, '__dict__'):
+            return sys.getsizeof(obj) + size_of(vars(obj))
+        return sys.getsizeof(obj)
+
+    return size_of(model)
@@ -0,0 +1,301 @@
+"""
+A versioned store of trained classifiers in a local directory. Every save
+makes a new version of a user's classifier, with metadata about how it was
+trained, and the last few versions are kept. Saves are written in a
+background thread (the newest version is served from memory until it is on
+disk), and each file is written to a temporary file that is then renamed over
+its final name, so a crash mid-write never leaves a corrupt classifier.
+
+Classifiers are saved with joblib, so that the NumPy arrays in them can be
+memory-mapped when loaded instead of read and unpickled. Classifiers saved by
+older versions of the server, as pickles at {legacy_root}/{uuid}, are imported
+as version 1 the first time a user's classifiers are looked up.
+"""
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import joblib
+
+import server.ml as ml
+from server.services.model_cache import estimate_size
+from utils import is_valid_uuid
+
+# default number of versions kept per user
+MAX_VERSIONS = 5
+
+
+class ModelStore:
+
+    def __init__(self, root, max_versions=MAX_VERSIONS, legacy_root=None,
+                 legacy_filter=None):
+        """
+        Initializes the store. Nothing is read until it is needed.
+
+        :param root: directory to keep classifiers in. Each kind of classifier
+                     needs a directory of its own
+        :param max_versions: most versions to keep per user. Older versions
+                             are deleted after a new one is written
+        :param legacy_root: directory older servers saved classifiers in, if
+                            any. A user's classifier there is imported if they
+                            have no versions
+        :param legacy_filter: function that returns True if a classifier in
+                              legacy_root is of the kind kept in this store,
+                              since older servers saved every kind of
+                              classifier to the same file. Defaults to
+                              importing every classifier
+        """
+        self.root = root
+        self.max_versions = max_versions
+        self.legacy_root = legacy_root
+        self.legacy_filter = legacy_filter
+
+        # newest version number, with the UUID as key
+        self._latest = {}
+
+        # versions that are not written yet, with the UUID as key, as
+        # (version, model, metadata)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        # one thread writes versions in the order they were saved
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    #
+    # Paths
+    #
+
+    def _dir(self, uuid):
+        # the UUID comes from the client, so make sure it is a file name
+        if not is_valid_uuid(uuid):
+            raise ValueError(f"Invalid UUID {uuid!r}")
+        return os.path.join(self.root, uuid)
+
+    def _model_path(self, uuid, version):
+        return os.path.join(self._dir(uuid), f'{version}.joblib')
+
+    def _metadata_path(self, uuid, version):
+        return os.path.join(self._dir(uuid), f'{version}.json')
+
+    def _written_versions(self, uuid):
+        """
+        Lists the versions of a user's classifier on disk, oldest first. A
+        version is complete once its metadata is written, which is done after
+        its classifier.
+        """
+        try:
+            names = os.listdir(self._dir(uuid))
+        except FileNotFoundError:
+            return []
+
+        return sorted(int(name[:-len('.json')]) for name in names
+                      if name.endswith('.json') and
+                      name[:-len('.json')].isdigit())
+
+    #
+    # Saving
+    #
+
+    def save(self, uuid, model, **metadata):
+        """
+        Saves a new version of a user's classifier. Returns immediately; the
+        classifier is written in the background.
+
+        :param uuid: client UUID
+        :param model: classifier to save
+        :param metadata: information about the classifier to save with it (eg.
+                         pipeline, acc, num_samples), which must be JSON
+                         serializable
+        :return: version number of the new classifier
+        """
+        with self._lock:
+            version = self._get_latest(uuid) + 1
+            self._latest[uuid] = version
+
+            metadata = dict(metadata, version=version, saved=time.time())
+            self._pending[uuid] = (version, model, metadata)
+
+        self._writer.submit(self._write, uuid, version, model, metadata)
+        return version
+
+    def _write(self, uuid, version, model, metadata):
+        """Writes a version to disk and deletes versions that are too old"""
+        try:
+            os.makedirs(self._dir(uuid), exist_ok=True)
+            write_atomic(self._model_path(uuid, version),
+                         lambda f: joblib.dump(model, f))
+            write_atomic(self._metadata_path(uuid, version),
+                         lambda f: f.write(json.dumps(metadata).encode()))
+        except Exception as e:
+            # the version is still served from memory until a newer one is
+            # written
+            print(f"Cannot save classifier: {e}")
+            return
+
+        with self._lock:
+            pending = self._pending.get(uuid)
+            if pending is not None and pending[0] == version:
+                del self._pending[uuid]
+
+        for old in self._written_versions(uuid)[:-self.max_versions]:
+            for path in (self._metadata_path(uuid, old),
+                         self._model_path(uuid, old)):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"Cannot delete old classifier: {e}")
+
+    def flush(self):
+        """Waits until every saved version is written"""
+        self._writer.submit(lambda: None).result()
+
+    def close(self):
+        """Writes every saved version and stops the writer thread"""
+        self._writer.shutdown(wait=True)
+
+    #
+    # Loading
+    #
+
+    def _get_latest(self, uuid):
+        """Returns the newest version number of a user's classifier, or 0"""
+        if uuid not in self._latest:
+            versions = self._written_versions(uuid)
+            if not versions and self._import_legacy(uuid):
+                versions = [1]
+            self._latest[uuid] = versions[-1] if versions else 0
+        return self._latest[uuid]
+
+    def _import_legacy(self, uuid):
+        """
+        Imports a user's classifier saved by an older server as version 1
+
+        :param uuid: client UUID
+        :return: True if a classifier was imported
+        """
+        if self.legacy_root is None or not is_valid_uuid(uuid):
+            return False
+
+        path = os.path.join(self.legacy_root, uuid)
+        try:
+            model = ml.load(path)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"Cannot import classifier saved by an older server: {e}")
+            return False
+
+        if self.legacy_filter is not None and not self.legacy_filter(model):
+            return False
+
+        metadata = {'version': 1, 'saved': os.path.getmtime(path),
+                    'legacy': True}
+        try:
+            os.makedirs(self._dir(uuid), exist_ok=True)
+            write_atomic(self._model_path(uuid, 1),
+                         lambda f: joblib.dump(model, f))
+            write_atomic(self._metadata_path(uuid, 1),
+                         lambda f: f.write(json.dumps(metadata).encode()))
+        except OSError as e:
+            print(f"Cannot import classifier saved by an older server: {e}")
+            return False
+        return True
+
+    def get_version(self, uuid):
+        """
+        Gets the version of a user's newest classifier
+
+        :param uuid: client UUID
+        :return: version number, or None if there is no classifier
+        """
+        with self._lock:
+            version = self._get_latest(uuid)
+        return version or None
+
+    def load(self, uuid, version=None, mmap=True):
+        """
+        Loads a user's classifier
+
+        :param uuid: client UUID
+        :param version: version to load, defaults to the newest
+        :param mmap: if True, memory-map the arrays in the classifier (read
+                     only) instead of reading them into memory
+        :return: (classifier, size of classifier in bytes, as saved or
+                 estimated if it is not written yet)
+        :raises FileNotFoundError: if there is no such classifier
+        """
+        with self._lock:
+            if version is None:
+                version = self._get_latest(uuid)
+            pending = self._pending.get(uuid)
+
+        if pending is not None and pending[0] == version:
+            return pending[1], estimate_size(pending[1])
+
+        path = self._model_path(uuid, version)
+        model = joblib.load(path, mmap_mode='r' if mmap else None)
+        return model, os.path.getsize(path)
+
+    def get_metadata(self, uuid, version=None):
+        """
+        Gets the metadata saved with a user's classifier
+
+        :param uuid: client UUID
+        :param version: version, defaults to the newest
+        :return: dict of metadata, or None if there is no such version
+        """
+        with self._lock:
+            if version is None:
+                version = self._get_latest(uuid)
+            pending = self._pending.get(uuid)
+
+        if pending is not None and pending[0] == version:
+            return dict(pending[2])
+
+        try:
+            with open(self._metadata_path(uuid, version)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def get_versions(self, uuid):
+        """
+        Gets the metadata of every version of a user's classifier that is
+        kept, oldest first
+
+        :param uuid: client UUID
+        :return: list of dicts of metadata
+        """
+        with self._lock:
+            pending = self._pending.get(uuid)
+
+        versions = self._written_versions(uuid)
+        if pending is not None and pending[0] not in versions:
+            versions.append(pending[0])
+
+        metadata = (self.get_metadata(uuid, version) for version in versions)
+        return [m for m in metadata if m is not None]
+
+
+def write_atomic(path, write):
+    """
+    Writes a file by writing a temporary file next to it and renaming it over
+    path, so that path is never partly written
+
+    :param path: path of file
+    :param write: function that writes the contents to a binary file object
+    :return: None
+    """
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
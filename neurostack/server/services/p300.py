@@ -1,27 +1,90 @@
+import copy
+
 import numpy as np
 from sklearn.model_selection import train_test_split
 
 import server.ml as ml
 from server.services.base_service import BaseService
 
+# Note in Barachant's ipynb, 'erpcov_mdm' performed best. 'vect_lr' is the
+# universal one for EEG data, but is trained from scratch each time; shrinkage
+# LDA performs about as well, and can be updated with each new sample.
+PIPELINE = 'incremental_lda'
+
+
+def fit(X, y):
+    """
+    Trains and scores a P300 classifier. This is a module-level function so
+    that it can be run in a worker process (see server.training).
+
+    :param X: (samples x channels x time) training data
+    :param y: labels of training data
+    :returns: (classifier, accuracy on held-out data)
+    """
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3)
+
+    # test on the held-out data, then train on it, so that the classifier has
+    # been trained on all of X (see partial_fit)
+    clf = ml.ml_classifier(X_train, y_train, classifier=None, pipeline=PIPELINE)
+    clf.partial_fit(X_test, y_test)
+
+    return clf, clf.prequential_score()
+
+
+def partial_fit(clf, X, y):
+    """
+    Updates a P300 classifier with the samples at the end of the training set
+    that it has not been trained on, in time proportional to the number of
+    new samples
+
+    :param clf: classifier trained by fit (it is not changed)
+    :param X: (samples x channels x time) training data, of which the
+              classifier has been trained on the first samples
+    :param y: labels of training data
+    :returns: (updated classifier, accuracy on samples it was tested on before
+              training on them since the last fit), or None if clf cannot be
+              updated (eg. it was trained by an older version of fit)
+    """
+    if not isinstance(clf, ml.IncrementalLDA):
+        return None
+
+    new = slice(clf.n_samples_seen_, None)
+    clf = copy.copy(clf).partial_fit(X[new], y[new])
+    return clf, clf.prequential_score()
+
 
 class P300Service(BaseService):
 
-    def train(self, uuid, data, p300):
+    # save the classifier (updated with every sample) every this many samples,
+    # and train it from scratch every refit_interval samples
+    retrain_interval = 10
+    refit_interval = 100
+
+    pipeline = PIPELINE
+    legacy_step = 'vectorizer'
+    fit = staticmethod(fit)
+    partial_fit = staticmethod(partial_fit)
+
+    def train(self, uuid, data, p300, timestamp=None):
         """
-        Method to make a prediction with a given classifier
+        Method to save training data and update the classifier with it, and
+        save the classifier (training it from scratch in this thread, if due)
+        if enough new data has come in
 
         :param uuid: client UUID
         :param data: EEG data to use for training
         :param p300: True or False
-        :returns: None if there is not enough data for training, or the current
-                  model accuracy in the format
+        :param timestamp: timestamp of data, passed back with the results
+        :returns: the current model accuracy in the format below. If the
+                  model was not trained, 'acc' is None
                   {
                       'uuid': client UUID
+                      'timestamp': timestamp of data
                       'acc': current training accuracy
                   }
         """
         self.save_inputs(uuid, data, p300)
+        updated = self.update_classifier(uuid)
 
         results = {
             'uuid': uuid,
@@ -29,53 +92,71 @@ class P300Service(BaseService):
             'acc': None
         }
 
-        if len(self.targets[uuid]) % 10 == 0 and len(self.targets[uuid]) >= 10:
-            X = np.array(self.inputs[uuid])
-            y = np.array(self.targets[uuid])
-
-            X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3)
-
-            # Note in Barachant's ipynb, 'erpcov_mdm' performed best. 'vect_lr' is the
-            # universal one for EEG data.
-
-            # train, score, and save
-            clf = ml.ml_classifier(X_train, y_train, classifier=None, pipeline='vect_lr')
-            acc = clf.score(X_test, y_test)
-            self.save_classifier(uuid, clf)
-
-            results['acc'] = acc
+        if self.retrain_due(uuid):
+            X, y = self.get_training_set(uuid)
+            if updated is None or self.refit_due(uuid):
+                clf, results['acc'] = self.fit(X, y)
+            else:
+                clf, results['acc'] = updated
+            self.save_classifier(uuid, clf, acc=results['acc'],
+                                 num_samples=len(y))
 
         return results
 
-    def predict(self, uuid, data):
+    def predict(self, uuid, data, timestamp=None, clf=None):
         """
         Method to make a prediction with a given classifier
 
         :param uuid: client UUID
         :param data: EEG data to make prediction on
+        :param timestamp: timestamp of data, passed back with the results
+        :param clf: classifier to use, eg. as returned by
+                    load_classifier_async. Defaults to loading the client's
+                    classifier
         :returns: prediction results in the format
                   {
                       'uuid': client UUID
+                      'timestamp': timestamp of data
                       'p300': True or False result of model P300 prediction
                       'score': confidence value of prediction between 0 and 1
                   }
         """
-        # prepare data for prediction
-        data = np.array(data)
-        data = np.expand_dims(data, axis=0)
+        results = self.predict_batch(uuid, np.expand_dims(data, axis=0),
+                                     [timestamp], clf)
+        return results if isinstance(results, str) else results[0]
+
+    def predict_batch(self, uuid, data, timestamps=None, clf=None):
+        """
+        Method to make predictions for a batch of events with one call to the
+        classifier
 
-        # load classifier if not already loaded
-        if self.load_classifier(uuid):
-            p300 = self.clf[uuid].predict(data)[0]
-        else:
+        :param uuid: client UUID
+        :param data: (events x channels x samples) EEG data to make
+                     predictions on
+        :param timestamps: timestamps of events, passed back with the results
+        :param clf: classifier to use, eg. as returned by
+                    load_classifier_async. Defaults to loading the client's
+                    classifier
+        :returns: list of prediction results, one per event, in the format
+                  returned by predict
+        """
+        # prepare data for prediction
+        data = np.asarray(data)
+        if timestamps is None:
+            timestamps = [None] * len(data)
+
+        # load classifier if none was given
+        if clf is None and self.load_classifier(uuid):
+            clf = self.clf[uuid]
+        if clf is None:
             return 'Cannot load classifier and make prediction'
+        p300s = clf.predict(data)
 
         # TODO: currently we do not have a confidence method
         score = 1
-        results = {
+        return [{
             'uuid': uuid,
             'timestamp': timestamp,
             'p300': int(p300),
             'score': score
-        }
-        return results
+        } for p300, timestamp in zip(p300s, timestamps)]
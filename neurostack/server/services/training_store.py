@@ -0,0 +1,274 @@
+"""
+Training data for each user, kept in preallocated arrays that double in size
+when they fill up, so that adding an epoch is a copy into the next free row
+and the training set is always one contiguous array. The arrays can be
+memory-mapped files in a directory, in which case they are reopened when the
+server restarts, so users do not have to calibrate again. Files are only opened
+when a user's training set is needed, and only the training sets of recently
+active users are kept open. The number of epochs in each training set is saved
+in a background thread.
+"""
+import collections
+import concurrent.futures
+import json
+import os
+import threading
+
+import numpy as np
+
+from server.services.model_store import write_atomic
+from utils import is_valid_uuid
+
+# number of epochs the arrays of a new user have room for
+INITIAL_CAPACITY = 16
+
+# default number of training sets kept open, if they are kept in files
+MAX_OPEN_SETS = 128
+
+
+class _TrainingSet:
+
+    def __init__(self, inputs, targets, count):
+        """
+        :param inputs: (capacity x ...) array of epochs
+        :param targets: (capacity x ...) array of labels
+        :param count: number of rows in use
+        """
+        self.inputs = inputs
+        self.targets = targets
+        self.count = count
+
+
+class TrainingStore:
+
+    def __init__(self, root=None, max_open=MAX_OPEN_SETS):
+        """
+        Initializes the store. Nothing is read until it is needed.
+
+        :param root: directory to keep training sets in, as memory-mapped
+                     files, or None to keep them in memory only
+        :param max_open: most training sets to keep open, if they are kept in
+                         files. The least recently used are closed
+        """
+        self.root = root
+        self.max_open = max_open
+
+        # open training sets with the UUID as key, least recently used first
+        self._sets = collections.OrderedDict()
+
+        # training sets whose number of epochs is not saved yet, with the
+        # UUID as key
+        self._unsaved = {}
+        self._lock = threading.Lock()
+
+        # one thread saves the number of epochs of each training set
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    #
+    # Files
+    #
+
+    def _path(self, uuid, name):
+        # the UUID comes from the client, so make sure it is a file name
+        if not is_valid_uuid(uuid):
+            raise ValueError(f"Invalid UUID {uuid!r}")
+        return os.path.join(self.root, uuid, name)
+
+    def _open(self, uuid):
+        """Opens the files of a training set saved in root"""
+        with open(self._path(uuid, 'meta.json')) as f:
+            count = json.load(f)['count']
+
+        inputs = np.load(self._path(uuid, 'inputs.npy'), mmap_mode='r+')
+        targets = np.load(self._path(uuid, 'targets.npy'), mmap_mode='r+')
+        return _TrainingSet(inputs, targets, count)
+
+    def _allocate(self, uuid, name, shape, dtype, rows=None):
+        """
+        Allocates an array, copying rows into the start of it
+
+        :param uuid: client UUID
+        :param name: name of array, 'inputs' or 'targets'
+        :param shape: shape of array
+        :param dtype: dtype of array
+        :param rows: rows in use of the array being replaced, if any
+        :return: the new array
+        """
+        if self.root is None:
+            new = np.empty(shape, dtype=dtype)
+            if rows is not None:
+                new[:len(rows)] = rows
+            return new
+
+        # fill a new file, then move it over the old one, so that the rows
+        # in use are always on disk
+        path = self._path(uuid, f'{name}.npy')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        new = np.lib.format.open_memmap(f'{path}.tmp', mode='w+',
+                                        dtype=dtype, shape=shape)
+        if rows is not None:
+            new[:len(rows)] = rows
+        new.flush()
+        os.replace(f'{path}.tmp', path)
+        return new
+
+    def _save_count(self, uuid):
+        """
+        Saves the number of rows in use of a training set, once the rows are
+        on disk. Runs in the writer thread, until no more rows have been
+        added while saving.
+        """
+        while True:
+            with self._lock:
+                training_set = self._unsaved[uuid]
+                count = training_set.count
+
+            try:
+                training_set.inputs.flush()
+                training_set.targets.flush()
+                write_atomic(self._path(uuid, 'meta.json'),
+                             lambda f: f.write(json.dumps({
+                                 'count': count
+                             }).encode()))
+            except OSError as e:
+                print(f"Cannot save training data of {uuid}: {e}")
+
+            with self._lock:
+                if training_set.count == count:
+                    del self._unsaved[uuid]
+                    return
+
+    def flush(self):
+        """Waits until the number of epochs of every training set is saved"""
+        self._writer.submit(lambda: None).result()
+
+    def close(self):
+        """Finishes saving in the background and stops the writer thread"""
+        self._writer.shutdown(wait=True)
+
+    #
+    # Open training sets
+    #
+
+    def _get(self, uuid):
+        """
+        Gets a user's training set, opening it if it is saved but not open,
+        and marks it recently used
+
+        :param uuid: client UUID
+        :return: the training set, or None if the user has no training data
+        """
+        training_set = self._sets.get(uuid)
+        if training_set is not None:
+            self._sets.move_to_end(uuid)
+            return training_set
+
+        if self.root is None:
+            return None
+
+        # a training set that was closed before its count was saved is still
+        # up to date in memory
+        with self._lock:
+            training_set = self._unsaved.get(uuid)
+
+        if training_set is None:
+            if not os.path.exists(self._path(uuid, 'meta.json')):
+                return None
+            try:
+                training_set = self._open(uuid)
+            except (OSError, ValueError) as e:
+                print(f"Cannot restore training data of {uuid}: {e}")
+                return None
+
+        self._add(uuid, training_set)
+        return training_set
+
+    def _add(self, uuid, training_set):
+        """Adds an open training set, closing the least recently used"""
+        self._sets[uuid] = training_set
+
+        # the files of a training set are closed once nothing uses them
+        if self.root is not None:
+            while len(self._sets) > self.max_open:
+                self._sets.popitem(last=False)
+
+    #
+    # Training data
+    #
+
+    def append(self, uuid, data, labels):
+        """
+        Adds an epoch to a user's training set
+
+        :param uuid: client UUID
+        :param data: epoch of EEG data. Every epoch of a user must have the
+                     same shape
+        :param labels: label of epoch
+        :return: None
+        :raises ValueError: if the epoch does not have the same shape as the
+                            others, or the UUID is not valid
+        """
+        data = np.asarray(data)
+        labels = np.asarray(labels)
+
+        training_set = self._get(uuid)
+        if training_set is None:
+            training_set = _TrainingSet(
+                self._allocate(uuid, 'inputs',
+                               (INITIAL_CAPACITY,) + data.shape, data.dtype),
+                self._allocate(uuid, 'targets',
+                               (INITIAL_CAPACITY,) + labels.shape,
+                               labels.dtype),
+                0)
+            self._add(uuid, training_set)
+
+        elif data.shape != training_set.inputs.shape[1:] or \
+                labels.shape != training_set.targets.shape[1:]:
+            raise ValueError(
+                f"Epoch of shape {data.shape} does not match the training "
+                f"set, of epochs of shape {training_set.inputs.shape[1:]}")
+
+        # out of room, so double the capacity
+        if training_set.count == len(training_set.inputs):
+            inputs, targets = self.get(uuid)
+            capacity = 2 * len(training_set.inputs)
+            training_set.inputs = self._allocate(
+                uuid, 'inputs', (capacity,) + inputs.shape[1:], inputs.dtype,
+                inputs)
+            training_set.targets = self._allocate(
+                uuid, 'targets', (capacity,) + targets.shape[1:],
+                targets.dtype, targets)
+
+        training_set.inputs[training_set.count] = data
+        training_set.targets[training_set.count] = labels
+        training_set.count += 1
+
+        if self.root is not None:
+            with self._lock:
+                saving = uuid in self._unsaved
+                self._unsaved[uuid] = training_set
+            if not saving:
+                self._writer.submit(self._save_count, uuid)
+
+    def num_samples(self, uuid):
+        """Returns the number of epochs in a user's training set"""
+        training_set = self._get(uuid)
+        return 0 if training_set is None else training_set.count
+
+    def get(self, uuid):
+        """
+        Gets a user's training set. The arrays are views of the rows in use,
+        which are not changed by adding more epochs.
+
+        :param uuid: client UUID
+        :return: (inputs, targets) as contiguous arrays
+        :raises KeyError: if the user has no training data
+        """
+        training_set = self._get(uuid)
+        if training_set is None:
+            raise KeyError(uuid)
+        return training_set.inputs[:training_set.count], \
+            training_set.targets[:training_set.count]
+
+    def __contains__(self, uuid):
+        return self._get(uuid) is not None
@@ -0,0 +1,76 @@
+"""
+Runs classifier training in a pool of worker processes, so that fitting a
+model does not hold up the server's event loop (and everyone else's
+predictions). There is at most one fit running, and one waiting, per key (eg.
+per service and user): if more data arrives while a fit is running, the
+waiting fit is replaced with one on the latest data, instead of queueing fits
+on data that is already out of date.
+"""
+import asyncio
+import concurrent.futures
+
+
+class TrainingExecutor:
+
+    def __init__(self, max_workers=None):
+        """
+        Initializes the worker processes
+
+        :param max_workers: number of worker processes, defaults to the
+                            number of CPUs
+        """
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+
+        # keys with a fit running, and the fit waiting to run after it
+        self._running = set()
+        self._waiting = {}
+
+    def submit(self, key, fit, args, callback):
+        """
+        Schedules a fit. Returns immediately.
+
+        :param key: key of the job, eg. (service name, uuid)
+        :param fit: module-level function to run in a worker process
+        :param args: tuple of arguments for fit. These are pickled and sent to
+                     the worker
+        :param callback: coroutine function called with the result of fit
+                         (or the exception it raised) once it is done. If a
+                         job is replaced by a newer one before it starts, its
+                         callback is never called
+        :return: None
+        """
+        if key in self._running:
+            self._waiting[key] = (fit, args, callback)
+            return
+
+        self._running.add(key)
+        asyncio.get_event_loop().create_task(
+            self._run(key, fit, args, callback))
+
+    def is_training(self, key):
+        """Returns True if a fit for key is running or waiting"""
+        return key in self._running
+
+    async def _run(self, key, fit, args, callback):
+        """Runs fits for key until there are none waiting"""
+        loop = asyncio.get_event_loop()
+
+        try:
+            while True:
+                try:
+                    result = await loop.run_in_executor(self._executor, fit,
+                                                        *args)
+                except Exception as e:
+                    result = e
+
+                await callback(result)
+
+                if key not in self._waiting:
+                    break
+                fit, args, callback = self._waiting.pop(key)
+        finally:
+            self._running.discard(key)
+
+    def shutdown(self):
+        """Stops the worker processes once running fits are done"""
+        self._executor.shutdown(wait=True)
@@ -1,8 +1,19 @@
-from server.server import NeurostackServer
+import argparse
 
+from server.server import LEGACY_DIR, NeurostackServer
+from server.services.base_service import DATA_DIR
+
+
+parser = argparse.ArgumentParser(description='Run Neurostack server')
+parser.add_argument('--data_dir', type=str, default=DATA_DIR,
+                    help='directory to keep classifiers and training data in')
+parser.add_argument('--legacy_dir', type=str, default=LEGACY_DIR,
+                    help='directory older versions of the server saved '
+                         'classifiers in, to import them from')
+args = parser.parse_args()
 
 # Run neurostack server on localhost:8001
-service = NeurostackServer()
+service = NeurostackServer(data_dir=args.data_dir, legacy_dir=args.legacy_dir)
 service.initialize_handlers()
 
 service.app.run(host='localhost', port=8001)
@@ -0,0 +1,380 @@
+"""
+Binary frames for streaming raw EEG to apps. A frame is a 24-byte header
+followed by the samples as little-endian float32, channel by channel:
+
+    offset  type      field
+    0       4 bytes   magic, b'NSRD'
+    4       uint16    format version
+    6       uint16    number of channels
+    8       uint32    number of samples per channel
+    12      float64   timestamp of the first sample
+    20      float32   sample rate (timestamp of sample i is first + i / rate)
+    24      float32[] data, (channels x samples)
+
+The header is a multiple of 4 bytes long, so the data can be read in place
+with a Float32Array in the browser.
+
+A Broadcaster reads new data from a data stream once per frame and hands the
+same frame to every subscriber. Each subscriber has a bounded queue, so one
+that cannot keep up drops frames (or is disconnected) instead of making the
+queue grow.
+"""
+import asyncio
+import collections
+import struct
+
+import numpy as np
+
+FRAME_MAGIC = b'NSRD'
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct('<4sHHIdf')
+
+
+def pack_frame(data, timestamps, sample_rate):
+    """
+    Packs samples into a binary frame
+
+    :param data: (channels x samples) array
+    :param timestamps: timestamps of the samples
+    :param sample_rate: sample rate of the stream
+    :return: frame as bytes
+    :raises ValueError: if the sample rate is not positive
+    """
+    if not sample_rate > 0:
+        raise ValueError(f"Cannot pack a frame with sample rate {sample_rate}")
+
+    num_channels, num_samples = data.shape
+    first_timestamp = float(timestamps[0]) if num_samples else 0.
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, num_channels,
+                               num_samples, first_timestamp, sample_rate)
+
+    return header + np.ascontiguousarray(data, dtype='<f4').tobytes()
+
+
+def unpack_frame(frame):
+    """
+    Unpacks a binary frame
+
+    :param frame: frame as bytes
+    :return: (data, timestamps), where data is a (channels x samples) float32
+             array
+    """
+    magic, version, num_channels, num_samples, first_timestamp, sample_rate = \
+        FRAME_HEADER.unpack_from(frame)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Not a raw data frame")
+    if not sample_rate > 0:
+        raise ValueError(f"Invalid sample rate {sample_rate}")
+
+    data = np.frombuffer(frame, dtype='<f4', offset=FRAME_HEADER.size,
+                         count=num_channels * num_samples)
+    timestamps = first_timestamp + np.arange(num_samples) / sample_rate
+
+    return data.reshape(num_channels, num_samples), timestamps
+
+
+def estimate_sample_rate(timestamps):
+    """
+    Estimates the sample rate of a stream from the timestamps of consecutive
+    samples
+
+    :param timestamps: timestamps of the samples
+    :return: sample rate, or None if there are too few samples to tell
+    """
+    if len(timestamps) < 2 or timestamps[-1] <= timestamps[0]:
+        return None
+    return (len(timestamps) - 1) / (timestamps[-1] - timestamps[0])
+
+
+#
+# Broadcasting frames to subscribers
+#
+
+# what to do when a subscriber's queue is full:
+#   drop_oldest - drop the oldest queued frame to make room
+#   latest      - drop all queued frames and keep only the newest one
+#   disconnect  - stop sending to the subscriber
+SLOW_CONSUMER_POLICIES = ('drop_oldest', 'latest', 'disconnect')
+
+# default frames per second to broadcast, and frames a subscriber may fall
+# behind by
+BROADCAST_FRAME_RATE = 25
+MAX_QUEUED_FRAMES = 50
+
+# most frames a subscriber may ask to have queued
+MAX_QUEUED_FRAMES_LIMIT = 1000
+
+
+class Frame:
+
+    def __init__(self, data, timestamps, channels, sample_rate):
+        """
+        A block of new samples, shared by all subscribers. Each encoding is
+        made at most once, however many subscribers ask for it.
+
+        :param data: (channels x samples) array
+        :param timestamps: timestamps of the samples
+        :param channels: names of the channels
+        :param sample_rate: sample rate of the stream
+        """
+        self.data = data
+        self.timestamps = timestamps
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self._encoded = {}
+
+    def encode(self, fmt):
+        """
+        Returns the frame encoded as:
+            'binary' - a binary frame (see pack_frame)
+            'json' - a list with a {channel: [timestamp, value]} dict per
+                     sample
+
+        :param fmt: 'binary' or 'json'
+        :return: encoded frame
+        """
+        if fmt not in self._encoded:
+            if fmt == 'binary':
+                encoded = pack_frame(self.data, self.timestamps,
+                                     self.sample_rate)
+            elif fmt == 'json':
+                data = self.data.tolist()
+                encoded = [{channel: [timestamp, data[j][i]]
+                            for j, channel in enumerate(self.channels)}
+                           for i, timestamp in enumerate(self.timestamps.tolist())]
+            else:
+                raise ValueError(f"Unknown frame format {fmt}")
+            self._encoded[fmt] = encoded
+
+        return self._encoded[fmt]
+
+
+class Subscriber:
+
+    def __init__(self, send, fmt='json', max_frames=MAX_QUEUED_FRAMES,
+                 policy='drop_oldest'):
+        """
+        A subscriber to a Broadcaster, with its own bounded queue of frames
+        and a task that sends them, so that a slow subscriber only holds up
+        itself.
+
+        :param send: coroutine function called with each encoded frame
+        :param fmt: encoding of frames to send, see Frame.encode
+        :param max_frames: most frames that can be queued, clamped to between
+                           1 and MAX_QUEUED_FRAMES_LIMIT
+        :param policy: what to do when the queue is full, one of
+                       SLOW_CONSUMER_POLICIES
+        """
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy {policy}")
+        try:
+            max_frames = int(max_frames)
+        except (TypeError, ValueError):
+            raise ValueError(f"max_frames must be a number, not {max_frames}")
+
+        self.send = send
+        self.format = fmt
+        self.max_frames = min(max(1, max_frames), MAX_QUEUED_FRAMES_LIMIT)
+        self.policy = policy
+
+        # number of frames dropped because the subscriber fell behind
+        self.dropped = 0
+
+        self._frames = collections.deque()
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def put(self, frame):
+        """
+        Queues a frame to be sent, applying the slow consumer policy if the
+        queue is full
+
+        :param frame: Frame to send
+        :return: False if the subscriber should be disconnected, else True
+        """
+        if len(self._frames) >= self.max_frames:
+            if self.policy == 'disconnect':
+                return False
+            if self.policy == 'latest':
+                self.dropped += len(self._frames)
+                self._frames.clear()
+            else:
+                self.dropped += 1
+                self._frames.popleft()
+
+        self._frames.append(frame)
+        self._ready.set()
+        return True
+
+    def start(self):
+        """Starts sending queued frames in the background"""
+        self._task = asyncio.get_event_loop().create_task(self._send_frames())
+
+    def stop(self):
+        """Stops sending frames and drops any that are queued"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._frames.clear()
+
+    async def _send_frames(self):
+        """Sends queued frames as they arrive"""
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+
+            while self._frames:
+                frame = self._frames.popleft()
+                try:
+                    await self.send(frame.encode(self.format))
+                except Exception as e:
+                    print(f"Cannot send frame to subscriber: {e}")
+
+
+class Broadcaster:
+
+    def __init__(self, device, frame_rate=BROADCAST_FRAME_RATE,
+                 filtered=False):
+        """
+        Reads new EEG data from a device's data stream once per frame and fans
+        it out to any number of subscribers. Runs while there are subscribers.
+
+        :param device: device to read from. Its current data stream is used,
+                       so broadcasting carries on if the device replaces it
+                       (eg. when it is shut down and reconnected)
+        :param frame_rate: frames per second
+        :param filtered: if True, broadcast the output of the data stream's
+                         online filters instead of raw data
+        """
+        self.device = device
+        self.frame_rate = frame_rate
+        self.filtered = filtered
+
+        # subscribers, and functions to call if they are disconnected, with
+        # subscriber key as key
+        self.subscribers = {}
+        self._on_disconnect = {}
+        self._task = None
+
+    def subscribe(self, key, send, fmt='json', max_frames=MAX_QUEUED_FRAMES,
+                  policy='drop_oldest', on_disconnect=None):
+        """
+        Adds a subscriber, replacing any with the same key, and starts
+        broadcasting if needed
+
+        :param key: key to identify the subscriber by (eg. user ID)
+        :param send: coroutine function called with each encoded frame
+        :param fmt: encoding of frames to send, see Frame.encode
+        :param max_frames: most frames that can be queued for the subscriber
+        :param policy: what to do when the subscriber falls max_frames behind,
+                       one of SLOW_CONSUMER_POLICIES
+        :param on_disconnect: coroutine function called if the subscriber is
+                              disconnected by the 'disconnect' policy
+        :return: the Subscriber
+        """
+        self.unsubscribe(key)
+
+        subscriber = Subscriber(send, fmt=fmt, max_frames=max_frames,
+                                policy=policy)
+        subscriber.start()
+        self.subscribers[key] = subscriber
+        self._on_disconnect[key] = on_disconnect
+
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(
+                self._broadcast())
+
+        return subscriber
+
+    def unsubscribe(self, key):
+        """
+        Removes a subscriber, if there is one with key
+
+        :param key: key of the subscriber
+        :return: None
+        """
+        subscriber = self.subscribers.pop(key, None)
+        self._on_disconnect.pop(key, None)
+        if subscriber is not None:
+            subscriber.stop()
+
+        # stop broadcasting once the last subscriber has left
+        if not self.subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _broadcast(self):
+        """
+        Reads new samples frame_rate times a second and queues them for every
+        subscriber, for as long as there are subscribers
+
+        :return: None
+        """
+        task = self._task
+        loop = asyncio.get_event_loop()
+        next_frame = loop.time()
+        data_stream = None
+
+        try:
+            while self.subscribers:
+                # start from the latest data if the device has a new stream
+                if self.device.data_stream is not data_stream:
+                    data_stream = self.device.data_stream
+                    cursor = data_stream.get_cursor()
+
+                # wait for the next frame, then for any data to put in it
+                next_frame += 1 / self.frame_rate
+                await asyncio.sleep(max(0., next_frame - loop.time()))
+                await data_stream.wait_for_data_async(cursor, timeout=1)
+                if data_stream.get_cursor() == cursor:
+                    next_frame = loop.time()
+                    continue
+
+                try:
+                    cursor = self._send_frame(data_stream, cursor)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # keep broadcasting to the subscribers, from the latest
+                    # data
+                    print(f"Cannot broadcast raw data: {e}")
+                    cursor = data_stream.get_cursor()
+        finally:
+            if self._task is task:
+                self._task = None
+
+    def _send_frame(self, data_stream, cursor):
+        """
+        Queues the samples added after cursor as a frame for every subscriber
+
+        :param data_stream: DataStream to read from
+        :param cursor: cursor of the last sample sent
+        :return: cursor to pass to the next call
+        """
+        channels = data_stream.get_eeg_channels()
+        if channels is None:
+            channels = data_stream.list_channels()
+        data, timestamps, new_cursor = data_stream.get_data_since(
+            cursor, channels, copy=True, filtered=self.filtered)
+        if len(timestamps) == 0:
+            return new_cursor
+
+        # without a known sample rate, wait until there are enough samples to
+        # estimate it
+        sample_rate = data_stream.sample_rate or \
+            estimate_sample_rate(timestamps)
+        if sample_rate is None:
+            return cursor
+
+        frame = Frame(data, timestamps, channels, sample_rate)
+        for key, subscriber in list(self.subscribers.items()):
+            if not subscriber.put(frame):
+                self._disconnect(key)
+        return new_cursor
+
+    def _disconnect(self, key):
+        """Removes a subscriber that fell behind, and lets its owner know"""
+        on_disconnect = self._on_disconnect.get(key)
+        self.unsubscribe(key)
+        if on_disconnect is not None:
+            asyncio.get_event_loop().create_task(on_disconnect())
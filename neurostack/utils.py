@@ -1,4 +1,15 @@
+import re
 import uuid
+import zlib
+
+import numpy as np
+
+# dtypes that arrays can be sent as in binary payloads
+PAYLOAD_DTYPES = ('float32', 'float16')
+
+# client UUIDs are used as file names, so they may only have letters, digits,
+# '-', '_' and '.', and may not start with '.'
+UUID_PATTERN = re.compile(r'[A-Za-z0-9_-][A-Za-z0-9_.-]{0,127}')
 
 
 def generate_uuid():
@@ -6,3 +17,102 @@ def generate_uuid():
     # Completely random UUID; use uuid1() for a UUID based on host MAC address
     # and current time
     return str(uuid.uuid4())
+
+
+def is_valid_uuid(uuid):
+    """
+    Checks that a client UUID is safe to use as a file name (see
+    UUID_PATTERN)
+
+    :param uuid: client UUID
+    :return: True if it is valid
+    """
+    return isinstance(uuid, str) and UUID_PATTERN.fullmatch(uuid) is not None
+
+
+def nan_to_none(array):
+    """
+    Converts an array to nested lists for JSON, with None in place of NaN
+    (which is not valid JSON)
+
+    :param array: array to convert
+    :return: nested lists
+    """
+    array = np.asarray(array)
+    if not np.issubdtype(array.dtype, np.floating) or \
+            not np.isnan(array).any():
+        return array.tolist()
+    return np.where(np.isnan(array), None, array.astype(object)).tolist()
+
+
+def encode_array(array, dtype='float32', compress=False):
+    """
+    Encodes an array as a compact binary payload for socket.io: a dict with
+    the array's dtype and shape, and its values as raw little-endian bytes.
+    socket.io sends the bytes as a binary attachment instead of as JSON.
+
+    :param array: array (or nested lists) to encode
+    :param dtype: dtype to send values as, one of PAYLOAD_DTYPES. float16
+                  halves the size, at the cost of precision
+    :param compress: if True, compress the bytes with zlib (lossless)
+    :return: payload dict, see decode_array
+    """
+    if dtype not in PAYLOAD_DTYPES:
+        raise ValueError(f"Cannot encode arrays as {dtype}")
+
+    dtype = np.dtype(dtype).newbyteorder('<')
+    array = np.ascontiguousarray(array, dtype=dtype)
+    data = array.tobytes()
+    if compress:
+        data = zlib.compress(data, 1)
+
+    return {
+        'dtype': array.dtype.str,
+        'shape': list(array.shape),
+        'compression': 'zlib' if compress else None,
+        'data': data
+    }
+
+
+def decode_array(payload):
+    """
+    Decodes an array sent by encode_array, or sent as nested lists
+
+    :param payload: payload dict from encode_array, or nested lists
+    :return: numpy array. Arrays sent as float16 are returned as float32
+    :raises ValueError: if the payload is not a valid array of one of
+                        PAYLOAD_DTYPES
+    """
+    if not isinstance(payload, dict):
+        return np.asarray(payload)
+
+    try:
+        dtype = np.dtype(payload['dtype'])
+    except TypeError:
+        raise ValueError(f"Unknown dtype {payload['dtype']}")
+    if dtype not in [np.dtype(name).newbyteorder('<')
+                     for name in PAYLOAD_DTYPES]:
+        raise ValueError(f"Cannot decode arrays of {dtype}")
+
+    shape = tuple(payload['shape'])
+    if not all(isinstance(n, int) and n >= 0 for n in shape):
+        raise ValueError(f"Invalid shape {payload['shape']}")
+    size = int(np.prod(shape)) * dtype.itemsize
+
+    data = payload['data']
+    if payload.get('compression') == 'zlib':
+        # decompress at most one byte more than expected, so that a payload
+        # that is too long is caught without decompressing all of it
+        data = zlib.decompressobj().decompress(data, size + 1)
+    elif payload.get('compression') is not None:
+        raise ValueError(f"Unknown compression {payload['compression']}")
+
+    if len(data) != size:
+        raise ValueError(f"Got {len(data)} bytes of data for an array of "
+                         f"shape {shape} of {dtype}")
+
+    array = np.frombuffer(data, dtype=dtype).reshape(shape)
+    if array.dtype == np.float16:
+        array = array.astype(np.float32)
+
+    return array